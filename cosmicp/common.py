@@ -5,6 +5,10 @@ import operator
 import os
 import numpy as np
 import json
+import time
+import queue
+import atexit
+import threading
 
 try: 
     from mpi4py import *
@@ -35,19 +39,156 @@ class bcolors:
 def color(string, c):
     return c + string + bcolors.ENDC
 
+#zmq endpoint of an address, IP:PORT addresses are tcp and others are given as tcp://, ipc://PATH or inproc://NAME
+def endpoint(address):
+    return address if "://" in address else "tcp://" + address
+
+#Log levels, per frame messages are below DEBUG and off by default
+ERROR, WARNING, INFO, DEBUG, FRAME = 40, 30, 20, 10, 5
+log_levels = {"error": ERROR, "warning": WARNING, "info": INFO, "debug": DEBUG, "frame": FRAME}
+
+log_level = INFO
+log_period = 5.0 #seconds between progress summaries, and between repetitions of rate limited messages
+
+#Messages are written to stdout by a background thread, callers never wait for the terminal
+log_queue = queue.Queue()
+log_thread = None
+log_lock = threading.Lock()
+
+rate_limits = {} #message key -> [time of the last message written, messages suppressed since]
+progress = {} #progress key -> [message, count, count at the last summary, time of the last summary]
+
+def set_log_level(level, period = None):
+
+    global log_level, log_period
+
+    log_level = log_levels[level] if isinstance(level, str) else level
+
+    if period is not None:
+        log_period = period
+
+def log_writer():
+
+    while True:
+        line = log_queue.get()
+        sys.stdout.write(line + "\n")
+
+        #Flushing only when there is nothing else to write
+        if log_queue.empty():
+            sys.stdout.flush()
+
+        log_queue.task_done()
+
+def flush_log():
+    """Waits until all the queued messages are written"""
+
+    if log_thread is not None:
+        log_queue.join()
+
+atexit.register(flush_log)
+
+def log(level, message, *args, c = None, rate_limited = False, key = None):
+    """Queues message, formatted with args, if level is enabled. Nothing is formatted otherwise.
+    If rate_limited, repetitions of the same key (the message by default) within log_period seconds are suppressed, and counted."""
+
+    global log_thread
+
+    if level < log_level:
+        return
+
+    if rate_limited:
+        key = key or message
+        now = time.time()
+
+        with log_lock:
+            last = rate_limits.setdefault(key, [0.0, 0])
+
+            if now - last[0] < log_period:
+                last[1] += 1
+                return
+
+            suppressed = last[1]
+            rate_limits[key] = [now, 0]
+
+        if suppressed > 0:
+            message += " ({} similar messages suppressed)".format(suppressed)
+
+    if args:
+        message = message.format(*args)
+
+    if c is not None:
+        message = color(message, c)
+
+    if log_thread is None:
+        with log_lock:
+            if log_thread is None:
+                log_thread = threading.Thread(target = log_writer, daemon = True)
+                log_thread.start()
+
+    log_queue.put(message)
+
+def log_rank(level, message, *args, c = None, rate_limited = False, key = None):
+    """Same as log, on all ranks with the rank number"""
+
+    if level < log_level:
+        return
+
+    if mpi_enabled:
+        message = color("\r MPI Rank " + str(rank) + ": ", bcolors.HEADER) + (color(message, c) if c is not None else message)
+        c = None
+
+    log(level, message, *args, c = c, rate_limited = rate_limited, key = key)
+
+def log_frame(message, *args):
+    """Per frame messages, only written at the 'frame' log level"""
+
+    if FRAME < log_level:
+        return
+
+    log_rank(FRAME, message, *args, c = bcolors.HEADER)
+
+def log_progress(key, message, n = 1):
+    """Counts n events of key, and writes message formatted with the total count and the rate at most every log_period seconds.
+    This replaces per frame messages at the default log level."""
+
+    now = time.time()
+
+    with log_lock:
+        p = progress.setdefault(key, [message, 0, 0, now])
+        p[1] += n
+
+        if now - p[3] < log_period:
+            return
+
+        total, rate = p[1], (p[1] - p[2]) / (now - p[3])
+        p[2], p[3] = p[1], now
+
+    log_rank(INFO, message, total, rate, c = bcolors.HEADER)
+
+def end_progress():
+    """Writes the final count of every progress key, and resets them (at the end of a scan)"""
+
+    with log_lock:
+        finished = list(progress.values())
+        progress.clear()
+
+    for message, total, last_total, last_time in finished:
+        if total > last_total:
+            log_rank(INFO, message, total, (total - last_total) / max(time.time() - last_time, 1e-9), c = bcolors.HEADER)
+
 def printd(string):
     if mpi_enabled:
-        a = color("\r MPI Rank " + str(rank) + ": ", bcolors.HEADER)
-        print(a, end="", flush=True)
-        print(string)
+        log_rank(INFO, string)
     else: 
         printv(string)
 
 def printv(string):
     if rank == 0:
-        print(string)
+        log(INFO, string)
+
+def gather(local, out_shape, n_elements, dtype, communicator = None):
 
-def gather(local, out_shape, n_elements, dtype):
+    communicator = communicator or comm
 
     t = None
 
@@ -55,21 +196,28 @@ def gather(local, out_shape, n_elements, dtype):
         t = MPI.INT
     if dtype == float or dtype == np.float32:
         t = MPI.FLOAT
+    if dtype == np.uint16:
+        t = MPI.UNSIGNED_SHORT
 
     sendbuf = np.array(local, dtype = dtype)
 
-    counts = comm.gather(n_elements)
+    counts = communicator.gather(n_elements)
 
     indexes = None
 
     if rank == 0:
         indexes = np.cumsum([0] + counts[:-1])
+
+        #A first dimension of None is given by the number of elements gathered
+        if out_shape[0] is None:
+            out_shape = (sum(counts) // int(np.prod(out_shape[1:])),) + tuple(out_shape[1:])
+
         recvbuf = np.empty(out_shape, dtype)
 
     else:
         recvbuf = None
 
-    comm.Gatherv(sendbuf=sendbuf, recvbuf=[recvbuf, counts, indexes, t])
+    communicator.Gatherv(sendbuf=sendbuf, recvbuf=[recvbuf, counts, indexes, t])
 
     return recvbuf
 
@@ -93,7 +241,13 @@ def complete_metadata(metadata, conf_file):
     metadata["final_res"] = defaults["geometry"]["resolution"]  #3e-9 #recon pixel size meters
     metadata["desired_padded_input_frame_width"] = None
     metadata["output_frame_width"] = defaults["geometry"]["shape"]  #256 # final frame width 
+    metadata["rebin"] = defaults["geometry"].get("rebin", 1) #largest rebinning of the clean frames, see preprocessor.rebin_factor
     metadata["translations"] = convert_translations(np.array(metadata["translations"]))
+    metadata["repetition"] = defaults["scan"].get("repetition", 1) #consecutive exposures at each position, see preprocessor.compute_accumulation_metadata
+
+    #Detector gain calibration, ADUs per photon = adu_per_ev * energy (eV) + adu_offset
+    metadata["adu_per_ev"] = defaults["process"]["adu_per_ev"]
+    metadata["adu_offset"] = defaults["process"]["adu_offset"]
     if metadata["double_exposure"]:
         metadata["double_exp_time_ratio"] = metadata["dwell1"] // metadata["dwell2"] # time ratio between long and short exposure
     else:
@@ -2,17 +2,19 @@
 
 import sys
 import os
-import h5py
-import zmq
 from cosmicp.options import parse_arguments
-from cosmicp.common import rank, size, mpi_enabled, printd, printv, set_visible_device, complete_metadata, color, bcolors
+from cosmicp.common import rank, size, mpi_enabled, printd, printv, set_visible_device, complete_metadata, color, bcolors, set_log_level, end_progress, log, WARNING
+import cosmicp.profiling as profiling
 import socket
+from functools import partial
 
 if __name__ == '__main__':
     args = sys.argv[1:]
 
     options = parse_arguments(args)
 
+    set_log_level(options["log_level"], options["log_period"])
+
     if options["gpu_accelerated"]:
         device_order, visible_devices, n_gpus = set_visible_device(rank)
 
@@ -29,25 +31,20 @@ if __name__ == '__main__':
 
     os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3" #this removes some log messages from tensorflow that can be pretty annoying
 
-    from absl import logging
-    logging.set_verbosity(logging.ERROR) #This does removes some annoying warnings from JAX
-
+    #Before JAX is imported, XLA flags are read when it initializes
+    profiling.setup(options)
 
-    import numpy as onp
-    import jax.numpy as np
-    import jax
-    import cosmicp.diskIO as diskIO
-    import cosmicp.preprocessor as preprocessor
+    #Sockets, dark library and metrics are set up before importing JAX, which takes a few seconds per rank
+    import cosmicp.metrics as metrics
+    import cosmicp.trace as trace
 
-    from cosmicp.diskIO import frames_out, map_tiffs, read_metadata_hdf5
-    from cosmicp.preprocessor import prepare, process, save_results, receive_metadata, subscribe_to_socket, xsub_xpub_router, publish_to_socket, send_metadata
-    from timeit import default_timer as timer
+    from cosmicp.darks import open_dark_library
 
     network_metadata = {}
 
-    #See if we have a file or an ip address
+    #See if we have a file or an ip address, in server mode files come with the jobs
     try:
-        socket.inet_aton(options["fname"].split(":")[0]) #We need the split to remove the port number
+        socket.inet_aton((options["fname"] or "").split(":")[0]) #We need the split to remove the port number
         network_metadata["input_address"] = options["fname"]
         printv(color("\nProcessing data from socket\n", bcolors.OKGREEN))
     except OSError:
@@ -57,6 +54,9 @@ if __name__ == '__main__':
     #data coming from socket or into a socket
     if "input_address" in network_metadata or options["output_mode"] != "disk":
 
+        import zmq
+        from cosmicp.network import receive_metadata, subscribe_to_socket, xsub_xpub_router, publish_to_socket, send_metadata, compression_available
+
         network_metadata["context"] = zmq.Context()
 
     if options["output_mode"] != "disk":
@@ -67,6 +67,36 @@ if __name__ == '__main__':
         network_metadata["intermediate_address"] = options["intermediate_address"]
         network_metadata["intermediate_socket"] = publish_to_socket(network_metadata)
 
+        network_metadata["ordered_output"] = options["ordered_output"]
+        network_metadata["ordered_timeout"] = options["frame_timeout"]
+
+        #The ordered router orders single frame messages
+        if options["ordered_output"] > 0 and options["frames_per_message"] > 1:
+            log(WARNING, color("\r --ordered_output sends one frame per message, --frames_per_message is ignored", bcolors.WARNING))
+            options["frames_per_message"] = 1
+
+        if not compression_available(options["compression"]):
+            log(WARNING, color("\r Compression {} is not available, the output is compressed with zlib".format(options["compression"]), bcolors.WARNING))
+            options["compression"] = "zlib"
+
+        #Shared memory slots are neither compressed nor sparse
+        if options["shm_ring"] > 0 and (options["compression"] != "none" or options["sparse"]):
+            log(WARNING, color("\r The output in shared memory is neither compressed nor sparse", bcolors.WARNING))
+            options["compression"] = "none"
+            options["sparse"] = False
+
+        if options["intermediate_address"].startswith("inproc://") and size > 1:
+            log(WARNING, color("\r inproc:// only connects the threads of a process, the other MPI ranks can't reach the router", bcolors.WARNING))
+
+        network_metadata["output_format"] = {"frames_per_message": options["frames_per_message"], "compression": options["compression"],
+                                             "shared_memory": options["shm_ring"] > 0, "sparse": options["sparse"]}
+        network_metadata["shm_slots"] = options["shm_ring"]
+
+        #Previews go with the output frames to the socket, the settings are announced with the metadata of each scan
+        network_metadata["preview"] = None
+        if options["preview"] > 0:
+            network_metadata["preview"] = {"width": options["preview_width"], "decimation": options["preview"], "topic": "preview"}
+
         #rank 0 sets up the xsub and xpub router
         if rank == 0:
             xsub_xpub_router(network_metadata)
@@ -75,12 +105,46 @@ if __name__ == '__main__':
     if "input_address" in network_metadata:
 
         network_metadata["input_socket"] = subscribe_to_socket(network_metadata)
+        network_metadata["frame_timeout"] = options["frame_timeout"]
+        network_metadata["flush_period"] = options["flush_period"]
+        network_metadata["max_reorder"] = options["max_reorder"]
 
-    run = True
+    #Jobs are queued while the ranks import JAX
+    if options["server"] is not None:
+        import cosmicp.server as server
+        server.start(options["server"])
 
-    while run:
+    dark_library = open_dark_library(options["dark_library"], options["conf_file"])
 
-        printv(color("\nStarting a new scan preprocessing...\n", bcolors.OKGREEN))
+    if options["metrics_port"] is not None:
+        metrics.start_http_server(options["metrics_port"])
+
+    if options["metrics_file"] is not None:
+        metrics.start_stats_file(options["metrics_file"], options["metrics_period"])
+
+    if options["trace"] is not None:
+        trace.enable()
+
+    from absl import logging
+    logging.set_verbosity(logging.ERROR) #This does removes some annoying warnings from JAX
+
+    import h5py
+    import cosmicp.diskIO as diskIO
+
+    from cosmicp.diskIO import map_tiffs, read_metadata_hdf5
+    from cosmicp.preprocessor import prepare, process, save_results
+
+    #Scan k is saved while scan k + 1 is received and processed
+    background_saves = (options["keep_running"] or options["server"] is not None) and options["pending_saves"] > 0 and options["output_mode"] != "socket"
+
+    if background_saves:
+        import cosmicp.writer as writer
+        background_saves = writer.start(options["pending_saves"])
+
+    def read_scan(fname, options):
+        """Metadata, dark and exposure frames of the scan in fname, or of the next scan from the input socket, and the HDF5 file to close"""
+
+        f = None
 
         #data coming from socket
         if "input_address" in network_metadata:
@@ -90,30 +154,59 @@ if __name__ == '__main__':
 
             dark_frames, exp_frames = [],[]
 
-        elif options["fname"].endswith('.json'):
+        elif fname.endswith('.json'):
             #fname = "/cosmic-dtn/groups/cosmic/Data/2021/09/210916/210916006/210916006_002_info.json"
-            metadata = diskIO.read_metadata(options["fname"])
+            metadata = diskIO.read_metadata(fname)
             metadata = complete_metadata(metadata, options["conf_file"])
-            dark_frames = diskIO.read_dark_data(metadata, options["fname"])
-            base_folder = os.path.split(options["fname"])[:-1][0] + "/" 
+            dark_frames = diskIO.map_dark_data(metadata, fname, options["io_threads"])
+            base_folder = os.path.split(fname)[:-1][0] + "/" 
             base_folder += os.path.basename(os.path.normpath(metadata["exp_dir"]))
-            exp_frames = map_tiffs(base_folder)
+            exp_frames = map_tiffs(base_folder, options["io_threads"])
 
-        elif options["fname"].endswith('.h5'):
+        elif fname.endswith('.h5'):
             #fname = "/cosmic-dtn/groups/cosmic/Data/2021/09/210916/210916003/raw_data.h5"
 
-            metadata = read_metadata_hdf5(options["fname"])
+            metadata = read_metadata_hdf5(fname)
             #metadata = diskIO.read_metadata("/cosmic-dtn/groups/cosmic/Data/2021/09/210923/210923044/210923044_002_info.json")
 
             metadata = complete_metadata(metadata, options["conf_file"])
 
-            f = h5py.File(options["fname"], 'r')
+            f = h5py.File(fname, 'r')
 
             dark_frames = f["entry_1/data_1/dark_frames"]
             exp_frames = f["entry_1/data_1/exp_frames"]
+
+        elif fname.endswith(diskIO.raw_container_extension):
+            #Scan packed with scripts/pack_raw_scan.py, frames are memory mapped
+
+            metadata, dark_frames, exp_frames = diskIO.map_raw_container(fname)
+            metadata = complete_metadata(metadata, options["conf_file"])
+
+        return metadata, dark_frames, exp_frames, f
+
+
+    def preprocess_scan(fname, options, n_scans, metadata_overrides = {}, saved = None):
+        """Preprocesses a scan with options, metadata_overrides replacing values of the configuration file, saved() is called once its results are saved.
+        Returns the stage timings and counters of the scan on rank 0, where the gather and writes of the results count in the scan being processed then."""
+
+        printv(color("\nStarting a new scan preprocessing...\n", bcolors.OKGREEN))
+
+        scan_metrics = metrics.snapshot()
+
+        #Sent with the metadata and, to the ordered router, with the output frames
+        network_metadata["scan_id"] = n_scans
+
+        metadata, dark_frames, exp_frames, f = read_scan(fname, options)
+
+        metadata.update(metadata_overrides)
     
+        metadata["photon_counts"] = options["photon_counts"]
+        metadata["fast_start"] = options["fast_start"]
+        metadata["timestamps"] = options["timestamps"]
+        metadata["sparse_cxi"] = options["sparse_cxi"]
+        metadata["accumulate"] = options["accumulate"]
 
-        metadata, background_avg, received_exp_frames = prepare(metadata, dark_frames, exp_frames, network_metadata)
+        metadata, background_avg, received_exp_frames = prepare(metadata, dark_frames, exp_frames, network_metadata, dark_library)
 
         if options["output_mode"] != "disk" and rank == 0:
             send_metadata(network_metadata, metadata)
@@ -122,16 +215,65 @@ if __name__ == '__main__':
 
         printv(color("\nScan preprocessing completed\n", bcolors.OKGREEN))
 
-        if options["fname"].endswith('.h5'):
-            f.close
-
         #In socket mode we don't save the final results
-        if options["output_mode"] != "socket":
-            save_results(options["fname"], metadata, out_data, my_indexes, metadata["translations"].shape[0])
+        if options["output_mode"] != "socket" and background_saves:
+            writer.save(fname, metadata, out_data, my_indexes, metadata["translations"].shape[0], saved)
 
+        elif options["output_mode"] != "socket":
+            save_results(fname, metadata, out_data, my_indexes, metadata["translations"].shape[0])
 
-        run = options["keep_running"] and ("input_address" in network_metadata)
+            if saved is not None:
+                saved()
+
+        if f is not None:
+            f.close()
+
+        #Collective, all ranks send their metrics of this scan to rank 0
+        end_progress()
+
+        summary = metrics.print_summary(scan_metrics, "Scan stage timings")
+
+        if options["trace"] is not None:
+            trace_fname = options["trace"]
+            if options["keep_running"] or options["server"] is not None:
+                base, ext = os.path.splitext(trace_fname)
+                trace_fname = "{}_scan{}{}".format(base, n_scans, ext)
+            trace.dump(trace_fname)
+
+        profiling.end_of_scan()
 
+        return summary
 
-  
 
+    n_scans = 0
+
+    if options["server"] is not None:
+
+        #Jobs are processed by all ranks until the server is shut down, with the kernels compiled by the previous jobs
+        job = server.next_job()
+
+        while job is not None:
+
+            try:
+                summary = preprocess_scan(job["fname"], {**options, **job["options"]}, n_scans, job["metadata"], partial(server.job_saved, job))
+                server.job_done(job, summary)
+
+            except Exception as e:
+                server.job_failed(job, e)
+
+            n_scans += 1
+
+            job = server.next_job()
+
+    run = options["server"] is None
+
+    while run:
+
+        preprocess_scan(options["fname"], options, n_scans)
+
+        n_scans += 1
+
+        run = options["keep_running"] and ("input_address" in network_metadata)
+
+    if background_saves:
+        writer.finish()
@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+
+class DarkAccumulator:
+    """Running mean, and optionally variance, of the dark frames of each exposure (Welford's algorithm).
+    Memory does not grow with the number of dark frames. Frames are added in acquisition order,
+    which alternates long and short exposures in double exposure scans."""
+
+    def __init__(self, n_exposures = 1, track_variance = False):
+
+        self.n_exposures = n_exposures
+        self.track_variance = track_variance
+
+        self.n_frames = 0
+        self.counts = [0] * n_exposures
+        self.means = [None] * n_exposures
+        self.m2s = [None] * n_exposures
+
+        #Mean acquisition time of the frames (seconds since the epoch), None for frames of the current scan
+        self.acquisition_time = None
+
+    def add(self, frame):
+
+        e = self.n_frames % self.n_exposures
+
+        frame = np.asarray(frame, dtype = np.float64)
+
+        if self.means[e] is None:
+            self.means[e] = np.zeros(frame.shape)
+            if self.track_variance:
+                self.m2s[e] = np.zeros(frame.shape)
+
+        self.counts[e] += 1
+
+        delta = frame - self.means[e]
+        self.means[e] += delta / self.counts[e]
+
+        if self.track_variance:
+            self.m2s[e] += delta * (frame - self.means[e])
+
+        self.n_frames += 1
+
+    def add_batch(self, frames):
+
+        #Exposure of the first frame in the batch, the rest alternate from it
+        first = self.n_frames % self.n_exposures
+
+        for k in range(0, self.n_exposures):
+
+            e = (first + k) % self.n_exposures
+            exp_frames = frames[k::self.n_exposures]
+
+            if len(exp_frames) == 0:
+                continue
+
+            #The sum is accumulated in float64 without converting the whole batch
+            mean = np.mean(exp_frames, axis = 0, dtype = np.float64)
+
+            m2 = None
+            if self.track_variance:
+                m2 = np.zeros(mean.shape)
+                for frame in exp_frames:
+                    m2 += (frame - mean)**2
+
+            self.merge(e, len(exp_frames), mean, m2)
+
+        self.n_frames += len(frames)
+
+    def merge(self, e, count, mean, m2 = None):
+        """Merges the statistics of count frames of exposure e (Chan et al. parallel update)"""
+
+        if self.counts[e] == 0:
+            self.counts[e] = count
+            self.means[e] = np.array(mean, dtype = np.float64)
+            if self.track_variance:
+                self.m2s[e] = np.zeros(self.means[e].shape) if m2 is None else np.array(m2, dtype = np.float64)
+            return
+
+        total = self.counts[e] + count
+        delta = mean - self.means[e]
+
+        self.means[e] = self.means[e] + delta * (count / total)
+
+        if self.track_variance:
+            m2 = 0 if m2 is None else m2
+            self.m2s[e] = self.m2s[e] + m2 + delta**2 * (self.counts[e] * count / total)
+
+        self.counts[e] = total
+
+    def is_empty(self):
+        return min(self.counts) == 0
+
+    def background(self):
+        """Average dark frame, with shape (2, ...) for double exposure scans"""
+
+        if self.n_exposures == 1:
+            return np.float32(self.means[0])
+
+        return np.array(self.means, dtype = np.float32)
+
+    def variance(self):
+        """Per pixel variance of the dark frames (noise map), same shape as background()"""
+
+        var = [m2 / max(n - 1, 1) for m2, n in zip(self.m2s, self.counts)]
+
+        if self.n_exposures == 1:
+            return np.float32(var[0])
+
+        return np.array(var, dtype = np.float32)
+
+
+#Metadata fields identifying the dark level of a scan, fields missing in a scan are taken as None.
+#Detector settings reported by the control system (temperature, timing configuration...) can be added in the configuration file.
+default_key_fields = ["double_exposure", "dwell1", "dwell2", "dwell"]
+
+class DarkLibrary:
+    """On-disk library of averaged dark frames (with their variance, number of frames and acquisition time),
+    keyed by the dwell times and detector settings of a scan. Dark levels are stable over hours for the same settings,
+    so a fresh entry can replace, or complement, the dark frames of a new scan.
+
+    max_age: entries older than this (seconds) are not used.
+    evict_age: entries older than this (seconds) are deleted from disk.
+    min_frames: scans with fewer new dark frames per exposure than this are blended with the library entry."""
+
+    def __init__(self, path, max_age = 4 * 3600, evict_age = 72 * 3600, min_frames = 50, key_fields = default_key_fields):
+
+        self.path = path
+        self.max_age = max_age
+        self.evict_age = evict_age
+        self.min_frames = min_frames
+        self.key_fields = key_fields
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok = True)
+
+    def key(self, metadata, frame_shape):
+
+        key = {field: metadata.get(field, None) for field in self.key_fields}
+        key["frame_shape"] = [int(n) for n in frame_shape]
+
+        return json.dumps(key, sort_keys = True)
+
+    def entry_file(self, key):
+        return os.path.join(self.path, "dark_" + hashlib.sha1(key.encode()).hexdigest()[:16] + ".npz")
+
+    def entry_files(self):
+        return [os.path.join(self.path, fname) for fname in os.listdir(self.path) if fname.startswith("dark_") and fname.endswith(".npz")]
+
+    def stored_frame_shape(self, metadata):
+        """Frame shape of the newest library entry with the settings of metadata, None if there is none"""
+
+        fields = json.loads(self.key(metadata, ()))
+        del fields["frame_shape"]
+
+        shape, newest = None, None
+
+        for fname in self.entry_files():
+            try:
+                with np.load(fname) as entry:
+                    key, entry_time = json.loads(str(entry["key"])), float(entry["time"])
+            except (OSError, KeyError, ValueError):
+                continue
+
+            entry_shape = key.pop("frame_shape", None)
+
+            if key == fields and (newest is None or entry_time > newest):
+                shape, newest = entry_shape, entry_time
+
+        return shape
+
+    def load(self, metadata, frame_shape, max_count = None):
+        """Returns a DarkAccumulator with the library entry for these settings, or None if there is no fresh entry.
+        With max_count, the entry counts as at most max_count frames per exposure."""
+
+        key = self.key(metadata, frame_shape)
+
+        try:
+            with np.load(self.entry_file(key)) as entry:
+                if str(entry["key"]) != key or time.time() - float(entry["time"]) > self.max_age:
+                    return None
+
+                means, variances, counts, entry_time = entry["mean"], entry["variance"], entry["counts"], float(entry["time"])
+
+        except (OSError, KeyError, ValueError):
+            return None
+
+        darks = DarkAccumulator(len(counts), track_variance = True)
+        darks.acquisition_time = entry_time
+
+        for e in range(0, len(counts)):
+            count = int(counts[e]) if max_count is None else min(int(counts[e]), max_count)
+            darks.merge(e, count, means[e], variances[e] * max(count - 1, 1))
+
+        return darks
+
+    def blend(self, metadata, darks, frame_shape = None):
+        """Returns the dark statistics to use for a scan given its new dark frames: the new darks alone if there are enough of them,
+        otherwise blended with a fresh library entry, or the new darks alone again if there is no such entry.
+        frame_shape is the shape of the raw frames of the scan, if known, for scans without dark frames"""
+
+        if min(darks.counts) >= self.min_frames:
+            return darks
+
+        if not darks.is_empty():
+            frame_shape = darks.means[0].shape
+
+        elif frame_shape is None:
+            frame_shape = self.stored_frame_shape(metadata)
+
+            if frame_shape is None:
+                return darks
+
+        #The entry weighs as many frames as missing to reach min_frames, so old darks fade out over successive blends
+        entry = self.load(metadata, frame_shape, self.min_frames - min(darks.counts))
+
+        if entry is None:
+            return darks
+
+        #The blend is as old as the frames it averages, so that darks refreshed with a few new frames still expire
+        n_entry, n_new = min(entry.counts), min(darks.counts)
+        entry.acquisition_time = (n_entry * entry.acquisition_time + n_new * (darks.acquisition_time or time.time())) / (n_entry + n_new)
+
+        for e in range(0, darks.n_exposures):
+            if darks.counts[e] > 0:
+                entry.merge(e, darks.counts[e], darks.means[e], darks.m2s[e])
+
+        #This is the number of new frames in the scan
+        entry.n_frames = darks.n_frames
+
+        return entry
+
+    def store(self, metadata, darks):
+
+        frame_shape = darks.means[0].shape
+
+        fname = self.entry_file(self.key(metadata, frame_shape))
+        tmp_fname = fname + ".tmp.npz"
+
+        acquisition_time = darks.acquisition_time if darks.acquisition_time is not None else time.time()
+
+        np.savez(tmp_fname, key = self.key(metadata, frame_shape), time = acquisition_time, counts = np.array(darks.counts),
+                 mean = np.array(darks.means, dtype = np.float32), variance = darks.variance().reshape((darks.n_exposures,) + frame_shape))
+
+        #Atomic, ranks reading the library never see a partially written entry
+        os.replace(tmp_fname, fname)
+
+    def evict(self):
+
+        now = time.time()
+
+        for fname in self.entry_files():
+
+            try:
+                with np.load(fname) as entry:
+                    expired = now - float(entry["time"]) > self.evict_age
+            except (OSError, KeyError, ValueError):
+                #Unreadable entries go by their modification time
+                expired = now - os.path.getmtime(fname) > self.evict_age
+
+            if expired:
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+
+
+def open_dark_library(path, conf_file):
+    """Returns the DarkLibrary set up in the 'darks' section of the configuration file, path overrides the library directory.
+    Returns None if there is no library set up."""
+
+    conf = json.loads(open(conf_file).read()).get("darks", {})
+
+    if path is None:
+        path = conf.get("library", None)
+
+    if path is None:
+        return None
+
+    hours = 3600
+
+    return DarkLibrary(os.path.expanduser(path), max_age = conf.get("max_age_hours", 4) * hours, evict_age = conf.get("evict_age_hours", 72) * hours,
+                       min_frames = conf.get("min_frames", 50), key_fields = conf.get("key_fields", default_key_fields))
@@ -3,8 +3,18 @@ import numpy as np
 import sys
 import os
 import json
-from PIL import Image
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from .common import printd, printv, color, bcolors
+from .metrics import timed
+from .options import default_io_threads #threads decoding TIFF files in parallel, per MPI rank
+from . import sparse
+
+#Raw frame container: magic, header length (uint64), JSON header, then page aligned uint16 blocks of frames
+raw_container_extension = ".raw"
+raw_container_magic = b"COSMICRW"
+raw_container_alignment = 4096
 
 
 def read_metadata_hdf5(fname):
@@ -22,7 +32,7 @@ def read_metadata(json_file):
     return metadata
 
 
-def read_dark_data(metadata, json_file):
+def read_dark_data(metadata, json_file, n_threads = default_io_threads):
 
 
     dark_frames = None
@@ -35,43 +45,60 @@ def read_dark_data(metadata, json_file):
 
         #by default we could take the full path, but in this case it has an absolute path from PHASIS,
         #which is not good if you move data to other places
-        dark_frames = read_tiffs(base_folder + os.path.basename(os.path.normpath(metadata["dark_dir"])))
+        dark_frames = read_tiffs(base_folder + os.path.basename(os.path.normpath(metadata["dark_dir"])), n_threads = n_threads)
 
 
     return dark_frames
 
 
-def read_tiffs(directory, my_indexes = None):
-    from cosmicp.common import rank
+def list_tiffs(directory):
 
     lst=os.listdir(directory)
     lst.sort()
 
     #We remove from the list anything that is not a tiff
-    lst = [item for item in lst if item.endswith('.tif')]
+    lst = [os.path.join(directory, item) for item in lst if item.endswith('.tif')]
+
+    return lst
+
+
+#Same as read_dark_data, but frames are only decoded when accessed, so the dark frames are never all in memory
+def map_dark_data(metadata, json_file, n_threads = default_io_threads):
+
+    dark_frames = None
+
+    base_folder = os.path.split(json_file)[:-1][0] + "/"
+
+    if "dark_dir" in metadata:
+
+        dark_frames = map_tiffs(base_folder + os.path.basename(os.path.normpath(metadata["dark_dir"])), n_threads)
+
+    return dark_frames
+
+
+def read_tiffs(directory, my_indexes = None, n_threads = default_io_threads):
+    from cosmicp.common import rank
+
+    lst = list_tiffs(directory)
 
     if my_indexes is not None:
         lst = lst[my_indexes]
 
-    frames = []    
+    tiffs = TiffStack(lst, n_threads)
 
-    ii=0
-    n_frames=len(lst)
+    #All files are decoded in parallel into a single contiguous array
+    frames = tiffs.read_batch(0, len(tiffs))
 
-    for fname in lst:       
-        ii+=1
-        im = Image.open(os.path.join(directory, fname))
-        imarray = np.array(im)
-        frames.append(imarray)
-        if rank == 0:
-            sys.stdout.write(color("\r File = %s/%s " %(ii,n_frames), bcolors.HEADER))
-            sys.stdout.flush()
-        
-    if rank == 0: print("\n")
-    return np.array(frames)
+    tiffs.close()
 
+    if rank == 0:
+        sys.stdout.write(color("\r Files = %s " %(len(lst)), bcolors.HEADER))
+        print("\n")
 
-def frames_out(file_name, shape_frames):
+    return frames
+
+
+def frames_out(file_name, shape_frames, dtype = 'float32'):
     import h5py
 
     fid = h5py.File(file_name, 'a')
@@ -82,7 +109,7 @@ def frames_out(file_name, shape_frames):
         fid.create_group('/entry_1/instrument_1/detector_1/')
 
     #out_frames = fid.create_dataset('entry_1/data_1/data', shape_frames , dtype='float32')
-    out_frames = fid.create_dataset('/entry_1/instrument_1/detector_1/data', shape_frames , dtype='float32')
+    out_frames = fid.create_dataset('/entry_1/instrument_1/detector_1/data', shape_frames , dtype=dtype)
     
 
     if "entry_1/instrument_1/detector_1/data" in fid and not "entry_1/data_1/data" in fid:
@@ -93,19 +120,267 @@ def frames_out(file_name, shape_frames):
 
     return out_frames, fid
 
-def map_tiffs(base_folder):
-    import tifffile
-    ## tifs = tifffile.TiffSequence(lst)
-    ##tifs = tifffile.TiffSequence(base_folder)
-    tifs = tifffile.TiffSequence(base_folder+'/*.tif')
-    class MyClass():
-        def __getitem__(self, key):
-            return np.array(tifs.asarray(key))
-        shape=tifs.shape
-
-    myobj = MyClass()
-    
-    return myobj
+def read_cxi_frames(file_name, indexes = None):
+    """Output frames of a cxi file written by cosmicp, dense or in the sparse layout (--sparse_cxi), all of them or those of indexes"""
+
+    with h5py.File(file_name, "r") as fid:
+
+        if sparse.cxi_group in fid:
+            return sparse.read_cxi(fid, indexes)
+
+        if indexes is None:
+            return fid["entry_1/data_1/data"][()]
+
+        return np.array([fid["entry_1/data_1/data"][i] for i in indexes])
+
+def map_tiffs(base_folder, n_threads = default_io_threads):
+
+    return TiffStack(list_tiffs(base_folder), n_threads)
+
+
+class TiffStack():
+    """Stack of TIFF files indexed as an array of frames, frames are only decoded when accessed.
+    read_batch decodes a range of frames on a thread pool into one contiguous array."""
+
+    def __init__(self, files, n_threads = default_io_threads):
+        import tifffile
+
+        self.files = list(files)
+        self.pool = ThreadPoolExecutor(max_workers = max(1, n_threads))
+
+        first_frame = tifffile.imread(self.files[0])
+
+        self.dtype = first_frame.dtype
+        self.shape = (len(self.files),) + first_frame.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        import tifffile
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return self.read_batch(start, stop)
+            return np.array([self[i] for i in range(start, stop, step)])
+
+        return tifffile.imread(self.files[key])
+
+    def read_batch(self, start, stop, out = None):
+        import tifffile
+
+        if out is None:
+            out = np.empty((stop - start,) + self.shape[1:], dtype = self.dtype)
+
+        def decode(i):
+            out[i - start] = tifffile.imread(self.files[i])
+
+        #list() consumes the iterator, so that exceptions in the workers are raised here
+        list(self.pool.map(decode, range(start, stop)))
+
+        return out
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def read_batch(raw_frames, start, stop, out = None):
+    """Reads frames [start, stop) of raw_frames into out, if given, returns the frames as one contiguous array"""
+
+    if hasattr(raw_frames, "read_batch"):
+        return raw_frames.read_batch(start, stop, out)
+
+    if out is None:
+        out = np.empty((stop - start,) + tuple(raw_frames.shape[1:]), dtype = raw_frames.dtype)
+
+    #HDF5 datasets are read with a single call straight into the buffer, instead of one read per frame
+    if isinstance(raw_frames, h5py.Dataset):
+        if stop > start:
+            raw_frames.read_direct(out, source_sel = np.s_[start:stop], dest_sel = np.s_[0:stop - start])
+        return out
+
+    for j in range(start, stop):
+        out[j - start] = raw_frames[j]
+
+    return out
+
+
+def raw_container_name(fname):
+    #Same base name as the scan, so that the results of a reprocessing get the same names as with the original input
+    base = os.path.splitext(fname)[:-1][0][:-5]
+    return base + "_data" + raw_container_extension
+
+
+def write_raw_container(out_fname, metadata, blocks, batch_size = 50):
+    """Writes a memory mappable raw frame container. blocks maps a name to a stack of frames,
+    anything that read_batch can read (arrays, TiffStack, h5py datasets), frames are stored as uint16."""
+
+    header = {"metadata": metadata, "dtype": np.dtype(np.uint16).str, "blocks": {}}
+
+    #We need the header size to place the blocks, so we compute the offsets twice if the header grows past the first guess
+    header_size = raw_container_alignment
+    while True:
+        offset = header_size
+        for name, frames in blocks.items():
+            shape = [int(n) for n in frames.shape]
+            header["blocks"][name] = {"offset": offset, "shape": shape}
+            size = int(np.prod(shape)) * np.dtype(np.uint16).itemsize
+            offset += -(-size // raw_container_alignment) * raw_container_alignment
+
+        header_bytes = json.dumps(header).encode()
+        if len(raw_container_magic) + 8 + len(header_bytes) <= header_size:
+            break
+        header_size += raw_container_alignment
+
+    with open(out_fname, "wb") as f:
+
+        f.write(raw_container_magic)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+
+        for name, frames in blocks.items():
+
+            f.seek(header["blocks"][name]["offset"])
+
+            n_frames = frames.shape[0]
+
+            for i in range(0, n_frames, batch_size):
+                batch = read_batch(frames, i, min(i + batch_size, n_frames))
+                f.write(np.ascontiguousarray(batch, dtype = np.uint16).tobytes())
+
+                printv(color("\r {}: {}/{} frames".format(name, min(i + batch_size, n_frames), n_frames), bcolors.HEADER))
+
+        f.truncate(offset)
+
+
+def pack_raw_container(fname, out_fname = None, n_threads = default_io_threads):
+    """Packs a scan, given by its _info.json file (with the TIFF directories next to it) or a raw_data.h5 file,
+    into a single raw frame container. Returns the container file name."""
+
+    if out_fname is None:
+        out_fname = raw_container_name(fname)
+
+    if fname.endswith('.h5'):
+
+        metadata = read_metadata_hdf5(fname)
+
+        with h5py.File(fname, 'r') as f:
+            write_raw_container(out_fname, metadata, {"dark_frames": f["entry_1/data_1/dark_frames"],
+                                                      "exp_frames": f["entry_1/data_1/exp_frames"]})
+
+    else:
+
+        metadata = read_metadata(fname)
+
+        #TIFF directories are next to the json file, the paths in the metadata are absolute paths from the acquisition
+        base_folder = os.path.dirname(os.path.abspath(fname))
+
+        dark_frames = TiffStack(list_tiffs(os.path.join(base_folder, os.path.basename(os.path.normpath(metadata["dark_dir"])))), n_threads)
+        exp_frames = TiffStack(list_tiffs(os.path.join(base_folder, os.path.basename(os.path.normpath(metadata["exp_dir"])))), n_threads)
+
+        write_raw_container(out_fname, metadata, {"dark_frames": dark_frames, "exp_frames": exp_frames})
+
+        dark_frames.close()
+        exp_frames.close()
+
+    return out_fname
+
+
+def read_raw_container_header(fname):
+
+    with open(fname, "rb") as f:
+
+        if f.read(len(raw_container_magic)) != raw_container_magic:
+            raise Exception(color("\n{} is not a raw frame container\n".format(fname), bcolors.FAIL))
+
+        header_size = int(np.frombuffer(f.read(8), dtype = np.uint64)[0])
+
+        return json.loads(f.read(header_size))
+
+
+def map_raw_container(fname):
+    """Returns the metadata, the dark frames and the exposure frames of a raw frame container.
+    Frames are read-only np.memmap arrays, nothing is read from disk until they are accessed."""
+
+    header = read_raw_container_header(fname)
+
+    frames = {}
+    for name, block in header["blocks"].items():
+        frames[name] = np.memmap(fname, dtype = header["dtype"], mode = "r", offset = block["offset"], shape = tuple(block["shape"]))
+
+    return header["metadata"], frames["dark_frames"], frames["exp_frames"]
+
+
+def chunk_aligned_batch_size(raw_frames, local_batch_size, multiple_of = 1):
+    """Rounds local_batch_size up so that batches start and end on chunk boundaries of a chunked HDF5 dataset,
+    this way every chunk is read and decompressed only once, by a single rank. The result is also a multiple of multiple_of."""
+
+    chunks = getattr(raw_frames, "chunks", None)
+
+    if not isinstance(raw_frames, h5py.Dataset) or chunks is None:
+        return local_batch_size
+
+    step = np.lcm(chunks[0], multiple_of)
+
+    return int(-(-local_batch_size // step) * step)
+
+
+def prefetch_batches(raw_frames, batch_ranges, batch_size, n_buffers = 2):
+    """Generator yielding the frames of each (start, stop) range in batch_ranges as a (batch_size, ...) array.
+    The next batches are read on a background thread while the current one is being processed (double buffering by default).
+    A yielded array is reused to read later batches once the next one is requested, rows beyond stop - start are left undefined."""
+
+    #Frames in memory, or memory mapped, are handed over as views, without copies
+    if isinstance(raw_frames, np.ndarray):
+        yield from array_batches(raw_frames, batch_ranges, batch_size)
+        return
+
+    frame_shape = tuple(raw_frames.shape[1:])
+
+    buffers = queue.Queue()
+    for i in range(0, n_buffers):
+        buffers.put(np.empty((batch_size,) + frame_shape, dtype = raw_frames.dtype))
+
+    batches = queue.Queue()
+
+    def reader():
+        try:
+            for start, stop in batch_ranges:
+                buffer = buffers.get()
+                with timed("disk_read"):
+                    read_batch(raw_frames, start, stop, buffer[:stop - start])
+                batches.put(buffer)
+        except Exception as e:
+            batches.put(e)
+
+    th = threading.Thread(target = reader, daemon = True)
+    th.start()
+
+    for i in range(0, len(batch_ranges)):
+
+        batch = batches.get()
+
+        if isinstance(batch, Exception):
+            raise batch
+
+        yield batch
+
+        buffers.put(batch)
+
+def array_batches(raw_frames, batch_ranges, batch_size):
+
+    for start, stop in batch_ranges:
+
+        if start + batch_size <= raw_frames.shape[0]:
+            yield raw_frames[start:start + batch_size]
+
+        #A batch running past the last frame is the only one we copy, so that all batches have the same shape
+        else:
+            batch = np.zeros((batch_size,) + tuple(raw_frames.shape[1:]), dtype = raw_frames.dtype)
+            batch[:stop - start] = raw_frames[start:stop]
+            yield batch
+
 
 class IO:
 
@@ -169,6 +444,9 @@ class IO:
                 #This is relevant only with raw un-preprocessed data
                 "n_exposures": [groups["detector"] + "number_exposures"],
 
+                #ADUs per photon, present when the data are stored as photon counts
+                "photon_scale": [groups["detector"] + "photon_scale"],
+
                 #This is needed in SHARP although it is not used
                 "corner_position": [groups["detector"] + "corner_position"]
 
@@ -216,7 +494,7 @@ class IO:
                 try:
                     group = data_format[key][0]
                 except KeyError:
-                    group = key + "/"
+                    group = key #at the root, HDF5 2 rejects names ending with "/"
 
                 if value is not None:
                     f.create_dataset(group, data = value)
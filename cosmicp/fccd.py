@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import numpy as npo
 import jax.numpy as np
 from jax.experimental import loops
 import jax
@@ -29,8 +30,8 @@ nrows = 520
 gap = 34
 nrows1=nrows-gap # good rows
 
-# coordinates in the clean image
-xx=np.linspace(-1,1,2*ngcols)
+# coordinates in the clean image, constants are numpy arrays so that importing this module does not initialize the XLA backend
+xx=npo.linspace(-1,1,2*ngcols)
 
 @jax.jit
 def clockXblocks1(data):
@@ -70,8 +71,8 @@ def combine(data0, data1, t12, thres=3e3):
 ######################3
 # denoise bblocks
 bpts=60//2
-gg=np.exp(-(np.arange(-bpts//2,bpts//2)/(bpts/4))**2)
-gg/=np.sum(gg)
+gg=npo.exp(-(npo.arange(-bpts//2,bpts//2)/(bpts/4))**2)
+gg/=npo.sum(gg)
 #gg=np.reshape(gg,(bpts,1))
 
 @jax.jit
@@ -0,0 +1,330 @@
+"""
+    Lightweight per-rank counters and timing histograms of the preprocessing stages.
+
+    Metrics can be exported as Prometheus text through a small HTTP endpoint (one port per rank),
+    or written periodically into a JSON stats file, and summarized by rank 0 at the end of each scan.
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from . import trace
+from .common import rank, size, comm, printv, color, bcolors
+
+prefix = "cosmicp_"
+
+#Upper bounds (seconds) of the timing histogram buckets, from 10us to ~80s
+time_buckets = [1e-5 * 2**k for k in range(0, 24)]
+
+lock = threading.Lock()
+counters = {}
+histograms = {}
+gauges = {}
+
+
+class Counter:
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, n = 1):
+        with lock:
+            self.value += n
+
+
+class Gauge:
+    """Current value of a level, e.g. the frames held in a buffer, and the highest value it reached"""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.max = 0
+
+    def set(self, value):
+        with lock:
+            self.value = value
+            self.max = max(self.max, value)
+
+
+class Histogram:
+
+    def __init__(self, name, description, buckets = time_buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) #the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+
+        with lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+            self.max = max(self.max, value)
+
+    def state(self):
+        return {"counts": list(self.counts), "sum": self.sum, "count": self.count, "max": self.max}
+
+
+def counter(name, description = ""):
+
+    if name not in counters:
+        with lock:
+            counters.setdefault(name, Counter(name, description))
+
+    return counters[name]
+
+
+def gauge(name, description = ""):
+
+    if name not in gauges:
+        with lock:
+            gauges.setdefault(name, Gauge(name, description))
+
+    return gauges[name]
+
+
+def histogram(name, description = ""):
+
+    if name not in histograms:
+        with lock:
+            histograms.setdefault(name, Histogram(name, description))
+
+    return histograms[name]
+
+
+@contextmanager
+def timed(stage):
+    """Times the enclosed block into the <stage>_seconds histogram, and into the trace if enabled"""
+
+    #Wall clock times, so that traces of different ranks line up
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        histogram(stage + "_seconds", "Time spent in " + stage.replace("_", " ")).observe(end - start)
+        trace.complete(stage, start, end)
+
+
+#Latencies between the timestamps of an output frame, (name, from, to)
+frame_latencies = [("grabber_to_receive", "acquisition", "receive"),
+                   ("queue", "receive", "compute_start"),
+                   ("frame_compute", "compute_start", "compute_end"),
+                   ("output_wait", "compute_end", "send"),
+                   ("receive_to_send", "receive", "send"),
+                   ("acquisition_to_send", "acquisition", "send")]
+
+
+def observe_frame_latencies(frame_times):
+    """Records the latencies of an output frame given its timestamps, missing timestamps are skipped"""
+
+    for name, t_from, t_to in frame_latencies:
+        if frame_times.get(t_from) is not None and frame_times.get(t_to) is not None:
+            histogram("latency_" + name + "_seconds", "Latency of output frames, " + t_from + " to " + t_to).observe(frame_times[t_to] - frame_times[t_from])
+
+
+def quantile(state, q, buckets = time_buckets):
+    """Estimates the q quantile of a histogram state, interpolating linearly inside the bucket"""
+
+    if state["count"] == 0:
+        return 0.0
+
+    target = q * state["count"]
+    cumulative = 0
+
+    for i, n in enumerate(state["counts"]):
+
+        if n > 0 and cumulative + n >= target:
+            low = buckets[i - 1] if i > 0 else 0.0
+            high = buckets[i] if i < len(buckets) else state["max"]
+            return min(low + (high - low) * (target - cumulative) / n, state["max"])
+
+        cumulative += n
+
+    return state["max"]
+
+
+def snapshot():
+    """Current state of all metrics of this rank, as plain python types"""
+
+    with lock:
+        return {"rank": rank,
+                "time": time.time(),
+                "counters": {name: c.value for name, c in counters.items()},
+                "gauges": {name: {"value": g.value, "max": g.max} for name, g in gauges.items()},
+                "histograms": {name: h.state() for name, h in histograms.items()}}
+
+
+def difference(current, previous):
+    """Metrics accumulated between two snapshots"""
+
+    #Gauges are levels, not accumulated
+    diff = {"rank": current["rank"], "time": current["time"], "counters": {}, "gauges": current["gauges"], "histograms": {}}
+
+    for name, value in current["counters"].items():
+        diff["counters"][name] = value - previous["counters"].get(name, 0)
+
+    for name, state in current["histograms"].items():
+
+        prev = previous["histograms"].get(name, {"counts": [0] * len(state["counts"]), "sum": 0.0, "count": 0})
+
+        diff["histograms"][name] = {"counts": [a - b for a, b in zip(state["counts"], prev["counts"])],
+                                    "sum": state["sum"] - prev["sum"],
+                                    "count": state["count"] - prev["count"],
+                                    "max": state["max"]}
+
+    return diff
+
+
+def prometheus_text():
+
+    state = snapshot()
+    lines = []
+
+    for name, value in sorted(state["counters"].items()):
+        lines.append("# HELP {}{}_total {}".format(prefix, name, counters[name].description))
+        lines.append("# TYPE {}{}_total counter".format(prefix, name))
+        lines.append('{}{}_total{{rank="{}"}} {}'.format(prefix, name, rank, value))
+
+    for name, g in sorted(state["gauges"].items()):
+        lines.append("# HELP {}{} {}".format(prefix, name, gauges[name].description))
+        lines.append("# TYPE {}{} gauge".format(prefix, name))
+        lines.append('{}{}{{rank="{}"}} {}'.format(prefix, name, rank, g["value"]))
+        lines.append("# HELP {}{}_max Highest value of {}".format(prefix, name, name))
+        lines.append("# TYPE {}{}_max gauge".format(prefix, name))
+        lines.append('{}{}_max{{rank="{}"}} {}'.format(prefix, name, rank, g["max"]))
+
+    for name, h in sorted(state["histograms"].items()):
+        lines.append("# HELP {}{} {}".format(prefix, name, histograms[name].description))
+        lines.append("# TYPE {}{} histogram".format(prefix, name))
+
+        cumulative = 0
+        for le, n in zip(time_buckets + ["+Inf"], h["counts"]):
+            cumulative += n
+            lines.append('{}{}_bucket{{rank="{}",le="{}"}} {}'.format(prefix, name, rank, le, cumulative))
+
+        lines.append('{}{}_sum{{rank="{}"}} {}'.format(prefix, name, rank, h["sum"]))
+        lines.append('{}{}_count{{rank="{}"}} {}'.format(prefix, name, rank, h["count"]))
+
+    return "\n".join(lines) + "\n"
+
+
+def start_http_server(port, host = ""):
+    """Serves the metrics of this rank as Prometheus text at http://host:(port + rank)/metrics, on all interfaces if host is empty"""
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port + rank), Handler)
+
+    th = threading.Thread(target = server.serve_forever, daemon = True)
+    th.start()
+
+    return server
+
+
+def start_stats_file(fname, period = 5.0):
+    """Writes the metrics of this rank every period seconds into fname, with the rank number appended to the file name"""
+
+    base, ext = os.path.splitext(fname)
+    rank_fname = "{}_rank{}{}".format(base, rank, ext or ".json")
+
+    def writer():
+        while True:
+            tmp_fname = rank_fname + ".tmp"
+            with open(tmp_fname, "w") as f:
+                json.dump(snapshot(), f)
+            os.replace(tmp_fname, rank_fname)
+            time.sleep(period)
+
+    th = threading.Thread(target = writer, daemon = True)
+    th.start()
+
+    return th
+
+
+def print_summary(start_snapshot, title = "Stage timings"):
+    """Gathers the metrics accumulated since start_snapshot on all ranks, rank 0 prints a table per stage and returns it as a dict"""
+
+    local = difference(snapshot(), start_snapshot)
+
+    all_ranks = comm.gather(local) if comm is not None and size > 1 else [local]
+
+    if rank != 0:
+        return None
+
+    summary = {"stages": {}, "counters": {}, "gauges": {}}
+
+    printv(color("\n {} ({} ranks):".format(title, len(all_ranks)), bcolors.OKGREEN))
+    printv(color(" {:<30}{:>10}{:>12}{:>12}{:>12}{:>12}{:>14}".format("stage", "count", "total (s)", "mean (ms)", "p50 (ms)", "p99 (ms)", "slowest rank"), bcolors.HEADER))
+
+    names = sorted(set(name for r in all_ranks for name in r["histograms"]))
+
+    for name in names:
+
+        states = [r["histograms"].get(name) for r in all_ranks]
+        states = [s for s in states if s is not None]
+
+        merged = {"counts": [sum(c) for c in zip(*[s["counts"] for s in states])],
+                  "sum": sum(s["sum"] for s in states),
+                  "count": sum(s["count"] for s in states),
+                  "max": max(s["max"] for s in states)}
+
+        if merged["count"] == 0:
+            continue
+
+        slowest = max(all_ranks, key = lambda r: r["histograms"].get(name, {"sum": 0})["sum"])["rank"]
+
+        summary["stages"][name.replace("_seconds", "")] = {"count": merged["count"], "total_s": merged["sum"], "p50_s": quantile(merged, 0.5),
+                                                           "p99_s": quantile(merged, 0.99), "slowest_rank": slowest}
+
+        printv(" {:<30}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}{:>14}".format(name.replace("_seconds", ""), merged["count"], merged["sum"],
+               1000 * merged["sum"] / merged["count"], 1000 * quantile(merged, 0.5), 1000 * quantile(merged, 0.99), slowest))
+
+    totals = {}
+    for r in all_ranks:
+        for name, value in r["counters"].items():
+            totals[name] = totals.get(name, 0) + value
+
+    for name, value in sorted(totals.items()):
+        printv(" {:<30}{:>10}".format(name, value))
+
+    for r in all_ranks:
+        for name, g in r.get("gauges", {}).items():
+            total = summary["gauges"].setdefault(name, {"value": 0, "max": 0})
+            summary["gauges"][name] = {"value": total["value"] + g["value"], "max": max(total["max"], g["max"])}
+
+    for name, g in sorted(summary["gauges"].items()):
+        printv(" {:<30}{:>10}  (max {})".format(name, g["value"], g["max"]))
+
+    printv("")
+
+    summary["counters"] = totals
+
+    return summary
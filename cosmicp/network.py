@@ -0,0 +1,401 @@
+"""
+    ZMQ sockets of the streaming mode and the scan metadata messages, with no JAX dependency,
+    so that ranks set up their sockets while JAX is still to be imported.
+"""
+
+import json
+import time
+import zlib
+import threading
+import numpy as np
+import msgpack
+import msgpack_numpy
+import zmq
+
+from .common import printd, printv, color, bcolors, endpoint
+from .metrics import counter, gauge, histogram
+from . import shm
+from .sparse import sparse_to_dense
+
+
+def subscribe_to_socket(network_metadata):
+
+    addr = endpoint(network_metadata["input_address"])
+
+    socket = network_metadata["context"].socket(zmq.SUB)
+    socket.setsockopt(zmq.SUBSCRIBE, b'')
+    socket.setsockopt(zmq.LINGER, -1)
+    socket.set_hwm(2000)
+    socket.connect(addr)
+
+    return socket
+
+def publish_to_socket(network_metadata):
+
+    addr = endpoint(network_metadata["intermediate_address"])
+
+    socket = network_metadata["context"].socket(zmq.PUB)
+    socket.setsockopt(zmq.SNDHWM, 0)
+    socket.setsockopt(zmq.LINGER, -1)
+    socket.set_hwm(2000)
+    socket.connect(addr)
+
+    return socket
+
+def xsub_xpub_router(network_metadata):
+
+    printv(color("\r Setting up XSUB XPUB router, this will cast a thread running with the proxy router...", bcolors.HEADER))
+
+    frontend_socket = network_metadata["context"].socket(zmq.XPUB)
+
+    frontend_socket.setsockopt(zmq.SNDHWM, 0)
+    frontend_socket.setsockopt(zmq.LINGER, -1)
+
+    frontend_socket.bind(endpoint(network_metadata["output_address"]))
+
+    backend_socket = network_metadata["context"].socket(zmq.XSUB)
+
+    backend_socket.setsockopt(zmq.LINGER, -1)
+
+    backend_socket.bind(endpoint(network_metadata["intermediate_address"]))
+
+    if network_metadata.get("ordered_output", 0) > 0:
+        th = threading.Thread(target=ordered_proxy, args = (frontend_socket, backend_socket, network_metadata["ordered_output"], network_metadata["ordered_timeout"]))
+    else:
+        th = threading.Thread(target=zmq.proxy, args = (frontend_socket, backend_socket))
+    th.start()
+
+    #zmq.proxy(frontend_socket, backend_socket)
+
+    return th
+
+
+#Index of an output frame message, without unpacking the frame
+def frame_index(msg):
+
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(msg)
+    unpacker.read_array_header()
+
+    return int(unpacker.unpack())
+
+#With the ordered router, the output messages of the ranks are prefixed with the id of their scan ("scan_id" of the metadata),
+#as the ranks can send the first frames of a scan before rank 0 sends its metadata. The router removes the prefix,
+#consumers get the same messages with or without the ordered router.
+scan_tag = b"scan"
+
+def tag_scan(msg, scan_id):
+    return b"%s%d:" % (scan_tag, scan_id) + msg
+
+def untag_scan(msg):
+    """Scan id of a message (None if it is not tagged) and the message without the tag"""
+
+    if msg[:len(scan_tag)] != scan_tag:
+        return None, msg
+
+    end = msg.index(b":", len(scan_tag))
+
+    return int(msg[len(scan_tag):end]), msg[end + 1:]
+
+def ordered_proxy(frontend_socket, backend_socket, window_size, timeout, poll_period = 0.1):
+    """zmq.proxy sending the output frames of each scan in index order, after the scan metadata.
+
+    Frames received ahead of the next index are held, up to window_size of them. The next index is skipped when the window is full,
+    or when it is missing for timeout seconds (e.g. a frame lost in the input). Frames received after their index was skipped are dropped.
+    Frames of a scan sent before its metadata (see tag_scan) are held apart until it arrives. The frames of the previous scan
+    still held then are sent, its missing frames skipped, and its frames arriving later dropped. Untagged frames belong to the scan being sent."""
+
+    poller = zmq.Poller()
+    poller.register(frontend_socket, zmq.POLLIN)
+    poller.register(backend_socket, zmq.POLLIN)
+
+    announced = False #the metadata of a scan arrived
+    scan = None #id of the scan being sent
+    window = {} #frame index -> message, of the scan being sent
+    early = {} #scan id -> {frame index -> message}, of the scans whose metadata didn't arrive yet
+    next_index = 0
+    n_frames = 0 #of the scan being sent
+    stall_start = None #time the window started waiting for next_index
+
+    occupancy = gauge("ordered_window_frames", "Output frames held by the ordered router")
+    skipped = counter("ordered_skipped", "Output frame indexes the ordered router stopped waiting for")
+    late = counter("ordered_late", "Output frames dropped by the ordered router, received after their index was skipped or their scan ended")
+
+    while True:
+
+        events = dict(poller.poll(int(poll_period * 1000)))
+
+        #Subscriptions of the consumers
+        if frontend_socket in events:
+            backend_socket.send(frontend_socket.recv())
+
+        if backend_socket in events:
+
+            msg = backend_socket.recv()
+
+            #Previews are not held
+            if is_preview(msg):
+                frontend_socket.send(msg)
+
+            elif is_control_message(msg):
+
+                #The frames of the previous scan still held are sent, the missing ones skipped
+                if announced:
+                    held = sorted(i for i in window if next_index <= i < n_frames)
+                    skipped.inc(max(n_frames - next_index - len(held), 0))
+
+                    for index in held:
+                        frontend_socket.send(window[index])
+
+                frontend_socket.send(msg)
+
+                metadata = json.loads(msg)
+
+                announced = True
+                scan = metadata.get("scan_id")
+                n_frames = len(metadata.get("translations", []))
+                next_index = 0
+                stall_start = None
+
+                window = {**early.pop(None, {}), **early.pop(scan, {})}
+
+                #Frames of scans before this one that were never announced
+                for scan_id in [s for s in early if scan is not None and s < scan]:
+                    late.inc(len(early.pop(scan_id)))
+
+            else:
+                scan_id, msg = untag_scan(msg)
+                scan_id = scan if scan_id is None else scan_id
+
+                index = frame_index(msg)
+
+                if announced and scan_id == scan:
+                    if index < next_index:
+                        late.inc()
+                    else:
+                        window[index] = msg
+
+                elif announced and scan is not None and scan_id < scan:
+                    late.inc()
+
+                else:
+                    early.setdefault(scan_id, {})[index] = msg
+
+        occupancy.set(len(window) + sum(len(frames) for frames in early.values()))
+
+        if not announced:
+            continue
+
+        #Gives up on the next index
+        if window and (len(window) > window_size or (stall_start is not None and time.time() - stall_start > timeout)):
+
+            first = min(window)
+            skipped.inc(first - next_index)
+            next_index = first
+
+        first = next_index
+
+        while next_index in window:
+            frontend_socket.send(window.pop(next_index))
+            next_index += 1
+
+        occupancy.set(len(window) + sum(len(frames) for frames in early.values()))
+
+        #All the frames of the scan are sent, the next ones belong to the next scan
+        done = next_index >= n_frames
+
+        if stall_start is not None and (next_index != first or done):
+            histogram("ordered_stall_seconds", "Time the ordered router waited for a missing output frame").observe(time.time() - stall_start)
+            stall_start = None
+
+        if stall_start is None and window and not done:
+            stall_start = time.time()
+
+
+#Output frames are sent frames_per_message at a time, as one block with the vector of their indexes. As output frames are mostly zeros,
+#the block can be sparse (see sparse.py) and compressed, or left in a shared memory ring for consumers on the same host.
+#The format is announced in the "output_format" entry of the metadata sent to the output.
+compressions = ["none", "zlib", "lz4"]
+
+def default_output_format():
+    return {"frames_per_message": 1, "compression": "none", "shared_memory": False, "sparse": False}
+
+#Messages of a single frame, as (index, frame) or (index, frame, timestamps)
+def frame_messages(output_format):
+    return output_format is None or (output_format["frames_per_message"] == 1 and output_format["compression"] == "none"
+                                     and not output_format.get("shared_memory", False) and not output_format.get("sparse", False))
+
+def compression_available(compression):
+
+    if compression == "lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            return False
+
+    return compression in compressions
+
+def compress(data, compression):
+
+    if compression == "zlib":
+        return zlib.compress(data, 1)
+
+    import lz4.frame
+    return lz4.frame.compress(data)
+
+def decompress(data, compression):
+
+    if compression == "zlib":
+        return zlib.decompress(data)
+
+    import lz4.frame
+    return lz4.frame.decompress(data)
+
+#The bytes of the frame values are grouped by significance before compression, the high bytes being mostly equal
+def byte_shuffle(block):
+    return np.ascontiguousarray(block.reshape(-1).view(np.uint8).reshape(-1, block.itemsize).T).tobytes()
+
+def byte_unshuffle(data, dtype, shape):
+    dtype = np.dtype(dtype)
+    return np.frombuffer(data, np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+#An array as it is, or compressed as {"dtype", "shape", "compression", "data"} with the byte shuffled data
+def encode_array(array, compression):
+
+    if compression == "none":
+        return array
+
+    return {"dtype": array.dtype.str, "shape": list(array.shape), "compression": compression, "data": compress(byte_shuffle(array), compression)}
+
+def decode_array(encoded):
+
+    if isinstance(encoded, dict):
+        return byte_unshuffle(decompress(encoded["data"], encoded["compression"]), encoded["dtype"], encoded["shape"])
+
+    return np.asarray(encoded)
+
+def pack_output(indexes, frames, output_format, times = None, ring = None, scan_id = None):
+    """Output message of frames (a numpy array, or a sparse block with a sparse output format) with the given indexes.
+
+    With the default output format, messages are (index, frame), or (index, frame, timestamps), one per frame. Otherwise they
+    are (first index, indexes, block) or (first index, indexes, block, [timestamps]), the block being an array, or if compressed
+    {"dtype", "shape", "compression", "data"} with the byte shuffled data, or a sparse block with its indices and values encoded
+    the same way, or with shared memory the descriptor of the ring slot {"shm", "slot", "sequence", "offset", "dtype", "shape"}
+    the frames were copied to. With a scan_id, for the ordered router, the message is tagged with it (see tag_scan)."""
+
+    if frame_messages(output_format):
+
+        content = (b'%d' % indexes[0], frames[0]) if times is None else (b'%d' % indexes[0], frames[0], times[0])
+
+    else:
+        if output_format.get("shared_memory", False):
+            block = ring.write(frames)
+
+        elif isinstance(frames, dict):
+            block = {**frames, "indices": encode_array(frames["indices"], output_format["compression"]),
+                     "values": encode_array(frames["values"], output_format["compression"])}
+
+        else:
+            block = encode_array(frames, output_format["compression"])
+
+        content = (b'%d' % indexes[0], np.asarray(indexes, dtype = np.int32), block)
+
+        if times is not None:
+            content += (list(times),)
+
+    msg = msgpack.packb(content, default = msgpack_numpy.encode, use_bin_type = True)
+
+    return msg if scan_id is None else tag_scan(msg, scan_id)
+
+def unpack_output(msg, output_format = None):
+    """Indexes, frames and timestamps (None if not sent) of an output message, given the "output_format" of the scan metadata.
+    Frames are None when their shared memory slot was written again before they were read."""
+
+    content = msgpack.unpackb(msg, object_hook = msgpack_numpy.decode, raw = False)
+
+    if frame_messages(output_format):
+        return [int(content[0])], np.asarray(content[1])[np.newaxis], [content[2]] if len(content) > 2 else None
+
+    block = content[2]
+
+    if isinstance(block, dict) and "shm" in block:
+        block = shm.read(block)
+
+    elif isinstance(block, dict) and "sparse" in block:
+        block = sparse_to_dense({**block, "indices": decode_array(block["indices"]), "values": decode_array(block["values"])})
+
+    else:
+        block = decode_array(block)
+
+    return [int(i) for i in content[1]], block, content[3] if len(content) > 3 else None
+
+
+#Previews of the output frames are published with the frames under this topic, so that monitoring GUIs subscribe to them only.
+#Consumers of the whole stream skip them (see is_preview) when the preview is on ("preview" entry of the metadata)
+preview_topic = b"preview"
+
+def is_preview(msg):
+    return msg[:len(preview_topic)] == preview_topic
+
+def pack_preview(indexes, previews, stats):
+    """Preview message, the topic followed by {"indexes", "previews": uint8 array, "stats": {name: [value of each frame]}}"""
+
+    return preview_topic + msgpack.packb({"indexes": indexes, "previews": previews, "stats": stats}, default = msgpack_numpy.encode, use_bin_type = True)
+
+def unpack_preview(msg):
+    """Indexes, previews and statistics of a preview message"""
+
+    content = msgpack.unpackb(msg[len(preview_topic):], object_hook = msgpack_numpy.decode, raw = False)
+
+    return content["indexes"], content["previews"], content["stats"]
+
+
+#Control messages go through the input socket with the frames. They are JSON objects, as the metadata, and frames are msgpack arrays
+end_of_scan = "end_of_scan"
+
+def is_control_message(msg):
+    return msg[:1] == b'{'
+
+#Sent by the framegrabber after the last frame of a scan, n_frames being the number of exposure frames it sent
+def send_end_of_scan(socket, n_frames = None):
+    socket.send_string(json.dumps({"event": end_of_scan, "n_frames": n_frames}))
+
+
+def receive_metadata(network_metadata):
+
+    printv(color("\r Waiting for metadata...", bcolors.HEADER))
+
+    #The previous scan ended when this metadata arrived, before its end of scan message
+    if "pending_metadata" in network_metadata:
+        metadata = network_metadata.pop("pending_metadata")
+
+    else:
+        metadata = None
+
+        #Frames and end of scan messages of a previous scan that ended on a timeout are skipped
+        while metadata is None or metadata.get("event") == end_of_scan:
+            msg = network_metadata["input_socket"].recv()  # blocking
+
+            if is_control_message(msg):
+                metadata = json.loads(msg)
+
+    printv(color("\r Metadata received", bcolors.HEADER))
+
+    return metadata
+
+def send_metadata(network_metadata, metadata):
+
+    printd(color("\r Sending metadata to socket...", bcolors.HEADER))
+
+    #We remove ndarrays here so that we can serialize all the metadata.
+    metadata_plain = metadata.copy()
+
+    metadata_plain["translations"] = metadata_plain["translations"].tolist()
+    metadata_plain["center_of_mass"] = metadata_plain["center_of_mass"].tolist()
+    metadata_plain["output_format"] = network_metadata.get("output_format", default_output_format())
+    metadata_plain["preview"] = network_metadata.get("preview")
+    metadata_plain["scan_id"] = network_metadata.get("scan_id")
+
+    network_metadata["intermediate_socket"].send_string(json.dumps(metadata_plain))
+
+    printd(color("\r Metadata sent", bcolors.HEADER))
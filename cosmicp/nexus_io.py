@@ -57,6 +57,7 @@ nexus_metadata = {
 cosmic_metadata = {
     "illumination": "entry/probe",
     "illumination_mask": "entry/probe_mask",
+    "photon_scale": nexus_groups["detector"] + "photon_scale",
 }
 
 def read(file_name, data_format = None, data_indexes = ()):
@@ -93,7 +94,7 @@ def write(file_name, data_dictionary, data_format = None):
             try:
                 group = data_format[key]
             except KeyError:
-                group = key + "/"
+                group = key #at the root, HDF5 2 rejects names ending with "/"
             if value is not None:
                 f.create_dataset(group, data = value)
 
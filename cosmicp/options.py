@@ -1,48 +1,142 @@
 #!/usr/bin/env python
 
 import sys, getopt, os
-from cosmicp.common import printv, color, bcolors
+from cosmicp.common import printv, color, bcolors, log_levels
+from cosmicp.profiling import default_profile_dir
 
 default_conf = os.path.join(os.path.expanduser('~')) + "/cosmicp_config/default.json" #This default.json is written there during installation
 default_output_address = "127.0.0.1:50008"
 default_intermediate_address = "127.0.0.1:50021" 
-
-help =   "\nUsage: cosmicp.py [options] input.json\n\n\
+default_io_threads = 4 #threads decoding TIFF files in parallel, per MPI rank
+default_metrics_period = 5.0
+default_log_period = 5.0
+default_server_address = "127.0.0.1:50030"
+default_pending_saves = 1
+default_frame_timeout = 10.0
+default_flush_period = 0.2
+default_max_reorder = 64
+default_ordered_output = 0
+default_frames_per_message = 1
+default_compression = "none"
+default_shm_ring = 0
+default_preview_width = 64
+
+help =   "\nUsage: cosmicp.py [options] input.json\n       cosmicp.py [options] --server ADDRESS\n\n\
 \t -g   -> Perform a GPU execution, off by default.\n\
 \t -c F -> Using a configuration file F. If not given, the default configuration is pulled from {}.\n\
 \t -b N -> Set local batch size = N, per MPI rank. N = 20 by default.\n\
+\t -t N -> Use N threads per MPI rank to decode TIFF files when reading from disk. N = {} by default.\n\
 \t -m M -> Output mode. Supports M = 'disk','socket' and 'disksocket'. 'disk' (default) saves the final results into disk, \n\
 \t\t\t'socket' streams the data into a xpub zmq socket, and 'disksocket' does the same but also stores the final results into disk at the end.\n\
+\t -D DIR -> Use DIR as a library of averaged dark frames, shared between scans with the same dwell times and detector settings.\n\
+\t\t\tScans with few or no dark frames reuse fresh library entries, see the 'darks' section of the configuration file. Off by default.\n\
+\t -v L -> Log level L, one of 'error', 'warning', 'info' (default), 'debug' and 'frame'. Per frame messages are only written at 'frame',\n\
+\t\t\tthe other levels report the frames received, processed and sent every --log_period seconds ({} by default).\n\
+\t -F   -> Fast start: process the exposure frames as soon as the dark frames are averaged, with the center of the last scan with the same geometry,\n\
+\t\t\tor the center of the detector. The center is refined from the first output frames of all ranks, and the frames processed before\n\
+\t\t\tare processed again if it changed. In streaming mode these frames are held until the center is refined, so that each output frame\n\
+\t\t\tis sent once, with the refined center (their previews are not held). Off by default.\n\
+\t --sparse_cxi -> Save the output frames in the cxi file as sparse frames in entry_1/data_1/sparse (counts, indptr, indices, values) instead of\n\
+\t\t\tentry_1/data_1/data, diskIO.read_cxi_frames reads both layouts. Off by default.\n\
+\t --accumulate A -> Scans repeating each position ('repetition' in the 'scan' section of the configuration file) give one output frame per position,\n\
+\t\t\tthe clean exposures of a position being summed (A = 'sum') or averaged (A = 'mean'), with one translation per position. Off by default.\n\
+\t -p   -> Output estimated photon counts as uint16 (uint8 when the range allows) instead of float32 frames, off by default.\n\
+\t\t\tCounts use the 'adu_per_ev' and 'adu_offset' calibration from the configuration file, the scale is recorded as 'photon_scale'.\n\
 ------------------------------------------------------------------------------\n\
 Streaming analysis options:\n\
 \t -o ADDRESS -> Set ADDRESS as 'IP:PORT' corresponding to the address in an XSUB/XPUB router publishes all data from all MPI ranks.\n\
 \t\t\tDefaults to {}\n\
 \t -i ADDRESS -> Set ADDRESS as 'IP:PORT' corresponding to the intermediate address in which each MPI rank publishes their results.\n\
 \t\t\tDefaults to {}\n\
+\t\t\tBoth addresses can also be zmq endpoints, 'ipc://PATH' skips the TCP stack when the ranks and consumers run on the same node,\n\
+\t\t\tand 'inproc://NAME' (-i only, with a single MPI rank) keeps the frames in the process up to the router.\n\
+\t --ordered_output N -> The router sends the output frames in index order, holding up to N frames received ahead of a missing one. An index still missing\n\
+\t\t\twhen the window is full, or after --frame_timeout seconds, is skipped. N = {} (by default) sends the frames in the order the ranks send them.\n\
+\t --frames_per_message N -> Send the output frames N at a time, as one block with their indexes, one message per frame by default.\n\
+\t --compression C -> Compress the output messages with C = 'zlib' or 'lz4' (if installed), after shuffling the bytes of the frame values. '{}' by default.\n\
+\t\t\tThe output format is announced in the 'output_format' entry of the metadata, see network.unpack_output to read the messages.\n\
+\t --sparse -> Send the output frames as sparse blocks, the number of nonzero pixels of each frame with their indexes and values (CSR),\n\
+\t\t\tencoded on the backend. Combines with --frames_per_message and --compression. Off by default.\n\
+\t --shm_ring N -> For consumers on the same host, each rank copies its output messages into a ring of N slots in shared memory, and sends\n\
+\t\t\tdescriptors of the slots instead of the frames (not compressed). Slots are reused without waiting for the consumers. Off by default.\n\
+\t --preview N -> Publish with the output frames a preview of every N-th output frame, downsampled to --preview_width W pixels ({} by default)\n\
+\t\t\tand log scaled into uint8, with its total counts, maximum, center of mass drift and fraction of saturated pixels. Previews are computed\n\
+\t\t\tby the batch kernels and published under the 'preview' topic, see network.unpack_preview. Off by default.\n\
 \t -L -> Keep running and waiting for incoming scans. Only works with an streaming reconstruction. Off by default.\n\
-\n\n".format(default_conf, default_output_address, default_intermediate_address)
+\t --frame_timeout S -> End a scan after S seconds without input messages ({} by default), if its end of scan message or last frames are lost.\n\
+\t\t\tFrames with missing exposures are saved as zeros, flagged in entry_1/data_1/missing_frames of the cxi file.\n\
+\t --flush_period S -> Process a partial batch of frames once its first frame waited S seconds ({} by default), this bounds the latency of the last frames.\n\
+\t --max_reorder N -> Frames can arrive out of order, and exposures of double exposure scans not interleaved. A frame still missing exposures when a frame\n\
+\t\t\tN positions later arrives is dropped, its late exposures are counted as frames_late ({} by default).\n\
+\t --pending_saves N -> With -L or --server, the results of each scan are gathered and saved in the background while the next scan is processed,\n\
+\t\t\twith up to N scans waiting to be saved ({} by default). N = 0 saves them before receiving the next scan.\n\
+\t --timestamps -> Send output frames as (index, frame, timestamps) messages, with the acquisition (when the input carries it), receive,\n\
+\t\t\tcompute_start, compute_end and send times of each frame. Announced as 'timestamps' in the output metadata. Off by default.\n\
+------------------------------------------------------------------------------\n\
+Server mode, for series of scans from disk:\n\
+\t --server ADDRESS -> Keep the MPI ranks running with their compiled kernels, and preprocess the scans submitted as jobs to a zmq socket bound at\n\
+\t\t\tADDRESS ('IP:PORT', 'tcp://IP:PORT' or 'ipc://PATH', {} with an empty ADDRESS), in order. Jobs can override the options\n\
+\t\t\t-c, -b, -t, -p, -F, --timestamps and --trace, and the configuration file values. See scripts/cosmicp_jobs.py to submit jobs and follow them.\n\
+------------------------------------------------------------------------------\n\
+Metrics options (per stage timings and frame counters, summarized by rank 0 at the end of each scan):\n\
+\t --metrics_port PORT -> Serve Prometheus metrics at http://host:PORT+rank/metrics, one port per MPI rank. Off by default.\n\
+\t --metrics_file F -> Write the metrics of each rank as JSON into F_rank<N>.json, every --metrics_period seconds ({} by default). Off by default.\n\
+\t --trace F -> Write a trace of the stages and frames of all ranks into F in Chrome trace format (chrome://tracing or ui.perfetto.dev).\n\
+\t\t\tWith -L, the trace of each scan goes into F_scan<N>. Off by default.\n\
+------------------------------------------------------------------------------\n\
+Profiling options (each MPI rank writes into DIR/rank<N>):\n\
+\t --profile_dir DIR -> Output directory of the profiling options below, {} by default.\n\
+\t --jax_trace START:STOP -> JAX profiler trace of batches START to STOP - 1 of each scan, into jax_trace/ (TensorBoard or ui.perfetto.dev).\n\
+\t --cprofile -> cProfile of rank 0, written at the end of each scan into cprofile.pstats and cprofile.txt.\n\
+\t --hlo_dump -> Dump the HLO of the batch kernels compiled by XLA, as text, into hlo/.\n\
+\n\n".format(default_conf, default_io_threads, default_log_period, default_output_address, default_intermediate_address, default_ordered_output, default_compression, default_preview_width, default_frame_timeout, default_flush_period, default_max_reorder, default_pending_saves, default_server_address,
+         default_metrics_period, default_profile_dir)
 
 def parse_arguments(args, options = None):
 
     printv(color("\nParsing parameters...\n", bcolors.OKGREEN))
 
-    try:
-        json_file = args[0]
-    except:
-        raise Exception(color("\nMust provide an input JSON file\n", bcolors.FAIL))
-
     if options is None:
         options = {"gpu_accelerated": False,
                    "conf_file":  default_conf,
                    "batch_size_per_rank": 20,
+                   "io_threads": default_io_threads,
                    "output_mode":"disk",
                    "output_address": default_output_address,
                    "intermediate_address": default_intermediate_address,
-                   "keep_running": False}
+                   "keep_running": False,
+                   "photon_counts": False,
+                   "fast_start": False,
+                   "dark_library": None,
+                   "metrics_port": None,
+                   "metrics_file": None,
+                   "metrics_period": default_metrics_period,
+                   "timestamps": False,
+                   "trace": None,
+                   "profile_dir": default_profile_dir,
+                   "jax_trace": None,
+                   "cprofile": False,
+                   "hlo_dump": False,
+                   "log_level": "info",
+                   "log_period": default_log_period,
+                   "server": None,
+                   "pending_saves": default_pending_saves,
+                   "frame_timeout": default_frame_timeout,
+                   "flush_period": default_flush_period,
+                   "max_reorder": default_max_reorder,
+                   "ordered_output": default_ordered_output,
+                   "frames_per_message": default_frames_per_message,
+                   "compression": default_compression,
+                   "shm_ring": default_shm_ring,
+                   "preview": 0,
+                   "preview_width": default_preview_width,
+                   "sparse": False,
+                   "sparse_cxi": False,
+                   "accumulate": None}
 
     try:
-        opts, args_left = getopt.getopt(args,"hgc:b:m:o:i:L", \
-                              ["gpu_accelerated", "conf_file=", "batch_size_per_rank=", "output_mode=", "output_address=", "intermediate_address=", "keep_running"])
+        opts, args_left = getopt.getopt(args,"hgc:b:t:m:o:i:LpD:v:F", \
+                              ["gpu_accelerated", "conf_file=", "batch_size_per_rank=", "io_threads=", "output_mode=", "output_address=", "intermediate_address=", "keep_running", "photon_counts", "fast_start", "dark_library=", "metrics_port=", "metrics_file=", "metrics_period=", "timestamps", "trace=", "profile_dir=", "jax_trace=", "cprofile", "hlo_dump", "log_level=", "log_period=", "server=", "pending_saves=", "frame_timeout=", "flush_period=", "max_reorder=", "ordered_output=", "frames_per_message=", "compression=", "shm_ring=", "preview=", "preview_width=", "sparse", "sparse_cxi", "accumulate="])
 
     except getopt.GetoptError:
         printv(color(help, bcolors.WARNING))
@@ -56,6 +150,8 @@ def parse_arguments(args, options = None):
             options["gpu_accelerated"] = True
         if opt in ("-b", "--batch_size_per_rank"):
             options["batch_size_per_rank"] = int(arg)
+        if opt in ("-t", "--io_threads"):
+            options["io_threads"] = int(arg)
         if opt in ("-c", "--conf_file"):
             options["conf_file"] = str(arg)
         if opt in ("-m", "--output_mode"):
@@ -66,9 +162,72 @@ def parse_arguments(args, options = None):
             options["intermediate_address"] = str(arg)
         if opt in ("-L", "--keep_running"):
             options["keep_running"] = True   
-
-
-    if len(args_left) != 1:
+        if opt in ("-p", "--photon_counts"):
+            options["photon_counts"] = True
+        if opt in ("-F", "--fast_start"):
+            options["fast_start"] = True
+        if opt in ("-D", "--dark_library"):
+            options["dark_library"] = str(arg)
+        if opt == "--metrics_port":
+            options["metrics_port"] = int(arg)
+        if opt == "--metrics_file":
+            options["metrics_file"] = str(arg)
+        if opt == "--metrics_period":
+            options["metrics_period"] = float(arg)
+        if opt == "--timestamps":
+            options["timestamps"] = True
+        if opt == "--trace":
+            options["trace"] = str(arg)
+        if opt == "--profile_dir":
+            options["profile_dir"] = str(arg)
+        if opt == "--jax_trace":
+            start, stop = arg.split(":")
+            options["jax_trace"] = (int(start), int(stop))
+        if opt == "--cprofile":
+            options["cprofile"] = True
+        if opt == "--hlo_dump":
+            options["hlo_dump"] = True
+        if opt in ("-v", "--log_level"):
+            if arg not in log_levels:
+                raise Exception(color("\nUnknown log level " + arg + ", use one of " + ", ".join(log_levels) + "\n", bcolors.FAIL))
+            options["log_level"] = arg
+        if opt == "--log_period":
+            options["log_period"] = float(arg)
+        if opt == "--server":
+            options["server"] = str(arg) or default_server_address
+        if opt == "--pending_saves":
+            options["pending_saves"] = int(arg)
+        if opt == "--frame_timeout":
+            options["frame_timeout"] = float(arg)
+        if opt == "--flush_period":
+            options["flush_period"] = float(arg)
+        if opt == "--max_reorder":
+            options["max_reorder"] = int(arg)
+        if opt == "--ordered_output":
+            options["ordered_output"] = int(arg)
+        if opt == "--frames_per_message":
+            options["frames_per_message"] = int(arg)
+        if opt == "--compression":
+            options["compression"] = str(arg)
+        if opt == "--shm_ring":
+            options["shm_ring"] = int(arg)
+        if opt == "--preview":
+            options["preview"] = int(arg)
+        if opt == "--preview_width":
+            options["preview_width"] = int(arg)
+        if opt == "--sparse":
+            options["sparse"] = True
+        if opt == "--sparse_cxi":
+            options["sparse_cxi"] = True
+        if opt == "--accumulate":
+            options["accumulate"] = str(arg)
+
+
+    #In server mode the input files come with the jobs
+    if options["server"] is not None and len(args_left) == 0:
+        options["fname"] = None
+
+    elif len(args_left) != 1 or options["server"] is not None:
 
         printv(color(help, bcolors.WARNING))
         sys.exit(2)
@@ -3,21 +3,27 @@ import os
 import jax.numpy as np
 import jax
 import jax.ops
-import jax.dlpack
-import scipy
+import jax.scipy.signal
 import scipy.constants
-import scipy.interpolate
-import scipy.signal
 import numpy as npo
-import math
-import zmq
+import time
 import json
-import threading
 from .nexus_io import write, nexus_metadata, nexus_data, cosmic_metadata
 from .fccd import imgXraw as cleanXraw
+from .fccd import width as clean_frame_width
 from .common import printd, printv, rank, gather, color, bcolors, comm
+from .common import log, log_rank, log_frame, log_progress, INFO, DEBUG, WARNING
 from .common import  size as mpi_size
-from .diskIO import IO, frames_out
+from .network import subscribe_to_socket, publish_to_socket, xsub_xpub_router, receive_metadata, send_metadata, is_control_message, end_of_scan
+from .network import pack_output, pack_preview, default_output_format
+from .diskIO import IO, frames_out, prefetch_batches, chunk_aligned_batch_size
+from .darks import DarkAccumulator
+from .reorder import ReorderBuffer
+from .metrics import timed, counter, observe_frame_latencies
+from . import trace
+from . import profiling
+from . import shm
+from . import sparse
 
 from timeit import default_timer as timer
 from functools import partial
@@ -25,8 +31,11 @@ from functools import partial
 import msgpack
 import msgpack_numpy
 
+#Long exposure pixels above this level are replaced by the short exposure, and count as saturated in the preview statistics
+saturation_threshold = 3e3
+
 @jax.jit
-def combine_double_exposure(data0, data1, double_exp_time_ratio, thres=3e3):
+def combine_double_exposure(data0, data1, double_exp_time_ratio, thres=saturation_threshold):
 
     msk=data0<thres    
 
@@ -50,6 +59,28 @@ def center_of_mass(img, coord_array_1d):
 def filter_frame(frame, bbox):
     return jax.scipy.signal.convolve2d(frame, bbox, mode='same', boundary='fill')
 
+#Sums blocks of rebin x rebin pixels, the last rows and columns are left out when the width is not a multiple of rebin
+@partial(jax.jit, static_argnums=1)
+def rebin_frame(frame, rebin):
+
+    height, width = frame.shape[0] // rebin, frame.shape[1] // rebin
+
+    return np.sum(np.reshape(frame[:height * rebin, :width * rebin], (height, rebin, width, rebin)), axis = (1, 3))
+
+#Sums (or averages) each group of repetition consecutive clean frames, the exposures of a scan position
+@partial(jax.jit, static_argnums=(1, 2))
+def accumulate_frames(clean_frames, repetition, mean):
+
+    frames = np.reshape(clean_frames, (clean_frames.shape[0] // repetition, repetition) + clean_frames.shape[1:])
+
+    return np.mean(frames, axis = 1) if mean else np.sum(frames, axis = 1)
+
+#The clean frames are rebinned by the largest divisor of the box filter width up to geometry.rebin, so that the box filter of the
+#rebinned frames sums the same pixels, and the output frames keep their scale. Interpolating the rebinned frames with the scale
+#multiplied by the rebinning samples the same positions, the center is unchanged.
+def rebin_factor(kernel_width, rebin):
+    return max(r for r in range(1, max(min(kernel_width, rebin), 1) + 1) if kernel_width % r == 0)
+
 
 #Interpolation around the center of mass, thus centering. This downsamples into the output frame width
 @partial(jax.jit, static_argnums=2)
@@ -65,6 +96,74 @@ def shift_rescale(img, center_of_mass, out_frame_shape, scale):
 
     return img_out
 
+#Converts frames into estimated photon counts, photon_scale being the ADUs of one photon
+@jax.jit
+def photon_counts(frames, photon_scale):
+    return np.uint16(np.clip(np.round(frames / photon_scale), 0, npo.iinfo(npo.uint16).max))
+
+#Photon counts are stored as uint8 when the range allows, it halves again the output size
+def narrow_photon_counts(frames):
+
+    if frames.dtype == npo.uint16 and frames.size > 0 and npo.max(frames) <= npo.iinfo(npo.uint8).max:
+        return frames.astype(npo.uint8)
+
+    return frames
+
+def output_dtype(metadata):
+    return np.uint16 if metadata.get("photon_counts", False) else np.float32
+
+#CSR encoding of a batch of frames (see sparse.py) on the backend: the number of nonzero pixels of each frame, and the flat pixel indexes
+#and values of the nonzero pixels of all the frames in order, at the start of arrays as large as the batch
+@jax.jit
+def sparse_batch(frames):
+
+    flat = np.reshape(frames, (-1,))
+    frame_size = flat.shape[0] // frames.shape[0]
+
+    nonzero = flat != 0
+    counts = np.sum(np.reshape(nonzero, (frames.shape[0], frame_size)), axis = 1)
+
+    #Position of each nonzero pixel in the compacted arrays, zero pixels are out of bounds and dropped
+    position = np.where(nonzero, np.cumsum(nonzero) - 1, flat.shape[0])
+
+    indices = np.zeros(flat.shape, np.int32).at[position].set(np.arange(flat.shape[0], dtype = np.int32) % frame_size, mode = "drop")
+    values = np.zeros_like(flat).at[position].set(flat, mode = "drop")
+
+    return counts, indices, values
+
+def to_sparse(frames):
+    """Sparse block of a batch of frames (n, w, w), see sparse.py"""
+
+    counts, indices, values = sparse_batch(frames)
+
+    counts = npo.asarray(counts, dtype = npo.int32)
+    total = int(npo.sum(counts))
+
+    #Only the start of the arrays is copied from the device, in sizes rounded up to powers of two so that few slices are compiled
+    size = min(1 << max(total - 1, 0).bit_length(), indices.shape[0])
+
+    return {"sparse": "csr", "shape": list(frames.shape), "counts": counts,
+            "indices": npo.asarray(indices[:size])[:total].astype(sparse.index_dtype(frames.shape[1] * frames.shape[2])),
+            "values": narrow_photon_counts(npo.asarray(values[:size])[:total])}
+
+#Preview of an output frame, downsampled to preview_width and log scaled into uint8, and its statistics: total counts, maximum
+#and center of mass drift from the center of the frame (the center of the scan)
+def preview_frame(frame, preview_width):
+
+    frame = np.float32(frame)
+
+    small = jax.image.resize(frame, (preview_width, preview_width), method = "linear")
+    scaled = np.log1p(np.maximum(small, 0)) / np.maximum(np.log1p(np.max(small)), 1e-6)
+
+    coords = np.reshape(np.arange(frame.shape[0], dtype = np.float32), (frame.shape[0], 1))
+    total = np.sum(frame)
+
+    com = np.where(total > 0, center_of_mass(frame, coords), frame.shape[0] // 2)
+
+    stats = {"total": total, "max": np.max(frame), "com_drift": com - frame.shape[0] // 2}
+
+    return np.uint8(np.round(255 * scaled)), stats
+
 @jax.jit
 def split_background(background_double_exp):
 
@@ -75,14 +174,43 @@ def split_background(background_double_exp):
     return np.array([bkg_avg0, bkg_avg1])
 
 
-def compute_background_metadata(metadata, frames, dark_frames):
+def compute_geometry_metadata(metadata):
+    """Output pixel size, padded width and scales of the scan, which don't depend on its frames"""
+
+    # cropped width of the raw clean frames
+    if metadata["desired_padded_input_frame_width"]:
+        metadata["padded_frame_width"] = metadata["desired_padded_input_frame_width"]
+
+    else:
+        metadata["padded_frame_width"] = float(resolution2frame_width(metadata["final_res"], metadata["detector_distance"], metadata["energy"], metadata["detector_pixel_size"], metadata["frame_width"]))
+    
+    # modify pixel size; the pixel size is rescaled
+    metadata["x_pixel_size"] = metadata["detector_pixel_size"] * metadata["padded_frame_width"] / metadata["output_frame_width"]
+    metadata["y_pixel_size"] = metadata["x_pixel_size"]
+
+    # frame corner
+    corner_x = metadata['x_pixel_size']*metadata['output_frame_width']/2  
+    corner_z = metadata['detector_distance']                
+    metadata['corner_position'] = [corner_x, corner_x, corner_z]
+
+    if metadata.get("photon_counts", False):
+        #ADUs of a single photon at this energy (in eV), frames are divided by this to get photon counts
+        metadata["photon_scale"] = metadata["adu_per_ev"] * metadata["energy"] + metadata["adu_offset"]
+
+    metadata["energy"] = metadata["energy"]*scipy.constants.elementary_charge
+
+    metadata["output_padded_ratio"] = metadata["output_frame_width"]/metadata["padded_frame_width"]
+
+    return metadata
+
+
+def compute_background_metadata(metadata, frames, background_avg):
 
     ## get one frame to compute center
 
     clean_frame = [] 
     if metadata["double_exposure"]:
 
-        background_avg = split_background(dark_frames)
         for i in range(0, frames.shape[0], 2):
 
             frame_exp1 = frames[i] - background_avg[0]
@@ -91,7 +219,6 @@ def compute_background_metadata(metadata, frames, dark_frames):
             clean_frame.append(combine_double_exposure(cleanXraw(frame_exp1), cleanXraw(frame_exp2), metadata["double_exp_time_ratio"]))
             
     else:
-        background_avg = np.average(dark_frames,axis=0)
         for i in range(0, frames.shape[0], 1):
 
             # get clean frames
@@ -101,26 +228,10 @@ def compute_background_metadata(metadata, frames, dark_frames):
 
     metadata["frame_width"] = clean_frame.shape[0]
 
-    #Coordinates from 0 to frame width, 1 dimension
-    xx=np.reshape(np.arange(metadata["frame_width"]),(metadata["frame_width"],1))
+    #Coordinates from 0 to output frame width, 1 dimension
     yy=np.reshape(np.arange(metadata["output_frame_width"]),(metadata["output_frame_width"],1))
 
-    # cropped width of the raw clean frames
-    if metadata["desired_padded_input_frame_width"]:
-        metadata["padded_frame_width"] = metadata["desired_padded_input_frame_width"]
-
-    else:
-        metadata["padded_frame_width"] = float(resolution2frame_width(metadata["final_res"], metadata["detector_distance"], metadata["energy"], metadata["detector_pixel_size"], metadata["frame_width"]))
-    
-    # modify pixel size; the pixel size is rescaled
-    metadata["x_pixel_size"] = metadata["detector_pixel_size"] * metadata["padded_frame_width"] / metadata["output_frame_width"]
-    metadata["y_pixel_size"] = metadata["x_pixel_size"]
-
-    # frame corner
-    corner_x = metadata['x_pixel_size']*metadata['output_frame_width']/2  
-    corner_z = metadata['detector_distance']                
-    metadata['corner_position'] = [corner_x, corner_x, corner_z]
-    metadata["energy"] = metadata["energy"]*scipy.constants.elementary_charge
+    metadata = compute_geometry_metadata(metadata)
 
     #Convolution kernel
     kernel_width = np.max(np.array([np.int32(np.floor(metadata["padded_frame_width"]/metadata["output_frame_width"])),1]))
@@ -130,7 +241,7 @@ def compute_background_metadata(metadata, frames, dark_frames):
     for i in range(0, clean_frame.shape[0]):
         clean_frame[i] = filter_frame(clean_frame[i], bbox)
 
-        filtered_frames.append(shift_rescale(clean_frame[i], (0,0), metadata["output_frame_width"], metadata["output_frame_width"]/metadata["padded_frame_width"])[0])
+        filtered_frames.append(shift_rescale(clean_frame[i], (0,0), metadata["output_frame_width"], metadata["output_padded_ratio"])[0])
 
     filtered_frames = npo.array(filtered_frames)
 
@@ -139,112 +250,118 @@ def compute_background_metadata(metadata, frames, dark_frames):
     com = npo.array(np.round(com))
 
     metadata["center_of_mass"] = metadata["output_frame_width"]//2 - com
-    metadata["output_padded_ratio"] = metadata["output_frame_width"]/metadata["padded_frame_width"]
 
-    return metadata, background_avg
+    return metadata
 
 
-def subscribe_to_socket(network_metadata):
+#Centers of the previous scans, by output and padded frame widths, the centers being in output pixels
+last_centers = {}
 
-    addr = 'tcp://%s' % network_metadata["input_address"]
+def center_key(metadata):
+    return (metadata["output_frame_width"], round(metadata["padded_frame_width"], 3))
 
-    socket = network_metadata["context"].socket(zmq.SUB)
-    socket.setsockopt(zmq.SUBSCRIBE, b'')
-    socket.setsockopt(zmq.LINGER, -1)
-    socket.set_hwm(2000)
-    socket.connect(addr)
+#Center with the beam at the center of the clean frames, as the center of mass computed from frames above would find it
+def geometry_center(metadata):
 
-    return socket
+    com = npo.round(clean_frame_width * metadata["output_padded_ratio"] / 2 - 0.5)
 
-def publish_to_socket(network_metadata):
+    return metadata["output_frame_width"]//2 - npo.array([com, com])
 
-    addr = 'tcp://%s' % network_metadata["intermediate_address"]
 
-    socket = network_metadata["context"].socket(zmq.PUB)
-    socket.setsockopt(zmq.SNDHWM, 0)
-    socket.setsockopt(zmq.LINGER, -1)
-    socket.set_hwm(2000)
-    socket.connect(addr)
+#Fast start: no exposure frames are needed before processing, the center of the last scan with the same geometry is used,
+#or the geometry center if there is none. The center is then refined from the first output frames, see refine_center.
+def compute_fast_start_metadata(metadata):
 
-    return socket
+    metadata["frame_width"] = clean_frame_width
 
-def xsub_xpub_router(network_metadata):
+    metadata = compute_geometry_metadata(metadata)
 
-    printv(color("\r Setting up XSUB XPUB router, this will cast a thread running with the proxy router...", bcolors.HEADER))
+    if center_key(metadata) in last_centers:
+        metadata["center_of_mass"] = last_centers[center_key(metadata)].copy()
+        printv(color("\r Fast start, using the center of the last scan: {}".format(metadata["center_of_mass"]), bcolors.HEADER))
+    else:
+        metadata["center_of_mass"] = geometry_center(metadata)
+        printv(color("\r Fast start, using the center of the detector: {}".format(metadata["center_of_mass"]), bcolors.HEADER))
 
-    frontend_socket = network_metadata["context"].socket(zmq.XPUB)
+    return metadata
 
-    frontend_socket.setsockopt(zmq.SNDHWM, 0)
-    frontend_socket.setsockopt(zmq.LINGER, -1)
 
-    frontend_socket.bind('tcp://%s' % network_metadata["output_address"])
+#Input messages are (number, frame), or (number, frame, acquisition time) when the grabber timestamps its frames
+def unpack_frame(msg):
 
-    backend_socket = network_metadata["context"].socket(zmq.XSUB)
+    content = msgpack.unpackb(msg, object_hook= msgpack_numpy.decode, use_list=False,  max_bin_len=50000000, raw=False)
 
-    backend_socket.setsockopt(zmq.LINGER, -1)
+    acquisition_time = content[2] if len(content) > 2 else None
 
-    backend_socket.bind('tcp://%s' % network_metadata["intermediate_address"])
+    return content[0], content[1], acquisition_time
 
-    th = threading.Thread(target=zmq.proxy, args = (frontend_socket, backend_socket))
-    th.start()
 
-    #zmq.proxy(frontend_socket, backend_socket)
+def receive_frame(network_metadata):
 
-    return th
+    with timed("receive"):
+        msg = network_metadata["input_socket"].recv()
 
+    with timed("deserialize"):
+        (number, frame, acquisition_time) = unpack_frame(msg)
 
-def receive_metadata(network_metadata):
+    counter("frames_received", "Input frames received").inc()
 
-    printv(color("\r Waiting for metadata...", bcolors.HEADER))
+    log_frame("\r Received frame {}", int(number))
+    log_progress("received", "\r Received {} frames, {:.1f} frames/s")
 
-    metadata = json.loads(network_metadata["input_socket"].recv_string())  # blocking
+    return number, frame
 
-    printv(color("\r Metadata received", bcolors.HEADER))
 
-    return metadata
+def receive_n_frames(n_frames, network_metadata):
 
-def send_metadata(network_metadata, metadata):
+    frames = []
 
-    printd(color("\r Sending metadata to socket...", bcolors.HEADER))
+    n_received = 0
 
-    #We remove ndarrays here so that we can serialize all the metadata.
-    metadata_plain = metadata.copy()
+    while n_received < n_frames: 
 
-    metadata_plain["translations"] = metadata_plain["translations"].tolist()
-    metadata_plain["center_of_mass"] = metadata_plain["center_of_mass"].tolist()
+        number, frame = receive_frame(network_metadata)
 
-    network_metadata["intermediate_socket"].send_string(json.dumps(metadata_plain))
+        frames.append((int(number), frame))
+        n_received += 1           
 
-    printd(color("\r Metadata sent", bcolors.HEADER))
+    return frames
 
 
-def receive_n_frames(n_frames, network_metadata):
+#Dark frames are averaged as they arrive, so they are never buffered
+def receive_dark_frames(n_frames, darks, network_metadata):
 
-    frames = []
+    for i in range(0, n_frames): 
 
-    n_received = 0
+        number, frame = receive_frame(network_metadata)
 
-    while n_received < n_frames: 
+        darks.add(frame)
 
-        msg = network_metadata["input_socket"].recv()
+    return darks
 
-        (number, frame) = msgpack.unpackb(msg, object_hook= msgpack_numpy.decode, use_list=False,  max_bin_len=50000000, raw=False)
 
-        printv(color("\r Received frame " + str(int(number)), bcolors.HEADER))
+#Dark frames from disk or memory are averaged in batches, one batch in memory at a time
+def accumulate_dark_frames(dark_frames, darks, batch_size = 8):
 
-        frames.append(frame)
-        n_received += 1           
+    n_frames = dark_frames.shape[0]
 
-    return frames
+    batch_ranges = [(i, min(i + batch_size, n_frames)) for i in range(0, n_frames, batch_size)]
 
-from PIL import Image
+    for (start, stop), batch in zip(batch_ranges, prefetch_batches(dark_frames, batch_ranges, batch_size)):
+        darks.add_batch(batch[:stop - start])
+
+    return darks
 
 index = 0
 
 
-def prepare_from_mem(metadata, dark_frames, raw_frames):
+def prepare_from_mem(metadata, dark_frames, raw_frames, darks):
+
+    if dark_frames is not None:
+        accumulate_dark_frames(dark_frames, darks)
 
-    dark_frames = np.array(dark_frames)
+    if metadata.get("fast_start", False):
+        return metadata, []
 
     n_frames = raw_frames.shape[0]
     n_total_frames = metadata["translations"].shape[0]
@@ -270,71 +387,371 @@ def prepare_from_mem(metadata, dark_frames, raw_frames):
 
     center_frames = np.array(center_frames)
 
-    return metadata, center_frames, dark_frames
+    return metadata, center_frames
 
 
-def prepare_from_socket(metadata, network_metadata):
+def prepare_from_socket(metadata, network_metadata, darks):
 
     printv(color("\r Receiving dark frames...", bcolors.HEADER))
 
-    dark_frames = receive_n_frames(metadata["dark_num_total"] * (metadata['double_exposure']+1), network_metadata)
+    receive_dark_frames(metadata["dark_num_total"] * (metadata['double_exposure']+1), darks, network_metadata)
+
+    #With a fast start the center does not come from the first exposure frames
+    if metadata.get("fast_start", False):
+        return metadata, []
 
     n_some_exp_frames = 4  
 
     printv(color("\r Receiving some exposure frames...", bcolors.HEADER))
 
-    #We need some exp frames to compute the center of mass so we take those now and keep them for later 
-    some_exp_frames = receive_n_frames(n_some_exp_frames, network_metadata)
+    #We need some exp frames to compute the center of mass so we take those now and keep them for later, with their numbers
+    some_exp_frames = sorted(receive_n_frames(n_some_exp_frames, network_metadata), key = lambda f: f[0])
+
+    return metadata, some_exp_frames
+
+#frame_shape is the shape of the raw frames of the scan, None if none was received yet
+def blend_dark_library(metadata, darks, dark_library, frame_shape = None):
+
+    n_new_frames = min(darks.counts)
+
+    darks = dark_library.blend(metadata, darks, frame_shape)
+
+    printv(color("\r Dark frames: {} new, {} in total with the dark library".format(n_new_frames, min(darks.counts)), bcolors.HEADER))
+
+    #Every rank has to read the library before rank 0 updates it, so that all use the same background
+    if comm is not None:
+        comm.Barrier()
+
+    if rank == 0 and darks.n_frames > 0 and not darks.is_empty():
+        dark_library.store(metadata, darks)
+        dark_library.evict()
 
-    return metadata, np.array(some_exp_frames), dark_frames
+    return darks
 
-def prepare(metadata, dark_frames, raw_frames, network_metadata):
+
+def prepare(metadata, dark_frames, raw_frames, network_metadata, dark_library = None):
 
     received_exp_frames = []#this is used when reading from socket, we read some exp frames here first to compute some things so we have to keep them
 
+    #Running averages of the dark frames, for each exposure
+    darks = DarkAccumulator(metadata['double_exposure']+1, track_variance = True)
+
     #data coming in from socket
     if "input_socket" in network_metadata:
-        metadata, center_frames, dark_frames = prepare_from_socket(metadata, network_metadata)
-        received_exp_frames = center_frames
+        metadata, received_exp_frames = prepare_from_socket(metadata, network_metadata, darks)
+        center_frames = np.array([frame for number, frame in received_exp_frames])
 
     #data coming from mem or from disk
     else:
-        metadata, center_frames, dark_frames = prepare_from_mem(metadata, dark_frames, raw_frames)
+        metadata, center_frames = prepare_from_mem(metadata, dark_frames, raw_frames, darks)
+
+    #Scans with few or no dark frames use the averaged darks of previous scans with the same settings
+    if dark_library is not None:
+        frame_shape = raw_frames.shape[1:] if "input_socket" not in network_metadata else (center_frames.shape[1:] if len(center_frames) > 0 else None)
+        darks = blend_dark_library(metadata, darks, dark_library, frame_shape)
+
+    if darks.is_empty():
+        raise Exception(color("\nNo dark frames available for this scan\n", bcolors.FAIL))
+
+    background_avg = darks.background()
     
-    metadata, background_avg =  compute_background_metadata(metadata, center_frames, dark_frames)
+    if metadata.get("fast_start", False):
+        metadata = compute_fast_start_metadata(metadata)
+    else:
+        metadata =  compute_background_metadata(metadata, center_frames, background_avg)
+
+    metadata = compute_accumulation_metadata(metadata)
 
     return metadata, background_avg, received_exp_frames
 
 
-def prepare_filter_functions(metadata, background_avg):
+accumulate_modes = ("sum", "mean")
 
-    #Convolution kernel
-    kernel_width = np.max(np.array([np.int32(np.floor(metadata["padded_frame_width"]/metadata["output_frame_width"])),1]))
-    kernel_box = np.ones((kernel_width,kernel_width))
+#Exposures accumulated into each output frame, the repetition of the scan when they are accumulated
+def accumulated_exposures(metadata):
+
+    if metadata.get("accumulate") is None:
+        return 1
+
+    return max(int(metadata.get("repetition", 1)), 1)
+
+
+#With an accumulate mode, the repetition consecutive exposures of each position give one output frame, with one translation per position
+def compute_accumulation_metadata(metadata):
+
+    repetition = accumulated_exposures(metadata)
+
+    if repetition == 1:
+        return metadata
+
+    if metadata["accumulate"] not in accumulate_modes:
+        raise Exception(color("\nAccumulate mode {} is not one of {}\n".format(metadata["accumulate"], accumulate_modes), bcolors.FAIL))
+
+    n_positions = metadata["translations"].shape[0] // repetition
+
+    if n_positions * repetition != metadata["translations"].shape[0]:
+        log(WARNING, color("\r {} translations are not a multiple of the repetition {}, the last ones are left out".format(metadata["translations"].shape[0], repetition), bcolors.WARNING))
 
-    cleanXraw_vmap = jax.vmap(lambda x: cleanXraw(x - background_avg))
-    cleanXraw_vmap_d1 = jax.vmap(lambda x: cleanXraw(x - background_avg[0]))
-    cleanXraw_vmap_d2 = jax.vmap(lambda x: cleanXraw(x - background_avg[1]))
+    #The translations of the exposures of a position are averaged
+    metadata["translations"] = npo.mean(npo.reshape(metadata["translations"][:n_positions * repetition], (n_positions, repetition, -1)), axis = 1).astype(metadata["translations"].dtype)
 
-    combine_double_exposure_vmapf = jax.vmap(lambda x, y: combine_double_exposure(x, y, metadata["double_exp_time_ratio"]))
+    printv(color("\r {} exposures per position {}, {} output frames".format(repetition, "summed" if metadata["accumulate"] == "sum" else "averaged", n_positions), bcolors.HEADER))
 
-    #single and double exposure functions
-    f_cleanframes = jax.jit(lambda x: cleanXraw_vmap(x))
-    f_cleanframes_d = jax.jit(lambda x, y: combine_double_exposure_vmapf(cleanXraw_vmap_d1(x), cleanXraw_vmap_d2(y)))
+    return metadata
+
+
+#Batch kernels compiled so far, by the settings fixing their shapes. The background, center and scales are arguments of the kernels,
+#so that the following scans with the same settings reuse them instead of compiling them again (see the server mode of cosmic.py)
+filter_kernels = {}
+
+
+#With a preview_width, the kernels return (frames, previews, statistics) of the batch instead of the frames, see preview_frame.
+#With a rebin, the clean frames are rebinned before the box filter of kernel_width (in rebinned pixels), see rebin_factor.
+#With a repetition, each group of repetition consecutive frames of a batch gives one output frame, their sum or mean, see accumulate_frames
+def get_filter_kernels(kernel_width, output_frame_width, output_photon_counts, preview_width = 0, rebin = 1, repetition = 1, mean = False):
+
+    key = (kernel_width, output_frame_width, output_photon_counts, preview_width, rebin, repetition, mean)
+
+    if key in filter_kernels:
+        return filter_kernels[key]
+
+    kernel_box = np.ones((kernel_width,kernel_width))
 
-    def f(clean_frame):
+    cleanXraw_vmap = jax.vmap(lambda x, background: cleanXraw(x - background), in_axes = (0, None))
+
+    combine_double_exposure_vmapf = jax.vmap(combine_double_exposure, in_axes = (0, 0, None))
+
+    def f(clean_frame, center_of_mass, output_padded_ratio, photon_scale):
+        if rebin > 1:
+            clean_frame = rebin_frame(clean_frame, rebin)
         filtered_frame = filter_frame(clean_frame, kernel_box)
-        centered_rescaled_frame = shift_rescale(filtered_frame, metadata["center_of_mass"], metadata["output_frame_width"], metadata["output_padded_ratio"])
+        centered_rescaled_frame = shift_rescale(filtered_frame, center_of_mass, output_frame_width, output_padded_ratio)
+        if output_photon_counts:
+            centered_rescaled_frame = photon_counts(centered_rescaled_frame, photon_scale)
+        if preview_width > 0:
+            return (centered_rescaled_frame,) + preview_frame(centered_rescaled_frame[0], preview_width)
         return centered_rescaled_frame
 
-    process_batch_vmapf = jax.vmap(f)
+    process_frames_vmapf = jax.vmap(f, in_axes = (0, None, None, None))
+
+    def process_batch(clean_frames, center, ratio, photon_scale):
+        if repetition > 1:
+            clean_frames = accumulate_frames(clean_frames, repetition, mean)
+        return process_frames_vmapf(clean_frames, center, ratio, photon_scale)
+
+    #The fraction of saturated pixels is taken from the (long) exposure frames before they are combined, over the exposures of each output frame
+    def with_saturation(outputs, clean_frames):
+        if preview_width == 0:
+            return outputs
+        frames, previews, stats = outputs
+        saturated = np.reshape(clean_frames > saturation_threshold, (clean_frames.shape[0] // repetition, -1))
+        return frames, previews, {**stats, "saturated": np.mean(saturated, axis = 1)}
+
+    #single and double exposure functions, jitted lambdas (see profiling.setup), the clean frames used twice are computed once by XLA
+    f_all = jax.jit(lambda x, background, center, ratio, photon_scale:
+                    with_saturation(process_batch(cleanXraw_vmap(x, background), center, ratio, photon_scale), cleanXraw_vmap(x, background)))
+    f_all_d = jax.jit(lambda x, y, background, time_ratio, center, ratio, photon_scale: 
+                      with_saturation(process_batch(combine_double_exposure_vmapf(cleanXraw_vmap(x, background[0]), cleanXraw_vmap(y, background[1]), time_ratio), center, ratio, photon_scale),
+                                      cleanXraw_vmap(x, background[0])))
 
-    f_all = jax.jit(lambda x: process_batch_vmapf(f_cleanframes(x)))
-    f_all_d = jax.jit(lambda x, y: process_batch_vmapf(f_cleanframes_d(x, y)))
+    filter_kernels[key] = (f_all, f_all_d)
 
     return f_all, f_all_d
 
 
+#preview_width is 0 without previews, see network_metadata["preview"]
+def prepare_filter_functions(metadata, background_avg, preview_width = 0):
+
+    #Convolution kernel
+    kernel_width = int(max(npo.floor(metadata["padded_frame_width"]/metadata["output_frame_width"]), 1))
+
+    #The rebinning is folded into the box filter
+    rebin = rebin_factor(kernel_width, metadata.get("rebin", 1))
+    kernel_width //= rebin
+
+    if rebin != metadata.get("rebin", 1):
+        printv(color("\r Rebinning the clean frames by {} instead of {}, the box filter being {} pixels wide".format(rebin, metadata["rebin"], kernel_width * rebin), bcolors.HEADER))
+
+    f_all, f_all_d = get_filter_kernels(kernel_width, metadata["output_frame_width"], metadata.get("photon_counts", False), preview_width, rebin,
+                                        accumulated_exposures(metadata), metadata.get("accumulate") == "mean")
+
+    ratio = npo.float32(metadata["output_padded_ratio"] * rebin)
+    time_ratio = npo.float32(metadata["double_exp_time_ratio"])
+    photon_scale = npo.float32(metadata.get("photon_scale", 1.0))
+
+    #The center is read on every call, it changes when it is refined during the scan (see refine_center)
+    center = lambda: npo.asarray(metadata["center_of_mass"], dtype = npo.float32)
+
+    return (lambda x: f_all(x, background_avg, center(), ratio, photon_scale)), \
+           (lambda x, y: f_all_d(x, y, background_avg, time_ratio, center(), ratio, photon_scale))
+
+
+def split_preview(outputs):
+    """Output frames of a batch kernel, and its (previews, statistics) or None without preview"""
+
+    if isinstance(outputs, tuple):
+        return outputs[0], outputs[1:]
+
+    return outputs, None
+
+
+def send_preview(preview, indexes, network_metadata):
+    """Publishes the previews and statistics of the output frames of a batch whose index is a multiple of the decimation"""
+
+    previews, stats = preview
+
+    rows = [k for k, index in enumerate(indexes) if index % network_metadata["preview"]["decimation"] == 0]
+
+    if len(rows) == 0:
+        return
+
+    with timed("send_preview"):
+        msg = pack_preview([int(indexes[k]) for k in rows], npo.asarray(previews[npo.array(rows)]),
+                           {name: npo.asarray(value[npo.array(rows)]).tolist() for name, value in stats.items()})
+
+        network_metadata["intermediate_socket"].send(msg)
+
+    counter("previews_sent", "Output frame previews sent to the socket").inc(len(rows))
+
+
+#Batches of each rank whose output frames refine a fast start center, and at most how many batches are kept
+#to be reprocessed, while the ranks agree on the refined center. The output frames of the kept batches are held,
+#they are sent once, with the refined center, so consumers get each output frame once.
+refine_batches = 2
+max_refine_batches = 8
+
+def start_center_refinement(metadata):
+    """State of the refinement of a fast start center, None without a fast start"""
+
+    if not metadata.get("fast_start", False):
+        return None
+
+    return {"sum": npo.zeros((metadata["output_frame_width"], metadata["output_frame_width"])), "total": None,
+            "request": None, "started": False, "batches": [], "done": False}
+
+
+#The output frames of the first batches are summed over all ranks with a non blocking reduction, so no rank waits for it
+def start_center_reduction(refinement):
+
+    refinement["total"] = npo.empty_like(refinement["sum"])
+    refinement["started"] = True
+
+    if comm is not None and mpi_size > 1:
+        refinement["request"] = comm.Iallreduce(refinement["sum"], refinement["total"])
+    else:
+        refinement["total"][:] = refinement["sum"]
+
+
+def center_reduction_done(refinement, wait = False):
+
+    if refinement["request"] is None:
+        return True
+
+    if wait:
+        refinement["request"].Wait()
+        return True
+
+    return refinement["request"].Test()
+
+
+def holds_output(refinement):
+    """The output frames of the batches are held until the center is refined"""
+
+    return refinement is not None and not refinement["done"]
+
+
+def refine_center(refinement, metadata, filter_all, filter_all_dexp, inputs, outputs, position):
+    """Called after each batch with its inputs, outputs, and (start, stop) position in the output frames of the rank.
+    Returns the batches held once the refined center is known, as [((start, stop), outputs)], outputs being
+    the batch reprocessed with the refined center, or None if the center did not change"""
+
+    if refinement is None or refinement["done"]:
+        return []
+
+    #Copies, the inputs from disk go back to the prefetching buffers
+    refinement["batches"].append((tuple(npo.array(x) for x in inputs), position))
+
+    if not refinement["started"]:
+        #Padded batches have more frames than their position, the rows past it are undefined
+        refinement["sum"] += npo.sum(npo.asarray(outputs[:position[1] - position[0], 0], dtype = npo.float64), axis = 0)
+
+        if len(refinement["batches"]) == refine_batches:
+            start_center_reduction(refinement)
+
+        return []
+
+    if center_reduction_done(refinement) or len(refinement["batches"]) >= max_refine_batches:
+        return finish_center_refinement(refinement, metadata, filter_all, filter_all_dexp)
+
+    return []
+
+
+def finish_center_refinement(refinement, metadata, filter_all, filter_all_dexp):
+    """Refines the center from the output frames of all ranks (collective, the last call of refine_center or at the end of the scan),
+    and reprocesses the kept batches if it changed"""
+
+    if refinement is None or refinement["done"]:
+        return []
+
+    if not refinement["started"]:
+        start_center_reduction(refinement)
+
+    center_reduction_done(refinement, wait = True)
+
+    batches = refinement["batches"]
+    refinement.update({"batches": [], "done": True})
+
+    total = refinement["total"]
+
+    unchanged = [(position, None) for inputs, position in batches]
+
+    if npo.sum(total) <= 0:
+        return unchanged
+
+    yy = np.reshape(np.arange(metadata["output_frame_width"]), (metadata["output_frame_width"], 1))
+
+    com = npo.array(np.round(center_of_mass(total, yy)))
+
+    center = metadata["center_of_mass"] + (metadata["output_frame_width"]//2 - com)
+
+    if npo.array_equal(center, metadata["center_of_mass"]):
+        printv(color("\r Center refined from the first output frames: {}, unchanged".format(center), bcolors.HEADER))
+        return unchanged
+
+    printv(color("\r Center refined from the first output frames: {}, {} before".format(center, metadata["center_of_mass"]), bcolors.HEADER))
+
+    metadata["center_of_mass"] = center
+
+    reprocessed = []
+
+    for inputs, position in batches:
+
+        with timed("reprocess"):
+            outputs, preview = split_preview(filter_all_dexp(*inputs) if len(inputs) == 2 else filter_all(*inputs))
+            outputs.block_until_ready()
+
+        counter("frames_reprocessed", "Output frames processed again with a refined center").inc(outputs.shape[0])
+
+        reprocessed.append((position, outputs))
+
+    return reprocessed
+
+
+def store_reprocessed(reprocessed, out_data, my_indexes, network_metadata, metadata, frame_times = None):
+    """Replaces the frames reprocessed with a refined center in out_data, and sends the frames held during the refinement to the output socket"""
+
+    for (start, stop), frames in reprocessed:
+
+        #Padded batches have more frames than their position
+        if frames is not None:
+            out_data = out_data.at[start:stop, :, :].set(frames[:stop - start,0,:,:])
+
+        if "intermediate_socket" in network_metadata:
+            send_socket_data(out_data, my_indexes, start, stop, network_metadata, frame_times, metadata.get("timestamps", False))
+
+    return out_data
+
+
 def process(metadata, raw_frames, background_avg, local_batch_size, received_exp_frames, network_metadata):
 
     if metadata["double_exposure"]:
@@ -342,36 +759,96 @@ def process(metadata, raw_frames, background_avg, local_batch_size, received_exp
     else:
         printv(color("\nProcessing the stack of raw frames as a single exposure scan...\n", bcolors.OKGREEN))
 
-    filter_all, filter_all_dexp = prepare_filter_functions(metadata, background_avg)
+    preview_width = network_metadata["preview"]["width"] if network_metadata.get("preview") else 0
+
+    filter_all, filter_all_dexp = prepare_filter_functions(metadata, background_avg, preview_width)
 
     if "input_socket" in network_metadata:
-        printv(color("\r Processing a stack of frames of size: {}".format((metadata["exp_num_total"], 
-                       received_exp_frames[0].shape[0], received_exp_frames[0].shape[1])), bcolors.HEADER))
+        printv(color("\r Processing a stack of {} frames".format(metadata["exp_num_total"]), bcolors.HEADER))
         results = process_from_socket(metadata, filter_all, filter_all_dexp, received_exp_frames, network_metadata)
     else:
         printv(color("\r Processing a stack of frames of size: {}".format((raw_frames.shape[0], raw_frames[0].shape[0], raw_frames[0].shape[1])), bcolors.HEADER))
         results = process_from_disk(metadata, raw_frames, local_batch_size, filter_all, filter_all_dexp, network_metadata)
 
+    #The next scans with a fast start begin with this center
+    last_centers[center_key(metadata)] = npo.array(metadata["center_of_mass"])
+
     return results
 
 
-def send_socket_data(frames, indexes, min_i, max_i, network_metadata):
+#frame_times maps output indexes to their timestamps (acquisition, receive, compute_start, compute_end), the send time is added here.
+#With send_timestamps, messages carry the timestamps of their frames. Frames are sent in messages of network_metadata["output_format"], see network.pack_output
+def send_socket_data(frames, indexes, min_i, max_i, network_metadata, frame_times = None, send_timestamps = False):
 
-    printd(color("\r Sending output frames buffer to socket...", bcolors.HEADER))
+    log_rank(DEBUG, "\r Sending output frames buffer to socket...", c = bcolors.HEADER)
 
-    for i in range(min_i, max_i):
+    output_format = network_metadata.get("output_format", default_output_format())
 
-        printd(color("\r Sending frame " + str(indexes[i]), bcolors.HEADER))
+    #The ordered router tells the frames of consecutive scans apart by their scan
+    scan_id = network_metadata.get("scan_id") if network_metadata.get("ordered_output", 0) > 0 else None
 
-        msg = msgpack.packb((b'%d' % indexes[i], npo.array(frames[i])), default=msgpack_numpy.encode, use_bin_type=True)
-        network_metadata["intermediate_socket"].send(msg)
+    for m in range(min_i, max_i, output_format["frames_per_message"]):
+
+        n = min(output_format["frames_per_message"], max_i - m)
+
+        for i in range(m, m + n):
+            log_frame("\r Sending frame {}", indexes[i])
+
+        times = [frame_times.pop(indexes[i], {}) if frame_times is not None else {} for i in range(m, m + n)]
+
+        send_time = time.time()
+        for t in times:
+            t["send"] = send_time
+
+        with timed("send"):
+            ring = None
+
+            #Only the nonzero pixels come back from the device
+            if output_format.get("sparse", False) and not output_format.get("shared_memory", False):
+                block = to_sparse(frames[m:m + n])
+            else:
+                #One copy from the device for all the frames of the message
+                block = narrow_photon_counts(npo.asarray(frames[m:m + n]))
+
+            if output_format.get("shared_memory", False):
+                #Slots hold frames_per_message frames of the widest type
+                ring = network_metadata["shm_ring"] = shm.ring(network_metadata.get("shm_ring"), network_metadata["shm_slots"],
+                                                               output_format["frames_per_message"] * block[0].size * npo.dtype(npo.float32).itemsize)
 
+            msg = pack_output(indexes[m:m + n], block, output_format, times if send_timestamps else None, ring, scan_id)
 
+            network_metadata["intermediate_socket"].send(msg)
+
+        counter("frames_sent", "Output frames sent to the socket").inc(n)
+        counter("messages_sent", "Output messages sent to the socket").inc()
+        log_progress("sent", "\r Sent {} frames, {:.1f} frames/s", n)
+        counter("bytes_sent", "Bytes of output frames sent to the socket").inc(len(msg))
+
+        for i, t in zip(range(m, m + n), times):
+            observe_frame_latencies(t)
+            trace.frame(indexes[i], t)
+
+
+#Default seconds without input messages before a scan is ended, seconds a partial batch waits for more frames,
+#and how many output frames an incomplete frame can be behind the newest one before it is dropped
+default_frame_timeout = 10.0
+default_flush_period = 0.2
+default_max_reorder = 64
+
+#received_exp_frames are (number, frame) pairs received before, to compute the center of mass.
+#The scan ends with an end of scan message, the metadata of the next scan, when all the frames of this rank are complete,
+#or after frame_timeout seconds without input messages. Frames with missing exposures are not processed, see save_results.
+#Frames can arrive in any order, up to max_reorder output frames late (see reorder.py).
+#With an accumulate mode, the exposures of the repetitions of a position are assembled into one output frame.
 def process_from_socket(metadata, filter_all, filter_all_dexp, received_exp_frames, network_metadata):
 
+    n_exposures = metadata['double_exposure'] + 1
 
-    total_input_frames = metadata["exp_num_total"] * (metadata['double_exposure']+1)
-    total_output_frames = metadata["exp_num_total"]  
+    #Exposure frames of each output frame
+    n_frame_exposures = n_exposures * accumulated_exposures(metadata)
+
+    total_input_frames = metadata["exp_num_total"] * n_exposures
+    total_output_frames = metadata["exp_num_total"] // accumulated_exposures(metadata)
     
     buffer_size_ratio = 0.01
     b_size = int(total_input_frames * buffer_size_ratio) // mpi_size
@@ -380,132 +857,196 @@ def process_from_socket(metadata, filter_all, filter_all_dexp, received_exp_fram
 
     input_buffer_size = max(6, b_size) #How many frames are stored in each rank before actually computing them
 
-    #How many frames are stored in each rank before sending them out to a socket, 
-    #this always has to be >= than input_buffer_size// (metadata['double_exposure']+1)
-    output_buffer_size = max(6, b_size) 
+    #Output frames per batch, partial batches are padded to this size so that the kernels are compiled once
+    batch_size = max(input_buffer_size // n_frame_exposures, 1)
 
-    output_index = 0
-    batch = 1
-    number = 0
+    frame_timeout = network_metadata.get("frame_timeout", default_frame_timeout)
+    flush_period = network_metadata.get("flush_period", default_flush_period)
 
     output_socket = "intermediate_socket" in network_metadata
 
-    n_batches = total_input_frames // mpi_size
+    #Each rank takes only some frames
+    my_frames = range(rank, total_output_frames, mpi_size)
 
-    #Here we correct if the total number of frames is not a multiple of mpi_size  
-    extra_frames = total_input_frames - (n_batches * mpi_size)
+    out_data = np.empty((len(my_frames), metadata["output_frame_width"], metadata["output_frame_width"]), dtype=output_dtype(metadata))
 
-    extra = 0
-    if rank < extra_frames: 
-        extra = 1
+    output_index = 0
+    my_indexes = []
 
-    out_data_shape = (n_batches * mpi_size //(metadata['double_exposure']+1) + extra, metadata["output_frame_width"], metadata["output_frame_width"])
+    #Exposures of the frames of this rank, in any order, are assembled into complete frames there
+    reorder = ReorderBuffer(n_frame_exposures, batch_size, network_metadata.get("max_reorder", default_max_reorder))
 
+    #Timestamps of the output frames of this rank, until they are sent
+    frame_times = {}
 
-    out_data = np.empty(out_data_shape,dtype=np.float32)
+    processed_batches = 0
 
-    frames_buffer = [] 
-    index_buffer = []
+    #With a fast start, the center is refined from the first batches
+    refinement = start_center_refinement(metadata)
 
-    processed_batches = 0
+    #The frames received already are added as the others
+    pending = [(number, frame, None, time.time()) for number, frame in received_exp_frames]
 
-    #We initialize here the buffer with the exp frames we have received already
-    for i in range(0,len(received_exp_frames)):
-        if ((i // (metadata["double_exposure"] + 1)) % mpi_size) == rank:
-            frames_buffer.append(received_exp_frames[i].astype(npo.uint16)) #We will deserialize these frames again below, so we cast back to uint16
-            index_buffer.append(i // (metadata["double_exposure"] + 1))
+    printv(color("\r Receiving all exposure frames...", bcolors.HEADER))
 
-    my_indexes = []
+    last_message = time.time()
+    end = False
 
+    while not end or len(reorder.ready) > 0:
 
-    frames_ready = len(frames_buffer) // (metadata["double_exposure"] + 1)
-    frames_sent = 0
+        #Waiting for a message until the inactivity timeout, or until the partial batch has to be processed
+        if not end and len(pending) == 0:
 
-    printv(color("\r Receiving all exposure frames...", bcolors.HEADER))
+            wait = frame_timeout - (time.time() - last_message)
 
-    while number != total_input_frames - 1: 
+            if reorder.wait_time(flush_period) is not None:
+                wait = min(wait, reorder.wait_time(flush_period))
 
-        msg = network_metadata["input_socket"].recv()  # blocking
+            if network_metadata["input_socket"].poll(max(wait, 0.0) * 1000):
 
-        (number, frame) = msgpack.unpackb(msg, object_hook= msgpack_numpy.decode, use_list=False,  max_bin_len=50000000, raw=False)  
+                with timed("receive"):
+                    msg = network_metadata["input_socket"].recv()
 
-        number = int(number)
-        final_number = number // (metadata["double_exposure"] + 1)
+                last_message = time.time()
 
-        #Each rank takes only some frames
-        if (final_number % mpi_size) == rank: 
+                if is_control_message(msg):
+                    control = json.loads(msg)
 
-            printd(color("\r Received frame " + str(number), bcolors.HEADER))
+                    #The next scan started, its metadata is kept for receive_metadata
+                    if control.get("event") != end_of_scan:
+                        network_metadata["pending_metadata"] = control
 
-            frames_buffer.append(frame)
-            index_buffer.append(final_number)
+                    log_rank(DEBUG, "\r End of scan received", c = bcolors.HEADER)
+                    end = True
 
- 
-        #after filling the buffer we do the processing, or if it is the last frame we consume the buffer too
-        if len(frames_buffer) == input_buffer_size or number == total_input_frames - 1:
+                else:
+                    with timed("deserialize"):
+                        (number, frame, acquisition_time) = unpack_frame(msg)
 
-            printd(color("\r Processing input frames buffer...", bcolors.HEADER))
+                    pending.append((number, frame, acquisition_time, last_message))
 
-            frames_buffer = np.array(frames_buffer)
+                    counter("frames_received", "Input frames received").inc()
+                    log_progress("received", "\r Received {} frames, {:.1f} frames/s")
 
-            #print(frames_buffer)
+            elif time.time() - last_message >= frame_timeout:
+                log_rank(WARNING, "\r No input frames for {:.1f}s, ending the scan", frame_timeout, c = bcolors.WARNING)
+                end = True
 
-            #if double exposure we take 1 every 2 (because indexes are duplicated as they are divided by 2 above)
-            my_indexes.extend(index_buffer[::metadata["double_exposure"] + 1]) 
+        for number, frame, acquisition_time, receive_time in pending:
 
-            n_frames_out = frames_buffer.shape[0] // (metadata['double_exposure']+1)
+            number = int(number)
+            final_number = number // n_frame_exposures
 
-            if metadata["double_exposure"]:
-                centered_rescaled_frames_jax = filter_all_dexp(frames_buffer[:-1:2], frames_buffer[1::2])
-            else:
-                centered_rescaled_frames_jax = filter_all(frames_buffer)
+            #Each rank takes only some frames
+            if final_number % mpi_size != rank or final_number >= total_output_frames:
+                continue
+
+            log_frame("\r Received frame {}", number)
+
+            #In double exposure the times of the last exposure received are kept
+            reorder.add(number, frame, {"acquisition": acquisition_time, "receive": receive_time})
 
+        pending = []
+
+        #This rank has all its frames, the remaining messages of the scan are skipped by receive_metadata
+        if len(reorder.completed) == len(my_frames):
+            end = True
+
+        #after filling a batch we do the processing, or after flush_period seconds, or at the end of the scan
+        if reorder.batch_ready(flush_period, end):
+
+            log_rank(DEBUG, "\r Processing input frames buffer...", c = bcolors.HEADER)
+
+            index_buffer, frames_buffer, times_buffer = reorder.pop_batch()
+
+            for index, times in zip(index_buffer, times_buffer):
+                frame_times[index] = times
+
+            n_frames_out = len(index_buffer)
+
+            with timed("batch_assembly"):
+                #Partial batches are padded with copies of their last frame
+                frames_buffer.extend(frames_buffer[-n_frame_exposures:] * (batch_size - n_frames_out))
+                frames_buffer = np.array(frames_buffer)
+
+            profiling.batch(processed_batches)
+
+            my_indexes.extend(index_buffer) 
+
+            inputs = (frames_buffer[:-1:2], frames_buffer[1::2]) if metadata["double_exposure"] else (frames_buffer,)
+
+            compute_start = time.time()
+
+            with timed("compute"):
+                if metadata["double_exposure"]:
+                    centered_rescaled_frames_jax, preview = split_preview(filter_all_dexp(*inputs))
+                else:
+                    centered_rescaled_frames_jax, preview = split_preview(filter_all(*inputs))
+
+                centered_rescaled_frames_jax.block_until_ready()
+
+            compute_end = time.time()
+
+            centered_rescaled_frames_jax = centered_rescaled_frames_jax[:n_frames_out]
+
+            for index in index_buffer:
+                frame_times.setdefault(index, {}).update({"compute_start": compute_start, "compute_end": compute_end})
+
+            counter("frames_processed", "Output frames computed").inc(n_frames_out)
 
             # TODO: 'centered_rescaled_frames_jax' picks up an additional dimension somehow, should fix this...
             #out_data = jax.ops.index_update(out_data, jax.ops.index[output_index:output_index + n_frames_out, :, :], centered_rescaled_frames_jax[:,0,:,:])
             out_data = out_data.at[output_index:output_index + n_frames_out, :, :].set(centered_rescaled_frames_jax[:,0,:,:])
 
-            frames_buffer = []
-            index_buffer = []
+            #Sending frames to socket, unless they wait for the refined center
+            if output_socket and not holds_output(refinement):
+                send_socket_data(out_data, my_indexes, output_index, output_index + n_frames_out, network_metadata, frame_times, metadata.get("timestamps", False))
+
+            if output_socket and preview is not None:
+                send_preview(preview, index_buffer, network_metadata)
+
+            reprocessed = refine_center(refinement, metadata, filter_all, filter_all_dexp, inputs, centered_rescaled_frames_jax, (output_index, output_index + n_frames_out))
+            out_data = store_reprocessed(reprocessed, out_data, my_indexes, network_metadata, metadata, frame_times)
 
             output_index += n_frames_out
             processed_batches += 1
 
-            frames_ready += n_frames_out
+            log_rank(DEBUG, "\r Computing batch = {} of {} frames", processed_batches, n_frames_out, c = bcolors.HEADER)
+            log_progress("processed", "\r Processed {} frames, {:.1f} frames/s", n_frames_out)
 
-            if rank == 0:
-                sys.stdout.write(color("\r Computing batch = %s of %s frames\n" %(processed_batches, n_frames_out), bcolors.HEADER))
-                sys.stdout.flush()
+    reprocessed = finish_center_refinement(refinement, metadata, filter_all, filter_all_dexp)
+    out_data = store_reprocessed(reprocessed, out_data, my_indexes, network_metadata, metadata, frame_times)
 
-        #Sending frames to socket
-        if output_socket and (frames_ready // output_buffer_size >= 1 or number == total_input_frames - 1):
+    missing = [i for i in my_frames if i not in reorder.completed]
 
-            #max_index = min(frames_sent + output_buffer_size, total_output_frames)
-            max_index = frames_sent + n_frames_out
-            min_index = frames_sent
+    if len(missing) > 0:
+        counter("frames_missing", "Output frames with missing exposures at the end of the scan").inc(len(missing))
+        log_rank(WARNING, "\r {} frames missing: {}", len(missing), missing if len(missing) <= 20 else str(missing[:20])[:-1] + ", ...]", c = bcolors.WARNING)
 
-            send_socket_data(out_data, my_indexes, min_index, max_index, network_metadata)
+    return out_data[:output_index], my_indexes
 
-            frames_sent += output_buffer_size
-            frames_ready -= output_buffer_size
-            #print("{} frames sent".format(min(frames_sent, total_output_frames)))
-   
 
-    return out_data, my_indexes
+#With an accumulate mode, the exposures of the repetitions of a position give one output frame
+def process_from_disk(metadata, raw_frames, local_batch_size, filter_all, filter_all_dexp, network_metadata):
 
+    #Exposure frames of each output frame
+    n_frame_exposures = (metadata['double_exposure']+1) * accumulated_exposures(metadata)
 
-def process_from_disk(metadata, raw_frames, local_batch_size, filter_all, filter_all_dexp, network_metadata):
+    #Exposures of an incomplete last position are left out
+    n_total_frames = raw_frames.shape[0] // n_frame_exposures * n_frame_exposures
 
-    n_total_frames = raw_frames.shape[0]
 
+    #if the batch size does not hold whole output frames (in double exposure or accumulating repetitions) we fix that
+    if local_batch_size != None and local_batch_size % n_frame_exposures != 0:
+        local_batch_size += n_frame_exposures - local_batch_size % n_frame_exposures
 
-    #if the batch size is not even in double exposure we fix that
-    if local_batch_size % 2 != 0 and metadata['double_exposure']:
-        local_batch_size += 1
+    #With chunked HDF5 inputs, batches are aligned with the chunks so that each rank reads whole chunks
+    if local_batch_size != None:
+        local_batch_size = chunk_aligned_batch_size(raw_frames, local_batch_size, n_frame_exposures)
 
     #If the batch size is not given or it is too big, we set it up to give work to every rank
     if local_batch_size == None or local_batch_size * mpi_size > n_total_frames:
-        local_batch_size = n_total_frames // mpi_size
+        local_batch_size = max(n_total_frames // mpi_size // n_frame_exposures, 1) * n_frame_exposures
 
     batch_size = mpi_size * local_batch_size
 
@@ -513,10 +1054,10 @@ def process_from_disk(metadata, raw_frames, local_batch_size, filter_all, filter
 
     #This stores the frames indexes that are being process by this mpi rank
     my_indexes = []
-    n_batches = raw_frames.shape[0] // batch_size
+    n_batches = n_total_frames // batch_size
 
     #Here we correct if the total number of frames is not a multiple of batch_size  
-    extra = raw_frames.shape[0] - (n_batches * batch_size)
+    extra = n_total_frames - (n_batches * batch_size)
 
     extra_last_batch = None
     if rank * local_batch_size < extra: 
@@ -525,65 +1066,107 @@ def process_from_disk(metadata, raw_frames, local_batch_size, filter_all, filter
         #We always overshot the batch sizes if they don't match perfectly (that is when extra % local_batch_size != 0)
         #To account for this, we need to have an index substraction (extra_last_batch) for last rank accross the ones having extra work
         if rank == n_ranks_extra - 1 and extra % local_batch_size != 0: 
-            extra_last_batch = - (local_batch_size - (extra % local_batch_size)) // (metadata['double_exposure']+1)     
+            extra_last_batch = - (local_batch_size - (extra % local_batch_size)) // n_frame_exposures     
 
-    n_out_frames = n_batches * local_batch_size //(metadata['double_exposure']+1)    
+    n_out_frames = n_batches * local_batch_size //n_frame_exposures    
 
     out_data_shape = (n_out_frames , metadata["output_frame_width"], metadata["output_frame_width"])
-    out_data = np.empty(out_data_shape,dtype=np.float32)
-    frames_batch = npo.empty((local_batch_size, raw_frames[0].shape[0], raw_frames[0].shape[1]))
+    out_data = np.empty(out_data_shape,dtype=output_dtype(metadata))
+
+    #Input frames ranges [local_i, upper_bound) of this rank for each batch
+    batch_ranges = []
+    for i in range(0, n_batches):
+        local_i = ((i * batch_size) + (rank * local_batch_size)) 
+        #we handle uneven shapes here
+        batch_ranges.append((local_i, min(local_i  + local_batch_size, n_total_frames)))
+
+    #The next batch is read from disk in the background while the current one is computed
+    batches = prefetch_batches(raw_frames, batch_ranges, local_batch_size)
 
     #Streaming variables
     frames_ready = 0
     frames_sent = 0
     streaming_output_buffer_size = 12
     output_socket = "intermediate_socket" in network_metadata
+    frame_times = {}
+
+    #With a fast start, the center is refined from the first batches
+    refinement = start_center_refinement(metadata)
 
     for i in range(0, n_batches):
 
-        local_i = ((i * batch_size) + (rank * local_batch_size)) 
+        local_i, upper_bound = batch_ranges[i]
 
-        #we handle uneven shapes here
-        upper_bound = min(local_i  + local_batch_size, n_total_frames)
-
-        local_range = range(local_i // (metadata['double_exposure']+1) , upper_bound // (metadata['double_exposure']+1))
+        local_range = range(local_i // n_frame_exposures , upper_bound // n_frame_exposures)
 
         my_indexes.extend(local_range)
 
-        i_s = i * local_batch_size // (metadata['double_exposure']+1)
-        i_e = i_s + local_batch_size // (metadata['double_exposure']+1)
+        i_s = i * local_batch_size // n_frame_exposures
+        i_e = i_s + local_batch_size // n_frame_exposures
 
-        for j in range(local_i, upper_bound) : 
-            frames_batch[j % local_batch_size] = raw_frames[j][:, :]
+        profiling.batch(i)
 
-        if metadata["double_exposure"]:
-            centered_rescaled_frames_jax = filter_all_dexp(frames_batch[:-1:2], frames_batch[1::2])
-        else:
-            centered_rescaled_frames_jax = filter_all(frames_batch)
+        #Waiting time for the prefetched batch, reads themselves are timed as disk_read
+        with timed("batch_assembly"):
+            frames_batch = next(batches)
+
+        compute_start = time.time()
+
+        inputs = (frames_batch[:-1:2], frames_batch[1::2]) if metadata["double_exposure"] else (frames_batch,)
+
+        with timed("compute"):
+            if metadata["double_exposure"]:
+                centered_rescaled_frames_jax, preview = split_preview(filter_all_dexp(*inputs))
+            else:
+                centered_rescaled_frames_jax, preview = split_preview(filter_all(*inputs))
+
+            #frames_batch goes back to the prefetching buffers on the next iteration, so the computation has to be done with it
+            centered_rescaled_frames_jax.block_until_ready()
+
+        compute_end = time.time()
+
+        if output_socket:
+            for index in local_range:
+                frame_times[index] = {"compute_start": compute_start, "compute_end": compute_end}
+
+        counter("frames_processed", "Output frames computed").inc(i_e - i_s)
 
         # TODO: 'centered_rescaled_frames_jax' picks up an additional dimension somehow, should fix this...
         #out_data = jax.ops.index_update(out_data, jax.ops.index[i_s:i_e, :, :], centered_rescaled_frames_jax[:,0,:,:])
         out_data = out_data.at[i_s:i_e, :, :].set(centered_rescaled_frames_jax[:,0,:,:])
 
+        if extra_last_batch is not None and i == n_batches - 1: 
+            i_e += extra_last_batch #extra_last_batch is a negative offset, we add it here
+
         if rank == 0:
-            sys.stdout.write(color("\r Computing batch = %s/%s " %(i+1,n_batches), bcolors.HEADER))
-            sys.stdout.flush()
+            log(INFO, "\r Computing batch = {}/{}", i + 1, n_batches, c = bcolors.HEADER, rate_limited = i < n_batches - 1, key = "computing batch")
 
         frames_ready += (i_e - i_s)
 
         #Sending frames to socket
         if output_socket:
 
-            if extra_last_batch is not None and i == n_batches - 1: 
-                i_e += extra_last_batch #extra_last_batch is a negative offset, we add it here
+            #unless they wait for the refined center
+            if not holds_output(refinement):
+                send_socket_data(out_data, my_indexes, i_s, i_e, network_metadata, frame_times, metadata.get("timestamps", False))
+
+            if preview is not None:
+                send_preview(preview, local_range, network_metadata)
+
+        reprocessed = refine_center(refinement, metadata, filter_all, filter_all_dexp, inputs, centered_rescaled_frames_jax, (i_s, i_e))
+        out_data = store_reprocessed(reprocessed, out_data, my_indexes, network_metadata, metadata, frame_times)
 
-            send_socket_data(out_data, my_indexes, i_s, i_e, network_metadata)
+    reprocessed = finish_center_refinement(refinement, metadata, filter_all, filter_all_dexp)
+    out_data = store_reprocessed(reprocessed, out_data, my_indexes, network_metadata, metadata, frame_times)
 
-    if rank == 0: print("\n")
     return out_data[:extra_last_batch], my_indexes
 
 
-def save_results(fname, metadata, local_data, my_indexes, n_frames):
+#Frames encoded at a time into the sparse layout of the cxi file
+sparse_batch_size = 64
+
+#communicator is the one of the gathers, a duplicate of the default one when saving in the background (see writer.py)
+def save_results(fname, metadata, local_data, my_indexes, n_frames, communicator = None):
 
     nexus_file = cxi_file = True
 
@@ -591,18 +1174,31 @@ def save_results(fname, metadata, local_data, my_indexes, n_frames):
     
     print(npo.max(local_data))
 
-    frames_gather = gather(local_data, (n_frames, local_data[0].shape[0], local_data[0].shape[1]), n_elements, npo.float32)  
+    #Frames can be missing in streaming mode, they are gathered as they are
+    with timed("gather"):
+        frames_gather = gather(local_data, (None, metadata["output_frame_width"], metadata["output_frame_width"]), n_elements, npo.dtype(local_data.dtype).type, communicator)  
 
-    #we need the indexes too to map properly each gathered frame
-    index_gather = gather(my_indexes, n_frames, len(my_indexes), npo.int32)
+        #we need the indexes too to map properly each gathered frame
+        index_gather = gather(my_indexes, (None,), len(my_indexes), npo.int32, communicator)
 
 
     if rank == 0:
 
-        #Here we generate a proper index pull map, with respect to the input
-        index_gather = npo.array([ npo.where(index_gather==i)[0][0] for i in range(0,len(index_gather))])
+        #Frames in the order of the input, the missing ones are zeros flagged in missing_frames
+        missing_frames = npo.ones(n_frames, dtype = bool)
+        missing_frames[index_gather] = False
+
+        if npo.any(missing_frames):
+            frames_all = npo.zeros((n_frames,) + frames_gather.shape[1:], dtype = frames_gather.dtype)
+            frames_all[index_gather] = frames_gather
+            frames_gather = frames_all
+
+            log(WARNING, color("\r {} of {} frames missing, saved as zeros".format(npo.sum(missing_frames), n_frames), bcolors.WARNING))
+
+        else:
+            frames_gather[index_gather,:,:] = frames_gather.copy()
 
-        frames_gather[:,:,:] = frames_gather[index_gather,:,:]
+        frames_gather = narrow_photon_counts(frames_gather)
 
         printv(color("\r Final output data size: {}".format(frames_gather.shape), bcolors.HEADER))
 
@@ -631,22 +1227,38 @@ def save_results(fname, metadata, local_data, my_indexes, n_frames):
             except OSError:
                 pass
 
-            io.write(cxi_filename, metadata, data_format = io.metadataFormat) #We generate a new cxi with the new data
+            with timed("hdf5_write"):
+                io.write(cxi_filename, metadata, data_format = io.metadataFormat) #We generate a new cxi with the new data
+
+                #Sparse frames replace entry_1/data_1/data, see sparse.read_cxi
+                if metadata.get("sparse_cxi", False):
+                    import h5py
+                    fid = h5py.File(cxi_filename, "a")
+
+                    with timed("sparse_encode"):
+                        sparse_frames = sparse.concatenate([to_sparse(frames_gather[i:i + sparse_batch_size]) for i in range(0, frames_gather.shape[0], sparse_batch_size)])
+
+                    sparse.write_cxi(fid, sparse_frames)
+
+                    printv(color("\r Sparse frames: {} nonzero pixels, {:.1f}% of the frames".format(sparse_frames["values"].size, 100 * sparse_frames["values"].size / frames_gather.size), bcolors.HEADER))
 
-            data_shape = frames_gather.shape
-            out_frames, fid = frames_out(cxi_filename, data_shape)  
+                else:
+                    data_shape = frames_gather.shape
+                    out_frames, fid = frames_out(cxi_filename, data_shape, frames_gather.dtype)  
 
 
-            dset = fid.create_dataset('entry_1/instrument_1/detector_1/probe', data = probe)
-            dset = fid.create_dataset('entry_1/instrument_1/detector_1/data_illumination', data = probe)
-            dset = fid.create_dataset('entry_1/instrument_1/source_1/probe', data = probe)
-            dset = fid.create_dataset('entry_1/instrument_1/source_1/data_illumination', data = probe)
-            dset = fid.create_dataset('entry_1/instrument_1/source_1/illumination', data = probe)
-            dset = fid.create_dataset('entry_1/instrument_1/detector_1/probe_mask', data = pMask)
+                dset = fid.create_dataset('entry_1/instrument_1/detector_1/probe', data = probe)
+                dset = fid.create_dataset('entry_1/instrument_1/detector_1/data_illumination', data = probe)
+                dset = fid.create_dataset('entry_1/instrument_1/source_1/probe', data = probe)
+                dset = fid.create_dataset('entry_1/instrument_1/source_1/data_illumination', data = probe)
+                dset = fid.create_dataset('entry_1/instrument_1/source_1/illumination', data = probe)
+                dset = fid.create_dataset('entry_1/instrument_1/detector_1/probe_mask', data = pMask)
+                dset = fid.create_dataset('entry_1/data_1/missing_frames', data = missing_frames)
 
-            out_frames[:, :, :] = frames_gather[:, :, :]
+                if not metadata.get("sparse_cxi", False):
+                    out_frames[:, :, :] = frames_gather[:, :, :]
 
-            fid.close()
+                fid.close()
 
         if nexus_file:
 
@@ -665,10 +1277,11 @@ def save_results(fname, metadata, local_data, my_indexes, n_frames):
             metadata["z_translations"] = metadata["translations"][:,2]
 
             data_format = nexus_data
-            #writing data
-            write(nexus_filename, {"data": frames_gather}, data_format = nexus_data)
-            #writing metadata
-            write(nexus_filename, metadata, data_format = {**nexus_metadata, **cosmic_metadata})
+            with timed("hdf5_write"):
+                #writing data
+                write(nexus_filename, {"data": frames_gather}, data_format = nexus_data)
+                #writing metadata
+                write(nexus_filename, metadata, data_format = {**nexus_metadata, **cosmic_metadata})
 
 
         
@@ -0,0 +1,102 @@
+"""
+    Profiling switches of production runs, each rank writes into its own directory <profile_dir>/rank<N>:
+
+    - XLA HLO dumps of the compiled kernels (hlo/), set up before JAX initializes its backend.
+    - A JAX profiler trace of a window of batches (jax_trace/), to open with TensorBoard or ui.perfetto.dev.
+    - A cProfile of the python side of rank 0 (cprofile.pstats, and cprofile.txt sorted by cumulative time).
+
+    This module does not import JAX, so that the HLO dump can be set up first.
+"""
+
+import os
+
+from .common import rank, printv, color, bcolors
+
+default_profile_dir = "cosmicp_profile"
+
+rank_dir = None
+
+#Batches [start, stop) of each scan traced with the JAX profiler
+trace_window = None
+tracing = False
+
+profiler = None
+
+
+def rank_profile_dir(profile_dir):
+
+    path = os.path.join(profile_dir, "rank" + str(rank))
+    os.makedirs(path, exist_ok = True)
+
+    return path
+
+
+def setup(options):
+    """Sets up the profiling requested in options, has to be called before importing JAX"""
+
+    global rank_dir, trace_window, profiler
+
+    if not (options["hlo_dump"] or options["jax_trace"] is not None or options["cprofile"]):
+        return
+
+    rank_dir = rank_profile_dir(options["profile_dir"])
+
+    if options["hlo_dump"]:
+        #Appended to the flags given by the user, if any. The batch kernels are jitted lambdas (see prepare_filter_functions),
+        #this leaves out the many small jitted operations
+        flags = "--xla_dump_to={} --xla_dump_hlo_as_text --xla_dump_hlo_module_re=.*lambda.*".format(os.path.join(rank_dir, "hlo"))
+        os.environ["XLA_FLAGS"] = (os.environ.get("XLA_FLAGS", "") + " " + flags).strip()
+
+    if options["jax_trace"] is not None:
+        trace_window = options["jax_trace"]
+
+    if options["cprofile"] and rank == 0:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    printv(color("\r Profiling output of this rank in " + rank_dir, bcolors.HEADER))
+
+
+def batch(i):
+    """Called before processing batch i of a scan, starts or stops the JAX profiler trace at the window limits"""
+
+    global tracing
+
+    if trace_window is None:
+        return
+
+    import jax
+
+    if not tracing and trace_window[0] <= i < trace_window[1]:
+        jax.profiler.start_trace(os.path.join(rank_dir, "jax_trace"))
+        tracing = True
+
+    elif tracing and i >= trace_window[1]:
+        jax.profiler.stop_trace()
+        tracing = False
+
+
+def end_of_scan():
+    """Stops the JAX profiler trace if the scan ended inside the window, and writes the cProfile statistics so far"""
+
+    global tracing
+
+    if tracing:
+        import jax
+
+        jax.profiler.stop_trace()
+        tracing = False
+
+    if profiler is not None:
+        import pstats
+
+        profiler.disable()
+
+        profiler.dump_stats(os.path.join(rank_dir, "cprofile.pstats"))
+
+        with open(os.path.join(rank_dir, "cprofile.txt"), "w") as f:
+            pstats.Stats(profiler, stream = f).sort_stats("cumulative").print_stats(60)
+
+        profiler.enable()
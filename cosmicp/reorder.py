@@ -0,0 +1,94 @@
+"""
+    Reordering of the input frames in streaming mode. With several framegrabbers or router hops, frames arrive out of order,
+    and the long and short exposures of a double exposure scan are not strictly interleaved anymore.
+"""
+
+import time
+
+from .metrics import counter
+
+
+class ReorderBuffer:
+    """Assembles the exposures of output frames, received in any order, into complete frames taken in batches of batch_size.
+    Exposure frame number n is the exposure n % n_exposures of the output frame n // n_exposures.
+
+    Incomplete frames more than max_distance output frames behind the newest frame received are dropped, which bounds the memory,
+    and their exposures arriving later are counted as late. Exposures received twice are counted as duplicates."""
+
+    def __init__(self, n_exposures, batch_size, max_distance):
+
+        self.n_exposures = n_exposures
+        self.batch_size = batch_size
+        self.max_distance = max_distance
+
+        self.exposures = {} #output frame -> {exposure: frame}, until the frame is complete
+        self.times = {} #output frame -> timestamps of its last exposure received
+
+        #Complete frames in the order they were completed, with their completion time
+        self.ready = []
+
+        self.completed = set()
+        self.dropped = set()
+        self.newest = -1
+
+    def add(self, number, frame, times = None):
+        """Adds the exposure frame number, returns False if it was late or a duplicate"""
+
+        index, e = divmod(number, self.n_exposures)
+
+        if index in self.completed or e in self.exposures.get(index, {}):
+            counter("frames_duplicate", "Input frames received twice").inc()
+            return False
+
+        if index in self.dropped or index < self.newest - self.max_distance:
+            counter("frames_late", "Input frames received after their frame was dropped from the reorder buffer").inc()
+            return False
+
+        self.exposures.setdefault(index, {})[e] = frame
+        self.times[index] = times
+
+        if len(self.exposures[index]) == self.n_exposures:
+
+            exposures = self.exposures.pop(index)
+            self.ready.append((index, [exposures[k] for k in range(0, self.n_exposures)], self.times.pop(index), time.time()))
+            self.completed.add(index)
+
+        if index > self.newest:
+            self.newest = index
+            self.evict()
+
+        return True
+
+    def evict(self):
+
+        for index in [i for i in self.exposures if i < self.newest - self.max_distance]:
+
+            counter("frames_incomplete", "Output frames dropped from the reorder buffer with missing exposures").inc()
+
+            del self.exposures[index]
+            del self.times[index]
+            self.dropped.add(index)
+
+    def batch_ready(self, flush_period, end = False):
+        """A full batch is ready, or a partial one waited flush_period seconds or the scan ended"""
+
+        return len(self.ready) >= self.batch_size or (len(self.ready) > 0 and (end or time.time() - self.ready[0][3] >= flush_period))
+
+    def wait_time(self, flush_period):
+        """Seconds until the partial batch is due, None if there is none"""
+
+        if len(self.ready) == 0:
+            return None
+
+        return max(flush_period - (time.time() - self.ready[0][3]), 0.0)
+
+    def pop_batch(self):
+        """Up to batch_size complete frames, as (indexes, exposure frames in order, timestamps)"""
+
+        batch, self.ready = self.ready[:self.batch_size], self.ready[self.batch_size:]
+
+        indexes = [index for index, exposures, times, ready_time in batch]
+        frames = [frame for index, exposures, times, ready_time in batch for frame in exposures]
+        times = [times for index, exposures, times, ready_time in batch]
+
+        return indexes, frames, times
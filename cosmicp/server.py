@@ -0,0 +1,228 @@
+"""
+    Server mode of cosmic.py (--server ADDRESS): the MPI ranks stay alive between scans, with JAX imported and the batch kernels
+    compiled, and preprocess from disk the scans submitted as jobs to rank 0, one at a time in order of submission.
+
+    Requests and replies are JSON objects on a zmq REP socket bound by rank 0 at ADDRESS (IP:PORT, tcp://IP:PORT or ipc://PATH):
+
+    - {"command": "submit", "fname": F, "options": {...}, "metadata": {...}} queues the preprocessing of the scan F (.json, .h5 or
+      packed raw scan). "options" overrides the command line options listed in job_options, and "metadata" the values taken from
+      the configuration file (e.g. "output_frame_width"). Replies {"job": ID, "state": "queued", "position": N}.
+    - {"command": "status"} replies the state of all jobs as {"jobs": [...]}, {"command": "status", "job": ID} the state of one job.
+    - {"command": "shutdown"} stops accepting jobs, the server exits once the queued jobs are done.
+
+    Each job is "queued", "running", "saving" (its results being written in the background), "done" or "failed", with its submission, start and end times, its stage timings and frame
+    counters, or the error that made it fail. Errors are replied as {"error": message}. See scripts/cosmicp_jobs.py for a client.
+"""
+
+import os
+import json
+import time
+import queue
+import threading
+import traceback
+import zmq
+
+from .common import rank, size, comm, printv, log_rank, color, bcolors, endpoint, ERROR
+
+#Command line options that a job can override
+job_options = ["conf_file", "batch_size_per_rank", "io_threads", "photon_counts", "fast_start", "timestamps", "trace"]
+
+scan_extensions = (".json", ".h5", ".raw") #.raw being diskIO.raw_container_extension, not imported here for the clients
+
+#Jobs are sent by rank 0 to the other ranks with this tag, idle ranks poll for them instead of spinning in a collective
+job_tag = 77
+poll_period = 0.2
+
+jobs = {} #job id -> job state, on rank 0
+jobs_lock = threading.Lock()
+job_queue = queue.Queue()
+accepting = True
+
+
+def submit_job(request):
+
+    fname = request.get("fname")
+
+    if not isinstance(fname, str) or not fname.endswith(scan_extensions):
+        return {"error": "fname must be a scan file ending in " + ", ".join(scan_extensions)}
+
+    fname = os.path.abspath(fname)
+
+    if not os.path.exists(fname):
+        return {"error": "No such file: " + fname}
+
+    options = request.get("options", {})
+    unknown = [k for k in options if k not in job_options]
+    if unknown:
+        return {"error": "Options {} can't be set per job, only {}".format(unknown, job_options)}
+
+    with jobs_lock:
+        if not accepting:
+            return {"error": "The server is shutting down"}
+
+        job = {"job": len(jobs), "fname": fname, "options": options, "metadata": request.get("metadata", {}),
+               "state": "queued", "submitted": time.time(), "started": None, "finished": None}
+
+        jobs[job["job"]] = job
+        position = job_queue.qsize()
+
+        job_queue.put(job)
+
+    printv(color("\r Job {} queued: {}".format(job["job"], fname), bcolors.HEADER))
+
+    return {"job": job["job"], "state": "queued", "position": position}
+
+
+def handle_request(request):
+
+    global accepting
+
+    command = request.get("command")
+
+    if command == "submit":
+        return submit_job(request)
+
+    elif command == "status":
+        with jobs_lock:
+            if "job" in request:
+                if request["job"] not in jobs:
+                    return {"error": "Unknown job " + str(request["job"])}
+                return dict(jobs[request["job"]])
+
+            return {"jobs": [dict(job) for job in jobs.values()]}
+
+    elif command == "shutdown":
+        with jobs_lock:
+            if accepting:
+                accepting = False
+                job_queue.put(None)
+
+        return {"state": "shutting down", "queued": job_queue.qsize() - 1}
+
+    return {"error": "Unknown command " + str(command)}
+
+
+def serve(address):
+
+    context = zmq.Context.instance()
+
+    socket = context.socket(zmq.REP)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.bind(endpoint(address))
+
+    while True:
+
+        try:
+            reply = handle_request(json.loads(socket.recv_string()))
+        except Exception as e:
+            reply = {"error": repr(e)}
+
+        socket.send_string(json.dumps(reply))
+
+
+def start(address):
+    """Starts serving job requests at address on rank 0"""
+
+    if rank != 0:
+        return None
+
+    printv(color("\nServing preprocessing jobs at " + endpoint(address) + "\n", bcolors.OKGREEN))
+
+    th = threading.Thread(target = serve, args = (address,), daemon = True)
+    th.start()
+
+    return th
+
+
+def next_job():
+    """Next job to process on all ranks, None when the server shuts down"""
+
+    if rank == 0:
+        job = job_queue.get()
+
+        job_message = None
+
+        if job is not None:
+            with jobs_lock:
+                job["state"] = "running"
+                job["started"] = time.time()
+
+            job_message = {k: job[k] for k in ("job", "fname", "options", "metadata")}
+
+        for r in range(1, size):
+            comm.send(job_message, dest = r, tag = job_tag)
+
+        return job_message
+
+    while not comm.Iprobe(source = 0, tag = job_tag):
+        time.sleep(poll_period)
+
+    return comm.recv(source = 0, tag = job_tag)
+
+
+def job_done(job_message, summary):
+
+    if rank != 0:
+        return
+
+    with jobs_lock:
+        job = jobs[job_message["job"]]
+        job["finished"] = time.time()
+        if job["state"] != "failed":
+            job["state"] = "done" if "saved" in job else "saving"
+        job["duration_s"] = job["finished"] - job["started"]
+        job["stages"] = summary["stages"]
+        job["counters"] = summary["counters"]
+        job["gauges"] = summary["gauges"]
+
+    printv(color("\r Job {} processed in {:.1f}s: {}".format(job["job"], job["duration_s"], job["fname"]), bcolors.OKGREEN))
+
+
+def job_saved(job_message, exception = None):
+    """Called once the results of a job are saved, or failed to, which can be after job_done when saving in the background"""
+
+    if rank != 0:
+        return
+
+    with jobs_lock:
+        job = jobs[job_message["job"]]
+        job["saved"] = time.time()
+
+        if exception is not None:
+            job["state"] = "failed"
+            job["error"] = repr(exception)
+
+        elif job["state"] == "saving":
+            job["state"] = "done"
+
+
+def job_failed(job_message, exception):
+
+    log_rank(ERROR, "\r Job {} failed: {}\n{}", job_message["job"], repr(exception), traceback.format_exc(), c = bcolors.FAIL)
+
+    if rank != 0:
+        return
+
+    with jobs_lock:
+        job = jobs[job_message["job"]]
+        job["finished"] = time.time()
+        job["state"] = "failed"
+        job["duration_s"] = job["finished"] - job["started"]
+        job["error"] = repr(exception)
+
+
+def request(address, message, timeout = 10.0):
+    """Sends a request to a server at address and returns its reply"""
+
+    context = zmq.Context.instance()
+
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+    socket.connect(endpoint(address))
+
+    try:
+        socket.send_string(json.dumps(message))
+        return json.loads(socket.recv_string())
+    finally:
+        socket.close()
@@ -0,0 +1,110 @@
+"""
+    Shared memory ring of output frames, for consumers on the same host as the preprocessor: each rank copies its output
+    blocks into the slots of a shared memory segment, and the zmq messages only carry descriptors of the slots.
+
+    A slot is written again slots messages later, without waiting for the consumers. Each slot starts with the sequence number
+    of the message it holds, -1 while it is written, so that a consumer finds out when it read a slot too late.
+"""
+
+import atexit
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+#Slots are aligned to cache lines
+alignment = 64
+
+#Segments attached by a consumer, by name
+attached = {}
+
+
+class ShmRing:
+    """slots slots of slot_bytes bytes in a new shared memory segment, removed at exit"""
+
+    def __init__(self, slots, slot_bytes):
+
+        self.slots = slots
+        self.slot_bytes = -(-slot_bytes // alignment) * alignment
+        self.data_offset = -(-slots * 8 // alignment) * alignment
+
+        self.segment = shared_memory.SharedMemory(create = True, size = self.data_offset + slots * self.slot_bytes)
+
+        self.headers = np.ndarray((slots,), np.int64, buffer = self.segment.buf)
+        self.headers[:] = -1
+
+        self.sequence = 0
+
+        atexit.register(self.close)
+
+    def write(self, block):
+        """Copies the block (a numpy array) into the next slot, returns its descriptor"""
+
+        slot = self.sequence % self.slots
+        offset = self.data_offset + slot * self.slot_bytes
+
+        self.headers[slot] = -1
+        np.ndarray(block.shape, block.dtype, buffer = self.segment.buf, offset = offset)[...] = block
+        self.headers[slot] = self.sequence
+
+        descriptor = {"shm": self.segment.name, "slot": slot, "sequence": self.sequence, "offset": offset,
+                      "dtype": block.dtype.str, "shape": list(block.shape)}
+
+        self.sequence += 1
+
+        return descriptor
+
+    def close(self):
+
+        if self.segment is None:
+            return
+
+        self.headers = None
+        self.segment.close()
+        self.segment.unlink()
+        self.segment = None
+
+
+def ring(current, slots, nbytes):
+    """current ring if its slots hold nbytes, or a new one (e.g. for the larger frames of a new scan)"""
+
+    if current is not None and current.slot_bytes >= nbytes:
+        return current
+
+    if current is not None:
+        current.close()
+
+    return ShmRing(slots, nbytes)
+
+
+def attach(name):
+
+    if name not in attached:
+
+        segment = shared_memory.SharedMemory(name = name)
+
+        #The segment belongs to the preprocessor, it must not be removed when the consumer exits
+        resource_tracker.unregister(segment._name, "shared_memory")
+
+        attached[name] = segment
+
+    return attached[name]
+
+
+def read(descriptor):
+    """Copy of the block of a descriptor, None if its slot was written again before it was read"""
+
+    try:
+        segment = attach(descriptor["shm"])
+    except FileNotFoundError:
+        return None
+
+    headers = np.ndarray((descriptor["slot"] + 1,), np.int64, buffer = segment.buf)
+
+    if headers[descriptor["slot"]] != descriptor["sequence"]:
+        return None
+
+    block = np.ndarray(descriptor["shape"], np.dtype(descriptor["dtype"]), buffer = segment.buf, offset = descriptor["offset"]).copy()
+
+    if headers[descriptor["slot"]] != descriptor["sequence"]:
+        return None
+
+    return block
@@ -0,0 +1,79 @@
+"""
+    Sparse (CSR) encoding of output frames, which are mostly zeros after the thresholding and clamping of the preprocessing.
+
+    A block of n frames of shape (w, w) is {"sparse": "csr", "shape": [n, w, w], "counts": number of nonzero pixels of each frame,
+    "indices": flat pixel index of each nonzero pixel, "values": its value}, the pixels of the frames following each other in order.
+    The encoding runs on the backend (preprocessor.to_sparse), the functions here only need numpy, for the readers.
+"""
+
+import numpy as np
+
+#Layout of the sparse frames in a cxi file, instead of entry_1/data_1/data
+cxi_group = "entry_1/data_1/sparse"
+
+
+def index_dtype(frame_size):
+    return np.uint16 if frame_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+def sparse_to_dense(sparse):
+    """Dense frames of a sparse block"""
+
+    n, height, width = sparse["shape"]
+
+    counts = np.asarray(sparse["counts"], dtype = np.int64)
+    values = np.asarray(sparse["values"])
+
+    frames = np.zeros((n, height * width), dtype = values.dtype)
+
+    rows = np.repeat(np.arange(n), counts)
+    frames[rows, np.asarray(sparse["indices"], dtype = np.int64)] = values
+
+    return frames.reshape(n, height, width)
+
+
+def concatenate(blocks):
+    """One sparse block of the frames of several blocks, in order"""
+
+    return {"sparse": "csr",
+            "shape": [sum(b["shape"][0] for b in blocks)] + list(blocks[0]["shape"][1:]),
+            "counts": np.concatenate([b["counts"] for b in blocks]),
+            "indices": np.concatenate([b["indices"] for b in blocks]),
+            "values": np.concatenate([b["values"] for b in blocks])}
+
+
+def write_cxi(fid, sparse):
+    """Writes a sparse block into the cxi file fid (h5py), see read_cxi"""
+
+    group = fid.require_group(cxi_group)
+    group.attrs["shape"] = sparse["shape"]
+    group.attrs["axes"] = "translation:y:x"
+
+    group.create_dataset("counts", data = sparse["counts"])
+    group.create_dataset("indptr", data = np.concatenate([[0], np.cumsum(sparse["counts"], dtype = np.int64)]))
+    group.create_dataset("indices", data = sparse["indices"])
+    group.create_dataset("values", data = sparse["values"])
+
+
+def read_cxi(fid, indexes = None):
+    """Dense frames of the sparse layout of the cxi file fid (h5py), all of them or those of indexes"""
+
+    group = fid[cxi_group]
+
+    n, height, width = group.attrs["shape"]
+
+    if indexes is None:
+        return sparse_to_dense({"sparse": "csr", "shape": [n, height, width], "counts": group["counts"][()],
+                                "indices": group["indices"][()], "values": group["values"][()]})
+
+    indptr = group["indptr"][()]
+
+    blocks = []
+    for i in indexes:
+        blocks.append({"sparse": "csr", "shape": [1, height, width], "counts": np.array([indptr[i + 1] - indptr[i]]),
+                       "indices": group["indices"][indptr[i]:indptr[i + 1]], "values": group["values"][indptr[i]:indptr[i + 1]]})
+
+    if len(blocks) == 0:
+        return np.zeros((0, height, width), dtype = group["values"].dtype)
+
+    return sparse_to_dense(concatenate(blocks))
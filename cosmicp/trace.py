@@ -0,0 +1,69 @@
+"""
+    Optional trace of the preprocessing in the Chrome trace event format (chrome://tracing, https://ui.perfetto.dev).
+
+    Each MPI rank is shown as a process, with the stages timed by metrics.timed on the thread running them
+    and the lifetime of each output frame, from its reception to its sending, on a "frames" track.
+"""
+
+import json
+import threading
+
+from .common import rank, size, comm
+
+enabled = False
+
+lock = threading.Lock()
+events = []
+
+
+def enable():
+
+    global enabled
+    enabled = True
+
+
+def complete(name, start, end, tid = None, args = None):
+    """Adds an event from start to end (time.time() seconds), on the calling thread track by default"""
+
+    if not enabled:
+        return
+
+    event = {"name": name, "ph": "X", "pid": rank, "tid": tid or threading.current_thread().name,
+             "ts": start * 1e6, "dur": max(end - start, 0.0) * 1e6}
+
+    if args is not None:
+        event["args"] = args
+
+    with lock:
+        events.append(event)
+
+
+def frame(index, frame_times):
+    """Adds the lifetime of an output frame, given its timestamps"""
+
+    start = frame_times.get("receive") or frame_times.get("compute_start")
+
+    if start is not None:
+        complete("frame " + str(index), start, frame_times["send"], "frames", frame_times)
+
+
+def dump(fname):
+    """Gathers the events of all ranks into fname (collective), then clears them"""
+
+    global events
+
+    with lock:
+        local, events = events, []
+
+    all_events = comm.gather(local) if comm is not None and size > 1 else [local]
+
+    if rank != 0:
+        return
+
+    trace = {"traceEvents": [e for rank_events in all_events for e in rank_events], "displayTimeUnit": "ms"}
+
+    for r in range(0, len(all_events)):
+        trace["traceEvents"].append({"name": "process_name", "ph": "M", "pid": r, "args": {"name": "MPI rank " + str(r)}})
+
+    with open(fname, "w") as f:
+        json.dump(trace, f)
@@ -0,0 +1,77 @@
+"""
+    Saving of the results of a scan in the background (keep-running and server modes): the output frames of scan k are gathered
+    and written to disk by a thread, while the main thread goes on with the metadata, dark frames and processing of scan k + 1.
+
+    The gathers run on a duplicate of the MPI communicator, so that they never match the collectives of the next scan, and
+    the scans are saved one at a time, in the order they were processed, on every rank. At most pending_saves scans wait for
+    their turn besides the one being written, then the main thread waits for the writer, so that the memory used is bounded.
+"""
+
+import queue
+import threading
+
+from .common import comm, mpi_enabled, log, log_rank, color, bcolors, ERROR, WARNING
+from .metrics import timed
+from .preprocessor import save_results
+
+save_queue = None
+save_comm = None
+
+
+def start(pending_saves = 1):
+    """Starts the writer thread (collective), returns False if MPI can't run the gathers from a thread"""
+
+    global save_queue, save_comm
+
+    if mpi_enabled:
+        from mpi4py import MPI
+
+        if MPI.Query_thread() < MPI.THREAD_MULTIPLE:
+            log(WARNING, color("\r MPI does not support MPI_THREAD_MULTIPLE, the results are saved in the foreground", bcolors.WARNING))
+            return False
+
+        save_comm = comm.Dup()
+
+    save_queue = queue.Queue(maxsize = pending_saves)
+
+    th = threading.Thread(target = writer, name = "writer", daemon = True)
+    th.start()
+
+    return True
+
+
+def writer():
+
+    while True:
+
+        fname, metadata, out_data, my_indexes, n_frames, saved = save_queue.get()
+
+        try:
+            save_results(fname, metadata, out_data, my_indexes, n_frames, save_comm)
+
+            if saved is not None:
+                saved()
+
+        except Exception as e:
+            log_rank(ERROR, "\r Saving the results of {} failed: {}", fname, repr(e), c = bcolors.FAIL)
+
+            if saved is not None:
+                saved(e)
+
+        finally:
+            save_queue.task_done()
+
+
+def save(fname, metadata, out_data, my_indexes, n_frames, saved = None):
+    """Queues the results of a scan to be saved as save_results does, then calls saved(), or saved(exception) if saving failed.
+    Waits while pending_saves scans are already waiting."""
+
+    with timed("save_wait"):
+        save_queue.put((fname, metadata, out_data, my_indexes, n_frames, saved))
+
+
+def finish():
+    """Waits until all the queued results are saved"""
+
+    if save_queue is not None:
+        save_queue.join()
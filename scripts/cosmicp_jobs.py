@@ -0,0 +1,119 @@
+"""
+Submits scans to a cosmic.py server (cosmic.py --server ADDRESS) and follows their preprocessing.
+
+Usage: python cosmicp_jobs.py ADDRESS submit [-o OPTIONS_JSON] [-m METADATA_JSON] [--wait] scan1.h5 [scan2.json ...]
+       python cosmicp_jobs.py ADDRESS status [JOB]
+       python cosmicp_jobs.py ADDRESS wait [JOB ...]
+       python cosmicp_jobs.py ADDRESS shutdown
+
+OPTIONS_JSON overrides command line options of the server for these jobs, e.g. '{"batch_size_per_rank": 8, "photon_counts": true}',
+and METADATA_JSON values of the configuration file, e.g. '{"output_frame_width": 128}'.
+wait returns once the given jobs (all by default) are done or failed, and prints their timings.
+"""
+
+import sys
+import json
+import time
+import getopt
+from cosmicp.server import request
+
+
+def print_jobs(jobs):
+
+    print("{:>5}  {:<8}{:>10}{:>10}  {}".format("job", "state", "wait (s)", "run (s)", "scan"))
+
+    for job in jobs:
+
+        waited = (job["started"] or time.time()) - job["submitted"]
+        ran = (job["finished"] or time.time()) - job["started"] if job["started"] else 0.0
+
+        print("{:>5}  {:<8}{:>10.1f}{:>10.1f}  {}".format(job["job"], job["state"], waited, ran, job["fname"]))
+
+        if "error" in job:
+            print("       " + job["error"])
+
+
+def print_stages(job):
+
+    print("\nJob {} stage timings:".format(job["job"]))
+
+    for name, stage in sorted(job.get("stages", {}).items()):
+        print(" {:<30}{:>10}{:>12.3f}".format(name, stage["count"], stage["total_s"]))
+
+    for name, value in sorted(job.get("counters", {}).items()):
+        print(" {:<30}{:>10}".format(name, value))
+
+    for name, value in sorted(job.get("gauges", {}).items()):
+        print(" {:<30}{:>10}  (max {})".format(name, value["value"], value["max"]))
+
+
+def wait(address, job_ids = None, period = 2.0):
+
+    while True:
+        jobs = request(address, {"command": "status"})["jobs"]
+
+        if job_ids:
+            jobs = [job for job in jobs if job["job"] in job_ids]
+
+        if all(job["state"] in ("done", "failed") for job in jobs):
+            return jobs
+
+        time.sleep(period)
+
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+
+    if len(args) < 2:
+        print(__doc__)
+        sys.exit(2)
+
+    address, command, args = args[0], args[1], args[2:]
+
+    if command == "submit":
+
+        opts, fnames = getopt.getopt(args, "o:m:", ["wait"])
+        opts = dict(opts)
+
+        job_ids = []
+        for fname in fnames:
+            reply = request(address, {"command": "submit", "fname": fname, "options": json.loads(opts.get("-o", "{}")),
+                                      "metadata": json.loads(opts.get("-m", "{}"))})
+
+            if "error" in reply:
+                print("{}: {}".format(fname, reply["error"]))
+            else:
+                print("{}: job {}, {} jobs ahead".format(fname, reply["job"], reply["position"]))
+                job_ids.append(reply["job"])
+
+        if "--wait" in opts and job_ids:
+            jobs = wait(address, job_ids)
+            print_jobs(jobs)
+            for job in jobs:
+                print_stages(job)
+
+    elif command == "status":
+
+        reply = request(address, {"command": "status", "job": int(args[0])} if args else {"command": "status"})
+
+        if "error" in reply:
+            print(reply["error"])
+        elif "jobs" in reply:
+            print_jobs(reply["jobs"])
+        else:
+            print_jobs([reply])
+            print_stages(reply)
+
+    elif command == "wait":
+
+        jobs = wait(address, [int(a) for a in args])
+        print_jobs(jobs)
+
+    elif command == "shutdown":
+
+        print(request(address, {"command": "shutdown"}))
+
+    else:
+        print(__doc__)
+        sys.exit(2)
@@ -0,0 +1,25 @@
+"""
+Packs a scan into a single raw frame container, that cosmic.py reads as memory mapped frames.
+
+Reprocessing a scan many times (e.g. tuning the resolution or the output shape) from the container
+skips decoding thousands of TIFF files on every run.
+
+Usage: python pack_raw_scan.py scan_info.json|raw_data.h5 [output.raw]
+"""
+
+import sys
+from cosmicp.diskIO import pack_raw_container
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+
+    if len(args) not in (1, 2):
+        print(__doc__)
+        sys.exit(2)
+
+    out_fname = args[1] if len(args) == 2 else None
+
+    out_fname = pack_raw_container(args[0], out_fname)
+
+    print("\nRaw frame container written to " + out_fname)
@@ -5,11 +5,14 @@ Can actualluy be deleted once the framegrabbing is stable
 """
 
 
+import os
 import socket
 import time
 import urllib.request, urllib.error, urllib.parse
 import zmq
 import cosmicp.udpframereader as udpr
+from cosmicp import metrics
+from cosmicp.metrics import timed, counter
 
 import numpy as np
 import cupy as cp
@@ -84,12 +87,15 @@ class Framegrabber:
         """receive frames from the FCCD. Return as soon as a new frame is ready, otherwise it is blocking."""
         #print "RECV: ", self.camera_socket.fileno(), self.fsize
         
-        pkg = udpr.read_frame(self.camera_socket.fileno(), self.fsize)
+        with timed("udp_receive"):
+            pkg = udpr.read_frame(self.camera_socket.fileno(), self.fsize)
         self.fbuffer, fnumber, self.fbytes = pkg
         self.nreceive += 1
+        counter("udp_frames_received", "Frames assembled from the UDP stream").inc()
 
         if fnumber > self.fnumber1:
             print("Dropped Frame(s) range %d - %d" % (self.fnumber1, fnumber))
+            counter("udp_frames_dropped", "Frames missing in the UDP stream").inc(fnumber - self.fnumber1)
         self.fnumber1 = fnumber + 1
         
         if (self.nreceive == self.updaterate):
@@ -120,7 +126,8 @@ class Framegrabber:
             ii +=1
             self._recvframe()
             t = time.time()
-            self._sendframe()
+            with timed("udp_send"):
+                self._sendframe()
             ts = time.time()-t
             tsend = 0.05*ts + 0.95*tsend
             if ii % 40 == 0: 
@@ -134,6 +141,15 @@ if __name__=='__main__':
     #FG=Framegrabber(2*1152*1040,read_addr= "10.0.5.55:49205",send_addr ="127.0.0.1:49206",udp_addr ="10.0.5.207:49203")
     ## Simulation with test_stxmcontrol:
     FG=Framegrabber(2*1152*1040,read_addr="127.0.0.1:49205",send_addr="127.0.0.1:49206",udp_addr ="127.0.0.1:49203")
+    ## Prometheus metrics of the framegrabber, off unless FRAMEGRABBER_METRICS_PORT is set (e.g. 9120 for http://localhost:9120/metrics),
+    ## served on FRAMEGRABBER_METRICS_HOST, localhost only by default
+    metrics_port = os.environ.get("FRAMEGRABBER_METRICS_PORT")
+    if metrics_port:
+        metrics_host = os.environ.get("FRAMEGRABBER_METRICS_HOST", "127.0.0.1")
+        try:
+            metrics.start_http_server(int(metrics_port), metrics_host)
+        except OSError as e:
+            print("Metrics not served on %s:%s: %s" % (metrics_host, metrics_port, e))
     FG.createReadFrameSocket()
     FG.createSendFrameSocket()
     FG.run()
@@ -0,0 +1,113 @@
+"""
+Benchmark of the raw frame reads from a raw_data.h5 input, on a synthetic chunked file.
+
+Compares the former per-frame reads of process_from_disk (one HDF5 read call per frame) with the bulk
+reads of diskIO.read_batch, and with prefetch_batches overlapping the reads with a fake compute step.
+
+Usage: python bench_h5_read.py [n_frames] [batch_size] [chunk_frames] [compressed]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import h5py
+
+from timeit import default_timer as timer
+
+from cosmicp.diskIO import read_batch, prefetch_batches, chunk_aligned_batch_size
+
+raw_frame_shape = (1040, 1152)
+
+
+def make_file(fname, n_frames, chunk_frames, compressed):
+
+    rng = np.random.default_rng(0)
+
+    compression = "gzip" if compressed else None
+
+    with h5py.File(fname, "w") as f:
+        dset = f.create_dataset("entry_1/data_1/exp_frames", (n_frames,) + raw_frame_shape, dtype = np.uint16,
+                                chunks = (chunk_frames,) + raw_frame_shape, compression = compression)
+
+        #Dark level plus read noise, the compressed case is then close to real data
+        for i in range(0, n_frames, chunk_frames):
+            n = min(chunk_frames, n_frames - i)
+            dset[i:i + n] = rng.normal(10000, 5, (n,) + raw_frame_shape).astype(np.uint16)
+
+
+def batch_ranges(n_frames, batch_size):
+    return [(i, min(i + batch_size, n_frames)) for i in range(0, n_frames, batch_size)]
+
+
+def per_frame_reads(dset, batch_size):
+
+    frames_batch = np.empty((batch_size,) + raw_frame_shape)
+
+    for start, stop in batch_ranges(dset.shape[0], batch_size):
+        for j in range(start, stop):
+            frames_batch[j % batch_size] = dset[j][:, :]
+
+
+def bulk_reads(dset, batch_size):
+
+    frames_batch = np.empty((batch_size,) + raw_frame_shape, dtype = dset.dtype)
+
+    for start, stop in batch_ranges(dset.shape[0], batch_size):
+        read_batch(dset, start, stop, frames_batch[:stop - start])
+
+
+def prefetched_reads(dset, batch_size, compute_time):
+
+    ranges = batch_ranges(dset.shape[0], batch_size)
+
+    for frames_batch in prefetch_batches(dset, ranges, batch_size):
+        time.sleep(compute_time)
+
+
+def main():
+
+    args = sys.argv[1:]
+
+    n_frames = int(args[0]) if len(args) > 0 else 200
+    batch_size = int(args[1]) if len(args) > 1 else 20
+    chunk_frames = int(args[2]) if len(args) > 2 else 1
+    compressed = len(args) > 3 and args[3] == "1"
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        fname = os.path.join(tmp, "raw_data.h5")
+
+        print("Writing {} frames of {}, {} frames per chunk, compressed = {}".format(n_frames, raw_frame_shape, chunk_frames, compressed))
+        make_file(fname, n_frames, chunk_frames, compressed)
+
+        with h5py.File(fname, "r") as f:
+
+            dset = f["entry_1/data_1/exp_frames"]
+
+            aligned_batch_size = chunk_aligned_batch_size(dset, batch_size)
+
+            print("Batch size = {}, chunk aligned batch size = {}".format(batch_size, aligned_batch_size))
+
+            start = timer()
+            per_frame_reads(dset, batch_size)
+            t_frames = timer() - start
+            print("Per frame reads:  {:.3f}s, {:.2f}ms / frame".format(t_frames, 1000 * t_frames / n_frames))
+
+            start = timer()
+            bulk_reads(dset, aligned_batch_size)
+            t_bulk = timer() - start
+            print("Bulk reads:       {:.3f}s, {:.2f}ms / frame".format(t_bulk, 1000 * t_bulk / n_frames))
+
+            #The fake compute takes as long as the reads, so a perfect overlap halves the total time
+            compute_time = t_bulk / len(batch_ranges(n_frames, aligned_batch_size))
+
+            start = timer()
+            prefetched_reads(dset, aligned_batch_size, compute_time)
+            t_prefetch = timer() - start
+            print("Prefetched reads with {:.1f}ms of compute per batch: {:.3f}s, serial would be {:.3f}s".format(1000 * compute_time, t_prefetch, 2 * t_bulk))
+
+
+if __name__ == "__main__":
+    main()
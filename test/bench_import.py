@@ -0,0 +1,101 @@
+"""
+Benchmark of the startup cost of a rank: import times of the cosmicp modules, and of cosmic.py -h, in fresh interpreters.
+
+Each measurement is repeated and the median is reported, with the slowest modules imported (python -X importtime)
+and whether importing initialized the XLA backend, which should only happen once the options are parsed and the sockets set up.
+
+Usage: python bench_import.py [output.json] [repeats]
+"""
+
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+
+from timeit import default_timer as timer
+
+package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+modules = ["cosmicp.options", "cosmicp.network", "cosmicp.darks", "cosmicp.diskIO", "cosmicp.fccd", "cosmicp.preprocessor"]
+
+#Prints whether the XLA backend is up after the import
+backend_check = "import sys; import {}; xb = sys.modules.get('jax._src.xla_bridge'); print(bool(xb is not None and xb._backends))"
+
+
+def environment():
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = package_dir + os.pathsep + env.get("PYTHONPATH", "")
+    env["CUDA_VISIBLE_DEVICES"] = ""
+
+    return env
+
+
+def run_time(cmd):
+
+    start = timer()
+    out = subprocess.run(cmd, env = environment(), stdout = subprocess.PIPE, stderr = subprocess.PIPE, check = True)
+    return timer() - start, out
+
+
+def slowest_imports(module, n = 8):
+    """Modules with the largest cumulative import time when importing module, as (name, seconds)"""
+
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], env = environment(),
+                         stdout = subprocess.PIPE, stderr = subprocess.PIPE, check = True)
+
+    times = []
+    for line in out.stderr.decode().splitlines():
+        if line.startswith("import time:") and "|" in line:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            if cumulative_us.strip().isdigit():
+                times.append((name.strip(), int(cumulative_us) * 1e-6))
+
+    #Only the top level modules of cosmicp dependencies, the nested ones are included in them
+    times = [t for t in times if not t[0].startswith("cosmicp") and "." not in t[0] and t[0] not in ("site", "sitecustomize")]
+
+    return sorted(times, key = lambda t: -t[1])[:n]
+
+
+def main():
+
+    args = sys.argv[1:]
+
+    out_fname = args[0] if len(args) > 0 else "bench_import.json"
+    repeats = int(args[1]) if len(args) > 1 else 5
+
+    results = {}
+
+    #Interpreter start up, subtracted from the rest
+    baseline = np.median([run_time([sys.executable, "-c", "pass"])[0] for i in range(0, repeats)])
+    print("Python start up: {:.3f}s".format(baseline))
+
+    for module in modules:
+
+        times = []
+        for i in range(0, repeats):
+            t, out = run_time([sys.executable, "-c", backend_check.format(module)])
+            times.append(t - baseline)
+
+        backend = out.stdout.decode().strip() == "True"
+
+        results[module] = {"median_s": float(np.median(times)), "min_s": float(np.min(times)), "backend_initialized": backend,
+                           "slowest_imports": slowest_imports(module)}
+
+        print(" import {:<24}{:>8.3f}s{}".format(module, results[module]["median_s"], ", initializes the XLA backend" if backend else ""))
+        print("    " + ", ".join("{} {:.3f}s".format(name, t) for name, t in results[module]["slowest_imports"][:4]))
+
+    times = [run_time([sys.executable, os.path.join(package_dir, "cosmicp", "cosmic.py"), "-h"])[0] - baseline for i in range(0, repeats)]
+    results["cosmic.py -h"] = {"median_s": float(np.median(times)), "min_s": float(np.min(times))}
+
+    print(" {:<31}{:>8.3f}s".format("cosmic.py -h", results["cosmic.py -h"]["median_s"]))
+
+    with open(out_fname, "w") as f:
+        json.dump({"python_startup_s": float(baseline), "repeats": repeats, "results": results}, f, indent = 1)
+
+    print("Results written to " + out_fname)
+
+
+if __name__ == "__main__":
+    main()
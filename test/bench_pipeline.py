@@ -0,0 +1,311 @@
+"""
+CPU benchmark of the preprocessing stages on synthetic FCCD data, no input files nor GPU needed.
+
+Raw frames and darks are simulated as in FccdSimulator (scripts/sim_no_control.py): a zone plate probe over a
+nanoball object, far field diffraction with Poisson noise, detector offset and read noise, scrambled into the raw
+(1040, 1152) layout of the FCCD. Each stage (cleanXraw, combine_double_exposure, filter_frame, shift_rescale) and
+process_from_disk end to end are timed over several batch sizes and output frame widths, results go to a JSON file
+so that they can be compared between commits.
+
+Usage: python bench_pipeline.py [output.json] [batch_sizes] [output_widths] [repeats]
+           batch sizes and output widths as comma separated lists, 2,8 and 128,256 by default
+       python bench_pipeline.py compare old.json new.json
+"""
+
+import os
+import sys
+import json
+import platform
+import subprocess
+import datetime
+
+#Keeps JAX on the CPU, see cosmic.py
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from timeit import default_timer as timer
+
+import cosmicp.fccd as fccd
+import cosmicp.preprocessor as preprocessor
+from cosmicp.common import complete_metadata
+
+conf_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "configuration", "default.json")
+
+raw_frame_shape = (1040, 1152)
+clean_frame_shape = (fccd.heigth, fccd.width)
+
+
+def rawXimg(img):
+    """Inverse of fccd.imgXraw without the filtering: scrambles a (960, 960) clean image into the raw FCCD layout"""
+
+    tif1 = np.zeros((fccd.nrcols, fccd.nbmux * fccd.nbpcol))
+    tif1[4:4 + fccd.ngcols, :fccd.width] = img[:fccd.ngcols]
+    tif1[4:4 + fccd.ngcols, fccd.width:] = np.rot90(img[fccd.ngcols:], 2)
+
+    bblocks = np.zeros((fccd.nrcols, fccd.nbmux, fccd.nbcol))
+    bblocks[:, :, 1:fccd.nbcol - 1] = tif1.reshape(fccd.nrcols, fccd.nbmux, fccd.nbpcol)
+    blocks = bblocks.reshape(fccd.nrcols, fccd.nbmux * fccd.nbcol)
+
+    half = raw_frame_shape[1]
+
+    raw = np.zeros(raw_frame_shape)
+    raw[fccd.nrows1 + 2 * fccd.gap: 2 * fccd.nrows1 + 2 * fccd.gap - 2] = np.rot90(blocks[:, :half], 2)
+    raw[1:fccd.nrows1 - 1] = blocks[:, half:]
+
+    return raw
+
+
+def stxm_probe(shape, inner = 8, outer = 25):
+
+    X, Y = np.indices(shape).astype(float)
+    X -= X.mean()
+    Y -= Y.mean()
+    R = (np.sqrt(X ** 2 + Y ** 2) < outer).astype(complex)
+    r = (np.sqrt(X ** 2 + Y ** 2) > inner).astype(complex)
+    return np.fft.fftshift(np.fft.ifft2(np.fft.fftshift(R * r)))
+
+
+def nanoball_object(shape, rng, rad = 5, num = 400):
+    """Transmission of randomly placed nanoballs, uniformly spread instead of clustered as in FccdSimulator"""
+
+    out = np.zeros(shape)
+    xx, yy = np.indices(shape)
+
+    for c in rng.uniform((0, 0), (shape[0] - 1, shape[1] - 1), (num, 2)):
+        h = rad ** 2 - (xx - c[0]) ** 2 - (yy - c[1]) ** 2
+        h[h < 0] = 0.
+        out += np.sqrt(h)
+
+    return out
+
+
+class SyntheticFCCD:
+    """Raw dark and exposure frames of a raster ptychography scan, with the FccdSimulator parameters"""
+
+    def __init__(self, double_exposure = True, dwell = (100, 20), seed = 1983):
+
+        self.rng = np.random.default_rng(seed)
+
+        self.double_exposure = double_exposure
+        self.dwell = dwell if double_exposure else dwell[:1]
+
+        self.offset = 10000
+        self.io_noise = 5
+        self.photons_per_sec = 2e7
+        self.adu_per_photon = 34
+        self.step = 6 #pixels
+        self.sim_shape = (384, 384)
+
+        self.photons = [self.photons_per_sec * d / 1000 for d in self.dwell]
+
+        self.probe = stxm_probe(self.sim_shape, outer = 30, inner = 12)
+        self.probe /= np.sqrt((np.abs(self.probe) ** 2).sum())
+
+        nb = nanoball_object((self.sim_shape[0] + 128, self.sim_shape[1] + 128), self.rng)
+        nb /= nb.max()
+        self.object = np.exp(0.2j * nb - nb / 2.)
+
+    def _draw(self, frames):
+        #Background noise, and saturation
+        res = frames + self.rng.normal(self.offset, self.io_noise, frames.shape)
+        return np.uint16(np.clip(res, 0, 63000))
+
+    def dark_frames(self, n):
+        return self._draw(np.zeros((n * len(self.dwell),) + raw_frame_shape))
+
+    def exp_frames(self, n):
+        """n scan positions, with the long and short exposures interleaved in double exposure scans"""
+
+        a, b = self.sim_shape
+        off = [(c - s) // 2 for c, s in zip(clean_frame_shape, self.sim_shape)]
+
+        frames = np.empty((n * len(self.dwell),) + raw_frame_shape, dtype = np.uint16)
+
+        for i in range(0, n):
+
+            r, c = (i % 16) * self.step, (i // 16) * self.step
+
+            exit_wave = self.probe * self.object[r:r + a, c:c + b]
+            intensity = np.abs(np.fft.fftshift(np.fft.fft2(np.fft.fftshift(exit_wave)))) ** 2 / (a * b)
+
+            for e, photons in enumerate(self.photons):
+                clean = np.zeros(clean_frame_shape)
+                clean[off[0]:off[0] + a, off[1]:off[1] + b] = self.rng.poisson(intensity * photons) * self.adu_per_photon
+                frames[i * len(self.dwell) + e] = self._draw(rawXimg(clean))
+
+        return frames
+
+    def metadata(self, n):
+
+        metadata = {"translations": [[0.03 * (i % 16), 0.03 * (i // 16)] for i in range(0, n)],
+                    "double_exposure": self.double_exposure,
+                    "dwell1": self.dwell[0],
+                    "dwell2": self.dwell[-1],
+                    "energy": 800,
+                    "exp_num_total": n,
+                    "dark_num_total": n}
+
+        return complete_metadata(metadata, conf_file)
+
+
+def time_call(f, args, repeats):
+    """Compilation plus first call time, then the min and median of repeats calls"""
+
+    start = timer()
+    jax.block_until_ready(f(*args))
+    first = timer() - start
+
+    times = []
+    for i in range(0, repeats):
+        start = timer()
+        jax.block_until_ready(f(*args))
+        times.append(timer() - start)
+
+    return {"first_s": first, "min_s": float(np.min(times)), "median_s": float(np.median(times))}
+
+
+def scan_metadata(sim, n_positions, output_width, dark_frames, exp_frames):
+    """Metadata with the center and rescaling of the scan, as computed by prepare()"""
+
+    metadata = sim.metadata(n_positions)
+    metadata["output_frame_width"] = output_width
+
+    background_avg = preprocessor.split_background(jnp.array(dark_frames)) if sim.double_exposure else jnp.mean(jnp.array(dark_frames), axis = 0)
+
+    metadata = preprocessor.compute_background_metadata(metadata, exp_frames[:len(sim.dwell)], background_avg)
+
+    return metadata, background_avg
+
+
+def bench_stages(sim, dark_frames, exp_frames, batch_sizes, output_widths, repeats):
+
+    results = []
+
+    background = jnp.float32(dark_frames[0])
+
+    for batch_size in batch_sizes:
+
+        raw = jnp.float32(exp_frames[:batch_size]) - background
+        clean = jax.jit(jax.vmap(preprocessor.cleanXraw))(raw)
+        clean.block_until_ready()
+
+        stages = {"cleanXraw": (jax.jit(jax.vmap(preprocessor.cleanXraw)), (raw,)),
+                  "combine_double_exposure": (jax.jit(jax.vmap(lambda x, y: preprocessor.combine_double_exposure(x, y, 5))), (clean, clean))}
+
+        for output_width in output_widths:
+
+            metadata, background_avg = scan_metadata(sim, 1, output_width, dark_frames, exp_frames)
+
+            kernel_width = max(int(np.floor(metadata["padded_frame_width"] / output_width)), 1)
+            kernel_box = jnp.ones((kernel_width, kernel_width))
+
+            #Default arguments bind the values of this output width, the functions are called after the loop
+            stages["filter_frame_w{}".format(output_width)] = (jax.jit(jax.vmap(lambda x, k = kernel_box: preprocessor.filter_frame(x, k))), (clean,))
+            stages["shift_rescale_w{}".format(output_width)] = (jax.jit(jax.vmap(lambda x, m = metadata, w = output_width: preprocessor.shift_rescale(x, m["center_of_mass"], w,
+                                                                                                                m["output_padded_ratio"]))), (clean,))
+
+        for name, (f, args) in stages.items():
+
+            r = time_call(f, args, repeats)
+            r.update({"stage": name.split("_w")[0], "name": name, "batch_size": batch_size, "per_frame_ms": 1000 * r["min_s"] / batch_size})
+
+            print(" {:<28} batch {:>4}: {:>9.2f} ms / frame, first call {:.2f} s".format(name, batch_size, r["per_frame_ms"], r["first_s"]))
+
+            results.append(r)
+
+    return results
+
+
+def bench_process_from_disk(sim, dark_frames, exp_frames, batch_sizes, output_widths, repeats):
+
+    results = []
+
+    n_positions = exp_frames.shape[0] // len(sim.dwell)
+
+    for output_width in output_widths:
+
+        metadata, background_avg = scan_metadata(sim, n_positions, output_width, dark_frames, exp_frames)
+        filter_all, filter_all_dexp = preprocessor.prepare_filter_functions(metadata, background_avg)
+
+        for batch_size in batch_sizes:
+
+            f = lambda: preprocessor.process_from_disk(metadata, exp_frames, batch_size * len(sim.dwell), filter_all, filter_all_dexp, {})[0]
+
+            r = time_call(f, (), repeats)
+            r.update({"stage": "process_from_disk", "name": "process_from_disk_w{}".format(output_width), "batch_size": batch_size,
+                      "output_width": output_width, "per_frame_ms": 1000 * r["min_s"] / n_positions})
+
+            print(" {:<28} batch {:>4}: {:>9.2f} ms / frame, first call {:.2f} s".format(r["name"], batch_size, r["per_frame_ms"], r["first_s"]))
+
+            results.append(r)
+
+    return results
+
+
+def environment():
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {"commit": commit, "date": datetime.datetime.now().isoformat(), "host": platform.node(), "cpu_count": os.cpu_count(),
+            "python": platform.python_version(), "jax": jax.__version__, "numpy": np.__version__, "device": str(jax.devices()[0])}
+
+
+def compare(old_fname, new_fname):
+    """Prints the per frame time ratios between two result files, > 1 is a slowdown"""
+
+    old = json.load(open(old_fname))
+    new = json.load(open(new_fname))
+
+    print("Old: {} ({}), new: {} ({})".format(old["environment"]["commit"], old["environment"]["date"], new["environment"]["commit"], new["environment"]["date"]))
+
+    old_results = {(r["name"], r["batch_size"]): r for r in old["results"]}
+
+    for r in new["results"]:
+        key = (r["name"], r["batch_size"])
+        if key in old_results:
+            ratio = r["per_frame_ms"] / old_results[key]["per_frame_ms"]
+            print(" {:<28} batch {:>4}: {:>9.2f} -> {:>9.2f} ms / frame  x{:.2f}".format(key[0], key[1], old_results[key]["per_frame_ms"], r["per_frame_ms"], ratio))
+
+
+def main():
+
+    args = sys.argv[1:]
+
+    if len(args) > 0 and args[0] == "compare":
+        compare(args[1], args[2])
+        return
+
+    out_fname = args[0] if len(args) > 0 else "bench_pipeline.json"
+    batch_sizes = [int(n) for n in args[1].split(",")] if len(args) > 1 else [2, 8]
+    output_widths = [int(n) for n in args[2].split(",")] if len(args) > 2 else [128, 256]
+    repeats = int(args[3]) if len(args) > 3 else 3
+
+    sim = SyntheticFCCD(double_exposure = True)
+
+    n_positions = max(batch_sizes)
+
+    print("Simulating {} dark and {} exposure frames...".format(n_positions * len(sim.dwell), n_positions * len(sim.dwell)))
+    dark_frames = sim.dark_frames(n_positions)
+    exp_frames = sim.exp_frames(n_positions)
+
+    print("Timing stages...")
+    results = bench_stages(sim, dark_frames, exp_frames, batch_sizes, output_widths, repeats)
+
+    print("Timing process_from_disk...")
+    results += bench_process_from_disk(sim, dark_frames, exp_frames, batch_sizes, output_widths, repeats)
+
+    with open(out_fname, "w") as f:
+        json.dump({"environment": environment(), "batch_sizes": batch_sizes, "output_widths": output_widths, "repeats": repeats, "results": results}, f, indent = 1)
+
+    print("Results written to " + out_fname)
+
+
+if __name__ == "__main__":
+    main()
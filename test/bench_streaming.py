@@ -0,0 +1,380 @@
+"""
+End-to-end latency benchmark of the streaming path: publisher -> cosmic.py <ip:port> -> XSUB/XPUB router -> consumer.
+
+A local replay publisher stands in for the framegrabber, following the protocol of receive_metadata and receive_n_frames:
+a JSON metadata string, then the dark frames and the exposure frames as msgpack (b'number', frame) messages, exposures at a
+given rate, and an end of scan message. It replays a raw_data.h5 or .raw scan, or synthetic frames from bench_pipeline.SyntheticFCCD. The preprocessor
+runs with each number of MPI ranks given, the harness subscribes to its output and reports the sustained output frames
+per second, the dropped frames and the latency percentiles from the publication of the last raw frame of a scan position
+to the reception of its processed frame.
+
+Usage: python bench_streaming.py [options]
+    --ranks N,M,...   numbers of MPI ranks to run, 1,2 by default
+    --rate R          exposure frames per second sent by the publisher, 0 sends as fast as possible. 10 by default
+    --frames N        number of scan positions, 64 by default
+    --darks N         number of dark frames per exposure, 10 by default
+    --single          single exposure scan, double exposure by default
+    --replay F        replay the frames of a raw_data.h5 or .raw scan instead of synthetic frames, cycling them if needed
+    --conf F          configuration file, configuration/default.json by default
+    --timeout S       stop waiting for output frames S seconds after the last frame was published, 120 by default
+    --output F        results JSON file, bench_streaming.json by default
+    --args "A"        extra arguments for cosmic.py, for instance "-g" or "-b 8"
+    --timestamps      send acquisition times with the frames and run cosmic.py with --timestamps,
+                      the latencies between the timestamps of the output frames are reported too
+    --drop N          do not publish every N-th exposure frame, to check the handling of missing frames. Off by default
+    --no_end          do not publish the end of scan message after the last frame, the scan then ends on cosmic.py --frame_timeout
+    --shuffle W       publish the exposure frames shuffled within windows of W frames, to check the reordering of the input. Off by default
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import shlex
+import signal
+import socket
+import subprocess
+import multiprocessing as mp
+
+import numpy as np
+import zmq
+import msgpack
+import msgpack_numpy
+
+from cosmicp.metrics import frame_latencies
+from cosmicp.network import send_end_of_scan, unpack_output, is_preview, unpack_preview
+
+package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+n_synthetic_positions = 8 #distinct synthetic frames, cycled for longer scans
+
+
+def free_port():
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def scan_frames(options):
+    """Metadata, dark frames and exposure frames to replay"""
+
+    if options["replay"] is None:
+        from bench_pipeline import SyntheticFCCD
+
+        sim = SyntheticFCCD(double_exposure = not options["single"])
+        metadata = {"double_exposure": not options["single"], "dwell1": sim.dwell[0], "dwell2": sim.dwell[-1], "energy": 800}
+
+        return metadata, sim.dark_frames(min(options["darks"], 4)), sim.exp_frames(n_synthetic_positions)
+
+    import h5py
+    from cosmicp import diskIO
+
+    if options["replay"].endswith(diskIO.raw_container_extension):
+        metadata, dark_frames, exp_frames = diskIO.map_raw_container(options["replay"])
+
+    else:
+        f = h5py.File(options["replay"], "r")
+        metadata = diskIO.read_metadata_hdf5(options["replay"])
+        dark_frames = f["entry_1/data_1/dark_frames"]
+        exp_frames = f["entry_1/data_1/exp_frames"]
+
+    n_exposures = metadata["double_exposure"] + 1
+
+    return metadata, np.array(dark_frames[:n_exposures * min(options["darks"], 8)]), np.array(exp_frames[:n_exposures * 16])
+
+
+def publisher(address, n_subscribers, options, times_queue):
+    """Replays a scan on address once n_subscribers are connected.
+    Puts the number of exposures per position and the publication time of each exposure frame into times_queue"""
+
+    metadata, dark_frames, exp_frames = scan_frames(options)
+
+    n_exposures = metadata["double_exposure"] + 1
+    n_positions = options["frames"]
+
+    metadata.update({"translations": [[0.03 * (i % 16), 0.03 * (i // 16), 0] for i in range(0, n_positions)],
+                     "exp_num_total": n_positions,
+                     "dark_num_total": options["darks"]})
+
+    pack = lambda number, frame: msgpack.packb((b'%d' % number, frame), default = msgpack_numpy.encode, use_bin_type = True)
+
+    dark_msgs = [pack(i, dark_frames[i % len(dark_frames)]) for i in range(0, options["darks"] * n_exposures)]
+
+    #Messages of the frames available, only the frame number changes when cycling them.
+    #With timestamps they are packed when sent, with their acquisition time
+    n_exp_frames = n_positions * n_exposures
+    if not options["timestamps"]:
+        exp_msgs = [pack(i, exp_frames[i % len(exp_frames)]) for i in range(0, n_exp_frames)]
+
+    context = zmq.Context()
+    pub = context.socket(zmq.XPUB)
+    pub.setsockopt(zmq.XPUB_VERBOSE, 1) #every rank subscription is reported
+    pub.setsockopt(zmq.SNDHWM, 0)
+    pub.bind("tcp://" + address)
+
+    #Waiting for every rank to subscribe, nothing is lost to slow joiners
+    for i in range(0, n_subscribers):
+        pub.recv()
+
+    pub.send_string(json.dumps(metadata))
+
+    for msg in dark_msgs:
+        pub.send(msg)
+
+    period = 1.0 / options["rate"] if options["rate"] > 0 else 0.0
+    start = time.time()
+
+    #Publication order of the exposure frames
+    order = list(range(0, n_exp_frames))
+    if options["shuffle"] > 1:
+        rng = np.random.default_rng(0)
+        for w in range(0, n_exp_frames, options["shuffle"]):
+            order[w:w + options["shuffle"]] = rng.permutation(order[w:w + options["shuffle"]])
+
+    times = [0.0] * n_exp_frames
+
+    for k, i in enumerate(order):
+
+        if period > 0:
+            time.sleep(max(0.0, start + k * period - time.time()))
+
+        times[i] = time.time()
+
+        if options["drop"] > 0 and (i + 1) % options["drop"] == 0:
+            continue
+
+        if options["timestamps"]:
+            pub.send(msgpack.packb((b'%d' % i, exp_frames[i % len(exp_frames)], times[i]), default = msgpack_numpy.encode, use_bin_type = True))
+        else:
+            pub.send(exp_msgs[i])
+
+    if not options["no_end"]:
+        send_end_of_scan(pub, n_exp_frames)
+
+    times_queue.put((n_exposures, times))
+
+    #Messages still queued go out before closing
+    pub.close(linger = -1)
+    context.term()
+
+
+def run_preprocessor(n_ranks, input_address, output_address, intermediate_address, options, log_file):
+
+    cmd = [sys.executable, os.path.join(package_dir, "cosmicp", "cosmic.py"), "-c", options["conf"], "-m", "socket",
+           "-o", output_address, "-i", intermediate_address] + shlex.split(options["args"]) + [input_address]
+
+    if options["timestamps"]:
+        cmd.insert(-1, "--timestamps")
+
+    if n_ranks > 1:
+        cmd = ["mpiexec", "-n", str(n_ranks)] + cmd
+
+    #A session of its own, so that all the ranks can be terminated together
+    return subprocess.Popen(cmd, stdout = log_file, stderr = subprocess.STDOUT, start_new_session = True)
+
+
+def stop(process):
+
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(10)
+        except (ProcessLookupError, subprocess.TimeoutExpired):
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def run(n_ranks, options):
+
+    input_address = "127.0.0.1:%d" % free_port()
+    output_address = "127.0.0.1:%d" % free_port()
+    intermediate_address = "127.0.0.1:%d" % free_port()
+
+    context = zmq.Context()
+    consumer = context.socket(zmq.SUB)
+    consumer.setsockopt(zmq.SUBSCRIBE, b'')
+    consumer.setsockopt(zmq.RCVHWM, 0)
+    consumer.connect("tcp://" + output_address)
+
+    times_queue = mp.get_context("spawn").Queue()
+    pub = mp.get_context("spawn").Process(target = publisher, args = (input_address, n_ranks, options, times_queue))
+    pub.start()
+
+    log_fname = os.path.splitext(options["output"])[0] + "_%dranks.log" % n_ranks
+    log_file = open(log_fname, "w")
+    process = run_preprocessor(n_ranks, input_address, output_address, intermediate_address, options, log_file)
+
+    received = {}
+    out_of_order = 0
+    duplicates = 0
+    messages = 0
+    previews = 0
+    received_bytes = 0
+    frame_times = {}
+    metadata = None
+    publish_times = None
+    last_publish = None
+
+    poller = zmq.Poller()
+    poller.register(consumer, zmq.POLLIN)
+
+    while len(received) < options["frames"]:
+
+        if publish_times is None and not times_queue.empty():
+            n_exposures, publish_times = times_queue.get()
+            last_publish = time.time()
+
+        if last_publish is not None and time.time() - last_publish > options["timeout"]:
+            break
+
+        #The publisher failed before sending the whole scan
+        if publish_times is None and not pub.is_alive() and times_queue.empty():
+            break
+
+        if process.poll() is not None and not poller.poll(0):
+            break
+
+        if not poller.poll(100):
+            continue
+
+        msg = consumer.recv()
+        t = time.time()
+
+        if msg[:1] == b'{':
+            metadata = json.loads(msg)
+            continue
+
+        #With cosmic.py --preview
+        if is_preview(msg):
+            previews += len(unpack_preview(msg)[0])
+            continue
+
+        indexes, frames, times = unpack_output(msg, metadata.get("output_format") if metadata else None)
+        messages += 1
+        received_bytes += len(msg)
+
+        for k, index in enumerate(indexes):
+
+            #Frames received after a frame with a higher index, e.g. without --ordered_output
+            if received and index < max(received):
+                out_of_order += 1
+
+            #Frames sent more than once
+            if index in received:
+                duplicates += 1
+
+            received.setdefault(index, t)
+
+            if times is not None:
+                frame_times[index] = times[k]
+
+    if publish_times is None:
+        n_exposures, publish_times = times_queue.get(timeout = 60) if pub.is_alive() or not times_queue.empty() else (1, [])
+
+    stop(process)
+    pub.join(10)
+    log_file.close()
+    consumer.close(linger = 0)
+    context.term()
+
+    #From the last raw frame of each position, long and short exposures are processed together
+    latencies = np.array([t - publish_times[(i + 1) * n_exposures - 1] for i, t in received.items() if (i + 1) * n_exposures - 1 < len(publish_times)])
+
+    recv_times = np.sort(np.array(list(received.values())))
+
+    result = {"ranks": n_ranks,
+              "frames_expected": options["frames"],
+              "frames_received": len(received),
+              "frames_dropped": options["frames"] - len(received),
+              "frames_out_of_order": out_of_order,
+              "frames_duplicate": duplicates,
+              "messages_received": messages,
+              "previews_received": previews,
+              "bytes_received": received_bytes,
+              "metadata_received": metadata is not None,
+              "publish_fps": (len(publish_times) - 1) / (publish_times[-1] - publish_times[0]) / n_exposures if len(publish_times) > 1 else None,
+              "output_fps": (len(recv_times) - 1) / (recv_times[-1] - recv_times[0]) if len(recv_times) > 1 else None,
+              "log": log_fname}
+
+    if len(latencies) > 0:
+        result.update({"latency_first_s": float(latencies[np.argmin(list(received.keys()))]),
+                       "latency_p50_s": float(np.percentile(latencies, 50)),
+                       "latency_p99_s": float(np.percentile(latencies, 99)),
+                       "latency_max_s": float(latencies.max())})
+
+    #Where the time goes, from the timestamps carried by the output frames
+    for name, t_from, t_to in frame_latencies:
+
+        stage = [times[t_to] - times[t_from] for times in frame_times.values() if times.get(t_from) is not None and times.get(t_to) is not None]
+
+        if len(stage) > 0:
+            result["stages_" + name + "_p50_s"] = float(np.percentile(stage, 50))
+            result["stages_" + name + "_p99_s"] = float(np.percentile(stage, 99))
+
+    return result
+
+
+def main():
+
+    options = {"ranks": [1, 2], "rate": 10.0, "frames": 64, "darks": 10, "single": False, "replay": None,
+               "conf": os.path.join(package_dir, "configuration", "default.json"), "timeout": 120.0, "output": "bench_streaming.json", "args": "", "timestamps": False,
+               "drop": 0, "no_end": False, "shuffle": 0}
+
+    opts, args_left = getopt.getopt(sys.argv[1:], "", ["ranks=", "rate=", "frames=", "darks=", "single", "replay=", "conf=", "timeout=", "output=", "args=", "timestamps", "drop=", "no_end", "shuffle="])
+
+    for opt, arg in opts:
+        if opt == "--ranks":
+            options["ranks"] = [int(n) for n in arg.split(",")]
+        if opt == "--rate":
+            options["rate"] = float(arg)
+        if opt == "--frames":
+            options["frames"] = int(arg)
+        if opt == "--darks":
+            options["darks"] = int(arg)
+        if opt == "--single":
+            options["single"] = True
+        if opt == "--replay":
+            options["replay"] = os.path.abspath(arg)
+        if opt == "--conf":
+            options["conf"] = os.path.abspath(arg)
+        if opt == "--timeout":
+            options["timeout"] = float(arg)
+        if opt == "--output":
+            options["output"] = arg
+        if opt == "--args":
+            options["args"] = arg
+        if opt == "--timestamps":
+            options["timestamps"] = True
+        if opt == "--drop":
+            options["drop"] = int(arg)
+        if opt == "--no_end":
+            options["no_end"] = True
+        if opt == "--shuffle":
+            options["shuffle"] = int(arg)
+
+    results = []
+
+    for n_ranks in options["ranks"]:
+
+        print("Running {} ranks, {} positions at {} frames/s...".format(n_ranks, options["frames"], options["rate"] or "max"))
+
+        r = run(n_ranks, options)
+        results.append(r)
+
+        print(" received {}/{} frames ({} out of order, {} messages, {:.1f} MB), output {} frames/s, latency p50 {} s, p99 {} s (first frame {} s)".format(r["frames_received"], r["frames_expected"], r["frames_out_of_order"], r["messages_received"], r["bytes_received"] / 1e6,
+              "%.2f" % r["output_fps"] if r["output_fps"] else "-", "%.3f" % r["latency_p50_s"] if "latency_p50_s" in r else "-",
+              "%.3f" % r["latency_p99_s"] if "latency_p99_s" in r else "-", "%.3f" % r["latency_first_s"] if "latency_first_s" in r else "-"))
+
+        for name, t_from, t_to in frame_latencies:
+            if "stages_" + name + "_p50_s" in r:
+                print("   {:<22} p50 {:.3f} s, p99 {:.3f} s".format(name, r["stages_" + name + "_p50_s"], r["stages_" + name + "_p99_s"]))
+
+    with open(options["output"], "w") as f:
+        json.dump({"options": options, "results": results}, f, indent = 1)
+
+    print("Results written to " + options["output"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Benchmark of the output transports: MPI ranks -> intermediate address -> XSUB/XPUB router -> consumer, without the preprocessing.
+
+Publisher processes stand in for the MPI ranks and send synthetic output frames (mostly zeros, as after the preprocessing) with
+their send time through network.pack_output, the router is network.xsub_xpub_router in its own process, and the harness consumes
+the frames with network.unpack_output. For each transport it reports the frames per second, MB/s of frames, the latency percentiles
+from the send to the decoding of a frame, the frames lost (dropped by the sockets or overwritten in shared memory), and the CPU time
+of the router process.
+
+Transports:
+    tcp      127.0.0.1 TCP for both hops, the default of cosmic.py
+    ipc      ipc:// sockets for both hops
+    inproc   publisher threads and router in one process (one MPI rank), inproc:// to the router and ipc:// to the consumer.
+             The CPU time reported includes the publishers
+    shm      ipc:// sockets carrying descriptors of shared memory ring slots, as cosmic.py --shm_ring
+
+Usage: python bench_transport.py [options]
+    --transports T,...       transports to compare, tcp,ipc,inproc,shm by default
+    --publishers N           publishers (MPI ranks), 2 by default
+    --frames N               frames sent by each publisher, 2000 by default
+    --width W                output frame width, 256 by default
+    --frames_per_message N   frames per message, as cosmic.py --frames_per_message, 1 by default
+    --rate R                 frames per second sent by each publisher, 0 sends as fast as possible. 1000 by default
+    --slots N                shared memory ring slots, as cosmic.py --shm_ring, 256 by default
+    --output F               results JSON file, bench_transport.json by default
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import socket
+import tempfile
+import threading
+import multiprocessing as mp
+
+import numpy as np
+import zmq
+
+from cosmicp.network import publish_to_socket, xsub_xpub_router, pack_output, unpack_output
+from cosmicp import shm
+
+#Seconds for the subscriptions to reach the publishers, and without frames before the consumer gives up
+join_time = 1.0
+idle_timeout = 5.0
+
+
+def free_port():
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def synthetic_frames(n, width):
+    """Frames with a bright disk in the middle and zeros around"""
+
+    y, x = np.mgrid[0:width, 0:width] - width // 2
+    disk = (x**2 + y**2 < (width // 8)**2)
+
+    rng = np.random.default_rng(0)
+
+    return np.array([disk * rng.uniform(0, 1000, (width, width)) for i in range(0, n)], dtype = np.float32)
+
+
+def addresses(transport, tmp_dir):
+    """Intermediate and output addresses of a transport"""
+
+    if transport == "tcp":
+        return "127.0.0.1:%d" % free_port(), "127.0.0.1:%d" % free_port()
+
+    intermediate = "inproc://intermediate" if transport == "inproc" else "ipc://" + os.path.join(tmp_dir, "intermediate")
+
+    return intermediate, "ipc://" + os.path.join(tmp_dir, "output")
+
+
+def publish(context, rank, n_ranks, intermediate_address, output_format, options, finished):
+    """Sends the frames rank, rank + n_ranks, ... as an MPI rank of cosmic.py does"""
+
+    network_metadata = {"context": context, "intermediate_address": intermediate_address}
+    pub = publish_to_socket(network_metadata)
+
+    frames = synthetic_frames(output_format["frames_per_message"], options["width"])
+    indexes = list(range(rank, options["frames"] * n_ranks, n_ranks))
+
+    ring = None
+    period = output_format["frames_per_message"] / options["rate"] if options["rate"] > 0 else 0.0
+
+    time.sleep(join_time)
+    start = time.time()
+
+    for k, m in enumerate(range(0, len(indexes), output_format["frames_per_message"])):
+
+        if period > 0:
+            time.sleep(max(0.0, start + k * period - time.time()))
+
+        block = frames[:len(indexes[m:m + output_format["frames_per_message"]])]
+
+        if output_format["shared_memory"]:
+            ring = shm.ring(ring, options["slots"], frames.nbytes)
+
+        send_time = time.time()
+        pub.send(pack_output(indexes[m:m + len(block)], block, output_format, [{"send": send_time}] * len(block), ring))
+
+    #The consumer reads the last slots before the ring is removed
+    finished.wait(60)
+
+    pub.close(linger = 1000)
+
+    if ring is not None:
+        ring.close()
+
+
+def publisher_process(rank, n_ranks, intermediate_address, output_format, options, finished):
+
+    context = zmq.Context()
+    publish(context, rank, n_ranks, intermediate_address, output_format, options, finished)
+    context.term()
+
+
+def router_process(intermediate_address, output_address, n_inproc_publishers, output_format, options, ready, finished, cpu_queue):
+    """Runs the router, and the publishers when they are threads of the same process, then reports the CPU time of the process"""
+
+    context = zmq.Context()
+    network_metadata = {"context": context, "intermediate_address": intermediate_address, "output_address": output_address}
+
+    xsub_xpub_router(network_metadata)
+
+    threads = [threading.Thread(target = publish, args = (context, r, n_inproc_publishers, intermediate_address, output_format, options, finished), daemon = True)
+               for r in range(0, n_inproc_publishers)]
+
+    for th in threads:
+        th.start()
+
+    ready.set()
+    finished.wait()
+
+    times = os.times()
+    cpu_queue.put(times.user + times.system)
+    cpu_queue.close()
+    cpu_queue.join_thread()
+
+    #The proxy thread runs until the process ends
+    os._exit(0)
+
+
+def run(transport, options):
+
+    tmp_dir = tempfile.mkdtemp(prefix = "cosmicp_transport_")
+
+    intermediate_address, output_address = addresses(transport, tmp_dir)
+
+    output_format = {"frames_per_message": options["frames_per_message"], "compression": "none", "shared_memory": transport == "shm"}
+
+    n_ranks = options["publishers"]
+    n_inproc_publishers = n_ranks if transport == "inproc" else 0
+
+    ready, finished = mp.Event(), mp.Event()
+    cpu_queue = mp.Queue()
+
+    router = mp.Process(target = router_process, args = (intermediate_address, output_address, n_inproc_publishers, output_format, options, ready, finished, cpu_queue))
+    router.start()
+    ready.wait(30)
+
+    context = zmq.Context()
+
+    consumer = context.socket(zmq.SUB)
+    consumer.setsockopt(zmq.SUBSCRIBE, b'')
+    consumer.setsockopt(zmq.RCVHWM, 0)
+    consumer.connect(output_address if "://" in output_address else "tcp://" + output_address)
+
+    publishers = [mp.Process(target = publisher_process, args = (r, n_ranks, intermediate_address, output_format, options, finished))
+                  for r in range(0, n_ranks) if transport != "inproc"]
+
+    for p in publishers:
+        p.start()
+
+    n_expected = options["frames"] * n_ranks
+    received = 0
+    lost = 0
+    n_bytes = 0
+    latencies = []
+    first, last = None, None
+    last_message = time.time() + join_time
+
+    while received + lost < n_expected and time.time() - last_message < idle_timeout:
+
+        if not consumer.poll(100):
+            continue
+
+        msg = consumer.recv()
+        indexes, frames, times = unpack_output(msg, output_format)
+        t = time.time()
+
+        last_message = t
+        first = first or t
+        last = t
+
+        if frames is None:
+            lost += len(indexes)
+            continue
+
+        received += len(indexes)
+        n_bytes += frames.nbytes
+        latencies.extend(t - times[k]["send"] for k in range(0, len(indexes)))
+
+    finished.set()
+
+    router_cpu = cpu_queue.get(timeout = 30)
+
+    for p in publishers + [router]:
+        p.join(30)
+
+    consumer.close(linger = 0)
+    context.term()
+    shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    duration = (last - first) if received > 1 else None
+
+    result = {"transport": transport,
+              "frames_expected": n_expected,
+              "frames_received": received,
+              "frames_lost": n_expected - received,
+              "frames_overwritten": lost,
+              "fps": received / duration if duration else None,
+              "mb_per_s": n_bytes / duration / 1e6 if duration else None,
+              "router_cpu_s": router_cpu}
+
+    if len(latencies) > 0:
+        result.update({"latency_p50_ms": 1000 * float(np.percentile(latencies, 50)),
+                       "latency_p99_ms": 1000 * float(np.percentile(latencies, 99))})
+
+    return result
+
+
+def main():
+
+    options = {"transports": ["tcp", "ipc", "inproc", "shm"], "publishers": 2, "frames": 2000, "width": 256, "frames_per_message": 1,
+               "rate": 1000.0, "slots": 256, "output": "bench_transport.json"}
+
+    opts, args_left = getopt.getopt(sys.argv[1:], "", ["transports=", "publishers=", "frames=", "width=", "frames_per_message=", "rate=", "slots=", "output="])
+
+    for opt, arg in opts:
+        if opt == "--transports":
+            options["transports"] = arg.split(",")
+        if opt == "--publishers":
+            options["publishers"] = int(arg)
+        if opt == "--frames":
+            options["frames"] = int(arg)
+        if opt == "--width":
+            options["width"] = int(arg)
+        if opt == "--frames_per_message":
+            options["frames_per_message"] = int(arg)
+        if opt == "--rate":
+            options["rate"] = float(arg)
+        if opt == "--slots":
+            options["slots"] = int(arg)
+        if opt == "--output":
+            options["output"] = arg
+
+    results = []
+
+    for transport in options["transports"]:
+
+        print("Running {} with {} publishers, {} frames each...".format(transport, options["publishers"], options["frames"]))
+
+        r = run(transport, options)
+        results.append(r)
+
+        print(" received {}/{} frames ({} overwritten), {} frames/s, {} MB/s, latency p50 {} ms, p99 {} ms, router CPU {:.2f} s".format(
+              r["frames_received"], r["frames_expected"], r["frames_overwritten"], "%.0f" % r["fps"] if r["fps"] else "-",
+              "%.0f" % r["mb_per_s"] if r["mb_per_s"] else "-", "%.2f" % r["latency_p50_ms"] if "latency_p50_ms" in r else "-",
+              "%.2f" % r["latency_p99_ms"] if "latency_p99_ms" in r else "-", r["router_cpu_s"]))
+
+    with open(options["output"], "w") as f:
+        json.dump({"options": options, "results": results}, f, indent = 1)
+
+    print("Results written to " + options["output"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Unit tests of cosmicp.darks, on small random frames.
+
+Usage: python -m pytest test/test_darks.py
+"""
+
+import time
+
+import numpy as np
+
+from cosmicp.darks import DarkAccumulator, DarkLibrary
+
+frame_shape = (16, 24)
+metadata = {"double_exposure": True, "dwell1": 100, "dwell2": 20}
+
+
+def dark_frames(n, n_exposures = 2, seed = 0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(1000, 5, (n * n_exposures,) + frame_shape).astype(np.uint16)
+
+
+def accumulate(frames, n_exposures = 2):
+    darks = DarkAccumulator(n_exposures, track_variance = True)
+    darks.add_batch(frames)
+    return darks
+
+
+def expected(frames, n_exposures = 2):
+    """np.mean and np.var of each exposure"""
+
+    exposures = [frames[e::n_exposures].astype(np.float64) for e in range(0, n_exposures)]
+
+    return np.array([np.mean(f, axis = 0) for f in exposures]), np.array([np.var(f, axis = 0, ddof = 1) for f in exposures])
+
+
+def test_add_and_add_batch_match_numpy():
+
+    frames = dark_frames(7)
+    mean, var = expected(frames)
+
+    one_by_one = DarkAccumulator(2, track_variance = True)
+    for frame in frames:
+        one_by_one.add(frame)
+
+    #Batches split on an odd frame continue on the right exposure
+    batches = DarkAccumulator(2, track_variance = True)
+    for i_s, i_e in [(0, 3), (3, 4), (4, 10), (10, 14)]:
+        batches.add_batch(frames[i_s:i_e])
+
+    for darks in [one_by_one, batches]:
+        assert darks.counts == [7, 7]
+        assert np.allclose(darks.background(), mean, rtol = 1e-6)
+        assert np.allclose(darks.variance(), var, rtol = 1e-4)
+
+
+def test_batch_starting_on_the_short_exposure():
+
+    frames = dark_frames(4)
+
+    darks = DarkAccumulator(2, track_variance = True)
+    darks.add(frames[0])
+    darks.add_batch(frames[1:])
+
+    mean, var = expected(frames)
+
+    assert np.allclose(darks.background(), mean, rtol = 1e-6)
+    assert np.allclose(darks.variance(), var, rtol = 1e-4)
+
+
+def test_merge_matches_numpy():
+
+    frames = dark_frames(30, n_exposures = 1).astype(np.float64)
+
+    darks = DarkAccumulator(1, track_variance = True)
+    for chunk in [frames[:1], frames[1:12], frames[12:]]:
+        darks.merge(0, len(chunk), np.mean(chunk, axis = 0), np.sum((chunk - np.mean(chunk, axis = 0))**2, axis = 0))
+
+    assert darks.counts == [30]
+    assert np.allclose(darks.background(), np.mean(frames, axis = 0), rtol = 1e-6)
+    assert np.allclose(darks.variance(), np.var(frames, axis = 0, ddof = 1), rtol = 1e-4)
+
+    #Merging means only (no m2) still counts the frames
+    means = DarkAccumulator(1)
+    means.merge(0, 10, np.mean(frames[:10], axis = 0))
+    means.merge(0, 20, np.mean(frames[10:], axis = 0))
+
+    assert np.allclose(means.background(), np.mean(frames, axis = 0), rtol = 1e-6)
+
+
+def test_blend_keeps_the_age_of_the_library_darks(tmp_path):
+    """An entry refreshed with a few new frames is about as old as the frames it averages"""
+
+    library = DarkLibrary(str(tmp_path), min_frames = 50)
+
+    hours = 3600
+    old = accumulate(dark_frames(50))
+    old.acquisition_time = time.time() - 3 * hours
+    library.store(metadata, old)
+
+    darks = library.blend(metadata, accumulate(dark_frames(1, seed = 1)))
+    library.store(metadata, darks)
+
+    assert min(darks.counts) == 50
+    assert time.time() - 3 * hours < darks.acquisition_time < time.time() - 2.9 * hours
+
+    #It expires with the old frames
+    assert library.load(metadata, frame_shape) is not None
+    assert DarkLibrary(str(tmp_path), max_age = 2.5 * hours).load(metadata, frame_shape) is None
+
+
+def test_scans_without_dark_frames_use_their_frame_shape(tmp_path):
+
+    library = DarkLibrary(str(tmp_path), min_frames = 50)
+    library.store(metadata, accumulate(dark_frames(50)))
+
+    empty = DarkAccumulator(2, track_variance = True)
+
+    assert not library.blend(metadata, empty, frame_shape).is_empty()
+    assert library.blend(metadata, empty, (32, 32)).is_empty()
+
+    #Without frames yet (fast start from a socket), the newest entry with the same settings is used
+    assert not library.blend(metadata, empty).is_empty()
+    assert library.blend({**metadata, "dwell1": 200}, empty).is_empty()
@@ -0,0 +1,89 @@
+"""
+Round trips of the raw frame container of cosmicp.diskIO (scripts/pack_raw_scan.py).
+
+Usage: python -m pytest test/test_diskIO.py
+"""
+
+import os
+import json
+
+import h5py
+import numpy as np
+import pytest
+
+from cosmicp import diskIO
+
+frame_shape = (20, 24)
+
+
+def raw_frames(n, seed = 0):
+    return np.random.default_rng(seed).integers(0, 2**16, (n,) + frame_shape).astype(np.uint16)
+
+
+@pytest.fixture
+def raw_data_h5(tmp_path):
+    """Scan in the raw_data.h5 layout, with a metadata header longer than the first page of the container"""
+
+    metadata = {"translations": [[0.01 * i, 0.02 * i] for i in range(0, 400)], "double_exposure": True, "dwell1": 100, "dwell2": 10}
+
+    fname = str(tmp_path / "NS_200101001_raw_data.h5")
+
+    with h5py.File(fname, "w") as f:
+        f.create_dataset("metadata", data = json.dumps(metadata))
+        f.create_dataset("entry_1/data_1/dark_frames", data = raw_frames(6, seed = 1), chunks = (2,) + frame_shape)
+        f.create_dataset("entry_1/data_1/exp_frames", data = raw_frames(13, seed = 2), chunks = (2,) + frame_shape)
+
+    return fname, metadata
+
+
+def test_pack_h5_scan_round_trip(raw_data_h5):
+
+    fname, metadata = raw_data_h5
+
+    out_fname = diskIO.pack_raw_container(fname)
+
+    assert out_fname == diskIO.raw_container_name(fname) and out_fname.endswith(diskIO.raw_container_extension)
+    assert os.path.getsize(out_fname) % diskIO.raw_container_alignment == 0
+
+    header = diskIO.read_raw_container_header(out_fname)
+    assert all(block["offset"] % diskIO.raw_container_alignment == 0 for block in header["blocks"].values())
+
+    read_metadata, dark_frames, exp_frames = diskIO.map_raw_container(out_fname)
+
+    assert read_metadata == metadata
+
+    with h5py.File(fname, "r") as f:
+        assert np.array_equal(dark_frames, f["entry_1/data_1/dark_frames"][()])
+        assert np.array_equal(exp_frames, f["entry_1/data_1/exp_frames"][()])
+
+    assert exp_frames.dtype == np.uint16
+    assert not exp_frames.flags.writeable
+
+
+def test_write_raw_container_in_batches(tmp_path):
+    """Frames are written batch_size at a time, and stored as uint16"""
+
+    fname = str(tmp_path / "scan_data.raw")
+
+    dark_frames = raw_frames(3)
+    exp_frames = raw_frames(7, seed = 1).astype(np.float32)
+
+    diskIO.write_raw_container(fname, {"energy": 800}, {"dark_frames": dark_frames, "exp_frames": exp_frames}, batch_size = 2)
+
+    metadata, read_dark_frames, read_exp_frames = diskIO.map_raw_container(fname)
+
+    assert metadata == {"energy": 800}
+    assert np.array_equal(read_dark_frames, dark_frames)
+    assert np.array_equal(read_exp_frames, exp_frames)
+    assert read_exp_frames.dtype == np.uint16
+
+
+def test_not_a_raw_container(tmp_path):
+
+    fname = str(tmp_path / "scan_data.raw")
+
+    with open(fname, "wb") as f:
+        f.write(b"\0" * 64)
+
+    with pytest.raises(Exception, match = "not a raw frame container"):
+        diskIO.map_raw_container(fname)
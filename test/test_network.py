@@ -0,0 +1,183 @@
+"""
+Round trips of the output messages of cosmicp.network: byte shuffle, compression and blocks of frames, and the ordered router.
+
+Usage: python -m pytest test/test_network.py
+"""
+
+import json
+import threading
+
+import numpy as np
+import pytest
+import zmq
+
+from cosmicp import network
+
+compressions = [c for c in ["zlib", "lz4"] if network.compression_available(c)]
+dtypes = [np.float32, np.uint16]
+
+
+def frames(dtype, n = 4, width = 16, seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    return (rng.random((n, width, width)) * 1000 * (rng.random((n, width, width)) < 0.2)).astype(dtype)
+
+
+@pytest.mark.parametrize("dtype", dtypes)
+def test_byte_shuffle_round_trip(dtype):
+
+    block = frames(dtype)
+
+    data = network.byte_shuffle(block)
+
+    assert len(data) == block.nbytes
+    #The first bytes are the lowest bytes of every value
+    assert data[:block.size] == block.reshape(-1).view(np.uint8)[::block.itemsize].tobytes()
+
+    assert np.array_equal(network.byte_unshuffle(data, block.dtype.str, block.shape), block)
+
+
+@pytest.mark.parametrize("compression", compressions)
+@pytest.mark.parametrize("dtype", dtypes)
+def test_encode_array_round_trip(compression, dtype):
+
+    block = frames(dtype)
+
+    encoded = network.encode_array(block, compression)
+
+    assert encoded["compression"] == compression
+    assert len(encoded["data"]) < block.nbytes
+
+    decoded = network.decode_array(encoded)
+
+    assert decoded.dtype == dtype
+    assert np.array_equal(decoded, block)
+
+    assert network.encode_array(block, "none") is block
+
+
+@pytest.mark.parametrize("compression", ["none"] + compressions)
+@pytest.mark.parametrize("dtype", dtypes)
+def test_output_blocks_round_trip(compression, dtype):
+
+    block = frames(dtype)
+
+    output_format = {**network.default_output_format(), "frames_per_message": len(block), "compression": compression}
+    times = [{"acquired": float(i)} for i in range(0, len(block))]
+
+    indexes, decoded, decoded_times = network.unpack_output(network.pack_output([7, 8, 9, 10], block, output_format, times), output_format)
+
+    assert indexes == [7, 8, 9, 10]
+    assert decoded.dtype == dtype
+    assert np.array_equal(decoded, block)
+    assert decoded_times == times
+
+
+def test_single_frame_messages():
+
+    block = frames(np.float32, n = 1)
+
+    indexes, decoded, times = network.unpack_output(network.pack_output([3], block, network.default_output_format()))
+
+    assert indexes == [3]
+    assert np.array_equal(decoded, block)
+    assert times is None
+
+
+def start_ordered_proxy(window_size = 8, timeout = 10.0):
+    """Ordered router between a publisher and a consumer socket of the test (inproc PAIR sockets)"""
+
+    context = zmq.Context()
+
+    sockets = {}
+    for name in ["backend", "frontend"]:
+        sockets[name] = context.socket(zmq.PAIR)
+        sockets[name].bind("inproc://" + name)
+
+    publisher = context.socket(zmq.PAIR)
+    publisher.connect("inproc://backend")
+
+    consumer = context.socket(zmq.PAIR)
+    consumer.connect("inproc://frontend")
+
+    threading.Thread(target = network.ordered_proxy, args = (sockets["frontend"], sockets["backend"], window_size, timeout, 0.01), daemon = True).start()
+
+    return publisher, consumer
+
+
+def send_frame(publisher, scan_id, index):
+    publisher.send(network.pack_output([index], np.full((1, 1, 1), 100 * scan_id + index), network.default_output_format(), scan_id = scan_id))
+
+def send_scan_metadata(publisher, scan_id, n_frames):
+    publisher.send_string(json.dumps({"scan_id": scan_id, "translations": [[0, 0]] * n_frames}))
+
+def received(consumer, wait = 0.3):
+    """Scan ids of the metadata and frame values received, in order"""
+
+    messages = []
+    while consumer.poll(int(wait * 1000)):
+        msg = consumer.recv()
+
+        if network.is_control_message(msg):
+            messages.append("scan{}".format(json.loads(msg)["scan_id"]))
+        else:
+            messages.append(int(network.unpack_output(msg)[1][0, 0, 0]))
+
+    return messages
+
+
+def test_scan_tags():
+
+    msg = network.pack_output([5], np.zeros((1, 2, 2)), network.default_output_format())
+
+    assert network.untag_scan(network.tag_scan(msg, 12)) == (12, msg)
+    assert network.untag_scan(msg) == (None, msg)
+
+
+def test_ordered_proxy_incomplete_scan_then_early_frames_of_the_next():
+    """Scan 0 misses its frame 2, scan 1 starts before its metadata arrives"""
+
+    publisher, consumer = start_ordered_proxy()
+
+    late = network.counter("ordered_late", "").value
+
+    send_frame(publisher, 0, 1)
+    send_scan_metadata(publisher, 0, 4)
+    send_frame(publisher, 0, 0)
+    send_frame(publisher, 0, 3)
+
+    for index in [5, 0, 1]:
+        send_frame(publisher, 1, index)
+
+    #Frames of scan 1 wait for its metadata
+    assert received(consumer) == ["scan0", 0, 1]
+
+    send_scan_metadata(publisher, 1, 6)
+    send_frame(publisher, 0, 2) #scan 0 is over
+
+    for index in [3, 2, 4]:
+        send_frame(publisher, 1, index)
+
+    assert received(consumer) == [3, "scan1", 100, 101, 102, 103, 104, 105]
+    assert network.counter("ordered_late", "").value == late + 1
+
+
+def test_ordered_proxy_skips_missing_frames_after_the_timeout():
+
+    publisher, consumer = start_ordered_proxy(window_size = 8, timeout = 0.2)
+
+    send_scan_metadata(publisher, 0, 4)
+
+    for index in [0, 2, 3]:
+        send_frame(publisher, 0, index)
+
+    assert received(consumer, wait = 0.5) == ["scan0", 0, 2, 3]
+
+    #Frames of an earlier scan than the one being sent are dropped
+    send_scan_metadata(publisher, 2, 2)
+    send_frame(publisher, 1, 0)
+    send_frame(publisher, 2, 1)
+    send_frame(publisher, 2, 0)
+
+    assert received(consumer) == ["scan2", 200, 201]
@@ -0,0 +1,89 @@
+"""
+Unit tests of cosmicp.preprocessor helpers that don't need a scan.
+
+Usage: python -m pytest test/test_preprocessor.py
+"""
+
+import numpy as np
+import pytest
+
+from bench_pipeline import SyntheticFCCD, scan_metadata
+from cosmicp import preprocessor
+
+
+def test_refine_center_ignores_batch_padding():
+    """Rows of a padded batch past its position are undefined, they are left out of the center refinement"""
+
+    width = 8
+    refinement = preprocessor.start_center_refinement({"fast_start": True, "output_frame_width": width})
+
+    outputs = np.ones((4, 1, width, width), dtype = np.float32)
+    outputs[2:] = np.nan
+
+    inputs = (np.zeros((4, 2, 2)),)
+
+    assert preprocessor.refine_center(refinement, {}, None, None, inputs, outputs, (0, 2)) == []
+
+    assert np.all(refinement["sum"] == 2)
+    assert preprocessor.holds_output(refinement)
+
+
+def accumulated_scan(n_exposures = 8, repetition = 2):
+    """Double exposure synthetic scan of n_exposures exposures, repetition per position, with its metadata and background"""
+
+    sim = SyntheticFCCD()
+
+    dark_frames = sim.dark_frames(2)
+    exp_frames = sim.exp_frames(n_exposures)
+
+    metadata, background_avg = scan_metadata(sim, n_exposures, 64, dark_frames, exp_frames)
+    metadata["repetition"] = repetition
+
+    return metadata, background_avg, exp_frames
+
+
+def test_accumulated_frames_are_the_sums_of_the_exposures():
+    """Output frames of a scan with repetition 2 equal the sums of the pairs of frames processed without accumulation"""
+
+    metadata, background_avg, exp_frames = accumulated_scan()
+
+    def output_frames(accumulate):
+        filter_all, filter_all_dexp = preprocessor.prepare_filter_functions({**metadata, "accumulate": accumulate}, background_avg)
+        return np.asarray(filter_all_dexp(exp_frames[0::2], exp_frames[1::2]), dtype = np.float64)
+
+    frames = output_frames(None)
+    pairs = frames[0::2] + frames[1::2]
+
+    summed = output_frames("sum")
+
+    assert summed.shape == (4,) + frames.shape[1:]
+    assert np.sum(pairs) > 0
+    assert np.allclose(summed, pairs, rtol = 1e-4, atol = 1e-4 * np.max(pairs))
+
+    #The mean mode divides the same sums, without compiling the kernels again
+    clean_frames = np.arange(0, 24, dtype = np.float32).reshape(6, 2, 2)
+    assert np.allclose(preprocessor.accumulate_frames(clean_frames, 2, True), (clean_frames[0::2] + clean_frames[1::2]) / 2)
+
+
+def test_accumulation_metadata_averages_the_translations(monkeypatch):
+
+    warnings = []
+    monkeypatch.setattr(preprocessor, "log", lambda level, msg: warnings.append(msg))
+
+    translations = np.arange(0, 18, dtype = np.float64).reshape(9, 2)
+
+    #Without an accumulate mode, one output frame per exposure
+    metadata = preprocessor.compute_accumulation_metadata({"translations": translations.copy(), "repetition": 2, "accumulate": None})
+    assert metadata["translations"].shape == (9, 2)
+
+    metadata = preprocessor.compute_accumulation_metadata({"translations": translations[:8].copy(), "repetition": 2, "accumulate": "sum"})
+    assert np.array_equal(metadata["translations"], [[1, 2], [5, 6], [9, 10], [13, 14]])
+    assert warnings == []
+
+    #The leftover exposure of an incomplete position is left out, with a warning
+    metadata = preprocessor.compute_accumulation_metadata({"translations": translations.copy(), "repetition": 2, "accumulate": "mean"})
+    assert metadata["translations"].shape == (4, 2)
+    assert len(warnings) == 1 and "not a multiple of the repetition" in warnings[0]
+
+    with pytest.raises(Exception, match = "Accumulate mode"):
+        preprocessor.compute_accumulation_metadata({"translations": translations.copy(), "repetition": 2, "accumulate": "max"})
@@ -0,0 +1,114 @@
+"""
+Unit tests of cosmicp.reorder.ReorderBuffer, exposures are given their frame number as frame.
+
+Usage: python -m pytest test/test_reorder.py
+"""
+
+import time
+
+from cosmicp.reorder import ReorderBuffer
+from cosmicp.metrics import counter
+
+
+def count(name):
+    return counter(name, "").value
+
+
+def test_exposures_in_any_order_make_frames_in_completion_order():
+
+    reorder = ReorderBuffer(2, 2, 8)
+
+    for number in [3, 0, 2, 5, 1, 4]:
+        assert reorder.add(number, number, times = number)
+
+    assert reorder.batch_ready(flush_period = 10.0)
+
+    indexes, frames, times = reorder.pop_batch()
+
+    assert indexes == [1, 0]
+    assert frames == [2, 3, 0, 1] #exposures in order within each frame
+    assert times == [2, 1] #timestamps of the last exposure received
+
+    assert not reorder.batch_ready(flush_period = 10.0) #one frame left, not due yet
+    assert reorder.pop_batch()[0] == [2]
+
+
+def test_incomplete_frames_are_evicted_and_their_exposures_late():
+
+    reorder = ReorderBuffer(2, 4, 2)
+
+    incomplete, late = count("frames_incomplete"), count("frames_late")
+
+    reorder.add(0, 0) #frame 0 misses its second exposure
+    reorder.add(2, 2) #frame 1 misses its second exposure
+    reorder.add(6, 6)
+    reorder.add(7, 7) #frame 3 is complete, frame 0 is now more than 2 frames behind
+
+    assert count("frames_incomplete") == incomplete + 1
+    assert 0 not in reorder.exposures and 1 in reorder.exposures
+
+    assert not reorder.add(1, 1) #dropped frame
+    assert count("frames_late") == late + 1
+
+    reorder.add(9, 9) #frame 4, frame 1 is dropped too
+    assert count("frames_incomplete") == incomplete + 2
+    assert not reorder.add(3, 3)
+
+    assert reorder.pop_batch()[0] == [3]
+
+
+def test_frames_behind_the_window_are_late_without_being_buffered():
+
+    reorder = ReorderBuffer(1, 4, 2)
+
+    late = count("frames_late")
+
+    reorder.add(10, 10)
+
+    assert not reorder.add(7, 7)
+    assert reorder.add(8, 8)
+    assert count("frames_late") == late + 1
+    assert reorder.pop_batch()[0] == [10, 8]
+
+
+def test_duplicates_are_counted_and_ignored():
+
+    reorder = ReorderBuffer(2, 4, 8)
+
+    duplicates = count("frames_duplicate")
+
+    assert reorder.add(0, 0)
+    assert not reorder.add(0, 0) #exposure already buffered
+    assert reorder.add(1, 1)
+    assert not reorder.add(1, 1) #frame already completed
+
+    assert count("frames_duplicate") == duplicates + 2
+    assert reorder.pop_batch()[1] == [0, 1]
+
+
+def test_partial_batches_are_flushed_after_the_period_or_at_the_end():
+
+    reorder = ReorderBuffer(1, 4, 8)
+
+    assert reorder.wait_time(0.05) is None
+    assert not reorder.batch_ready(0.05, end = True)
+
+    reorder.add(1, 1)
+    reorder.add(0, 0)
+
+    assert not reorder.batch_ready(0.05)
+    assert 0 < reorder.wait_time(0.05) <= 0.05
+    assert reorder.batch_ready(0.05, end = True)
+
+    time.sleep(0.06)
+
+    assert reorder.wait_time(0.05) == 0.0
+    assert reorder.batch_ready(0.05)
+
+    #The oldest completed frames go first, full batches at most
+    for number in range(2, 8):
+        reorder.add(number, number)
+
+    assert reorder.pop_batch()[0] == [1, 0, 2, 3]
+    assert reorder.pop_batch()[0] == [4, 5, 6, 7]
+    assert reorder.pop_batch()[0] == []
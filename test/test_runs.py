@@ -0,0 +1,84 @@
+"""
+End to end runs of cosmic.py on a small synthetic scan (see bench_pipeline.SyntheticFCCD), packed into a raw frame container.
+
+Usage: python -m pytest test/test_runs.py
+"""
+
+import os
+import sys
+import glob
+import threading
+import subprocess
+
+import h5py
+import numpy as np
+import pytest
+
+from bench_pipeline import SyntheticFCCD
+from cosmicp.diskIO import write_raw_container
+
+package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+conf_file = os.path.join(package_dir, "configuration", "default.json")
+
+n_positions = 8
+n_darks = 2
+
+
+@pytest.fixture(scope = "module")
+def raw_scan(tmp_path_factory):
+    """Raw frame container of a double exposure scan"""
+
+    sim = SyntheticFCCD()
+
+    metadata = {"translations": [[0.03 * (i % 4), 0.03 * (i // 4)] for i in range(0, n_positions)],
+                "double_exposure": True, "dwell1": sim.dwell[0], "dwell2": sim.dwell[1], "energy": 800,
+                "exp_num_total": n_positions, "dark_num_total": n_darks}
+
+    fname = str(tmp_path_factory.mktemp("scan") / "scan_data.raw")
+
+    write_raw_container(fname, metadata, {"dark_frames": sim.dark_frames(n_darks), "exp_frames": sim.exp_frames(n_positions)})
+
+    return fname
+
+
+def run_cosmic(fname, args, timeout = 600):
+    """Runs cosmic.py on fname with args, returns the cxi file written.
+    With a socket output the router keeps the process running, it is stopped once the scan is saved (its stage timings are printed)"""
+
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([package_dir] + [p for p in [os.environ.get("PYTHONPATH")] if p]))
+
+    process = subprocess.Popen([sys.executable, "-u", os.path.join(package_dir, "cosmicp", "cosmic.py"), "-c", conf_file, "-b", "4"] + args + [fname],
+                               cwd = os.path.dirname(fname), env = env, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True)
+
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+
+    output = []
+    for line in process.stdout:
+        output.append(line)
+
+        if "Scan stage timings" in line:
+            process.terminate()
+
+    process.wait()
+    timer.cancel()
+
+    assert any("Scan stage timings" in line for line in output), "".join(output[-50:])
+
+    return max(glob.glob(os.path.join(os.path.dirname(fname), "*_cosmic2.cxi")), key = os.path.getmtime)
+
+
+def test_disksocket_preview(raw_scan):
+    """Previews only go to the socket, the cxi file is written as without them"""
+
+    tmp_dir = os.path.dirname(raw_scan)
+
+    cxi = run_cosmic(raw_scan, ["-m", "disksocket", "--preview", "1", "-o", "ipc://" + os.path.join(tmp_dir, "output"),
+                                "-i", "ipc://" + os.path.join(tmp_dir, "intermediate")])
+
+    with h5py.File(cxi, "r") as f:
+        frames = f["entry_1/data_1/data"][()]
+
+        assert frames.shape == (n_positions, 256, 256)
+        assert np.all(np.isfinite(frames)) and np.sum(frames) > 0
+        assert "preview" not in f
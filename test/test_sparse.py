@@ -0,0 +1,89 @@
+"""
+Round trips of the sparse (CSR) output frames: preprocessor.to_sparse, the cxi layout of sparse.py and the output messages.
+
+Usage: python -m pytest test/test_sparse.py
+"""
+
+import h5py
+import numpy as np
+import pytest
+
+from cosmicp import sparse, network
+from cosmicp.preprocessor import to_sparse, narrow_photon_counts
+
+
+def photon_frames(n = 5, width = 32, max_count = 200, seed = 0):
+    """Mostly zero photon count frames, with an empty one"""
+
+    rng = np.random.default_rng(seed)
+
+    frames = rng.integers(1, max_count + 1, (n, width, width)).astype(np.uint16)
+    frames[rng.random(frames.shape) < 0.9] = 0
+    frames[1] = 0
+
+    return frames
+
+
+@pytest.mark.parametrize("max_count, dtype", [(200, np.uint8), (3000, np.uint16)])
+def test_cxi_round_trip(tmp_path, max_count, dtype):
+    """Photon counts fitting in a byte are stored as uint8"""
+
+    frames = photon_frames(max_count = max_count)
+
+    block = to_sparse(frames)
+
+    assert block["values"].dtype == dtype
+    assert block["indices"].dtype == np.uint16
+    assert list(block["counts"]) == [np.count_nonzero(f) for f in frames]
+
+    with h5py.File(tmp_path / "sparse.cxi", "w") as f:
+        sparse.write_cxi(f, block)
+
+    with h5py.File(tmp_path / "sparse.cxi", "r") as f:
+        assert np.array_equal(sparse.read_cxi(f), frames)
+        assert np.array_equal(sparse.read_cxi(f, [3, 1, 0]), frames[[3, 1, 0]])
+        assert sparse.read_cxi(f, []).shape == (0, 32, 32)
+
+
+def test_float_frames_round_trip():
+
+    frames = photon_frames().astype(np.float32) * 0.5
+
+    block = to_sparse(frames)
+
+    assert block["values"].dtype == np.float32
+    assert np.array_equal(sparse.sparse_to_dense(block), frames)
+
+
+def test_concatenated_blocks():
+
+    frames = photon_frames(n = 6)
+
+    block = sparse.concatenate([to_sparse(frames[:2]), to_sparse(frames[2:])])
+
+    assert block["shape"] == [6, 32, 32]
+    assert np.array_equal(sparse.sparse_to_dense(block), frames)
+
+
+def test_narrow_photon_counts():
+
+    assert narrow_photon_counts(np.array([0, 255], dtype = np.uint16)).dtype == np.uint8
+    assert narrow_photon_counts(np.array([0, 256], dtype = np.uint16)).dtype == np.uint16
+    assert narrow_photon_counts(np.zeros(0, dtype = np.uint16)).dtype == np.uint16
+    assert narrow_photon_counts(np.array([1.0], dtype = np.float32)).dtype == np.float32
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib"])
+def test_output_message_round_trip(compression):
+
+    frames = photon_frames()
+
+    output_format = {**network.default_output_format(), "frames_per_message": len(frames), "compression": compression, "sparse": True}
+
+    msg = network.pack_output(list(range(10, 15)), to_sparse(frames), output_format)
+
+    indexes, block, times = network.unpack_output(msg, output_format)
+
+    assert indexes == list(range(10, 15))
+    assert np.array_equal(block, frames)
+    assert times is None